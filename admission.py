@@ -0,0 +1,161 @@
+import threading
+import time
+
+from flask import current_app, g, has_request_context, jsonify, request
+from sqlalchemy.pool import QueuePool
+
+
+AUTH_ENDPOINTS = {'login', 'get_token', 'register'}
+
+# POST only because the ids don't fit in a query string
+READ_ENDPOINTS = {'mget_posts'}
+
+# Dispatchers that take no slot themselves: each sub-request is admitted on its own
+DISPATCH_ENDPOINTS = {'batch'}
+
+# Share of the total concurrency each class may use; when the service is
+# saturated writes and logins are shed before reads
+DEFAULT_SHARES = {'read': 1.0, 'write': 0.7, 'auth': 0.5}
+
+
+def classify_request():
+    """
+    Route class of the current request by endpoint, or None for one that
+    isn't admitted.
+    """
+    if request.endpoint in DISPATCH_ENDPOINTS:
+        return None
+    if request.endpoint in AUTH_ENDPOINTS:
+        return 'auth'
+    if request.endpoint in READ_ENDPOINTS or request.method in ('GET', 'HEAD', 'OPTIONS'):
+        return 'read'
+    return 'write'
+
+
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit for one route class.
+
+    Every request that finishes within the target latency (without a long
+    wait for a DB connection) adds 1/limit, so the limit grows by about one per
+    round trip; a slow request cuts the limit by ``backoff``, at most once
+    per target-latency window so one burst doesn't collapse it.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_latency, backoff=0.9):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.in_flight = 0
+        self._last_decrease = 0.0
+
+    def on_complete(self, latency, congested, now):
+        if latency > self.target_latency or congested:
+            if now - self._last_decrease >= self.target_latency:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self._last_decrease = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+
+class AdmissionController:
+    """
+    Tracks in-flight requests per route class and sheds load with a fast 503
+    once a class reaches its adaptive limit.
+    """
+
+    def __init__(self, config):
+        targets = config.get('ADMISSION_TARGET_LATENCY_MS', {'read': 100, 'write': 250, 'auth': 500})
+        self.target_pool_wait = config.get('ADMISSION_TARGET_POOL_WAIT_MS', 20) / 1000.0
+        self.shares = config.get('ADMISSION_SHARES', DEFAULT_SHARES)
+        self.limits = {
+            name: AdaptiveLimit(
+                initial=config.get('ADMISSION_INITIAL_CONCURRENCY', 16),
+                minimum=config.get('ADMISSION_MIN_CONCURRENCY', 2),
+                maximum=config.get('ADMISSION_MAX_CONCURRENCY', 128),
+                target_latency=target / 1000.0
+            )
+            for name, target in targets.items()
+        }
+        self._lock = threading.Lock()
+
+    def total_in_flight(self):
+        return sum(limit.in_flight for limit in self.limits.values())
+
+    def total_limit(self):
+        return sum(limit.limit for limit in self.limits.values())
+
+    def try_acquire(self, route_class):
+        with self._lock:
+            limit = self.limits[route_class]
+            if limit.in_flight >= limit.limit:
+                return False
+            if self.total_in_flight() >= self.total_limit() * self.shares.get(route_class, 1.0):
+                return False
+            limit.in_flight += 1
+            return True
+
+    def release(self, route_class, latency, pool_wait):
+        # Queueing for a connection means the database is the bottleneck,
+        # whatever the request's own latency says
+        with self._lock:
+            limit = self.limits[route_class]
+            limit.in_flight -= 1
+            limit.on_complete(latency, pool_wait > self.target_pool_wait, time.monotonic())
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that adds the time each checkout waited for a connection to
+    the current request's ``g.pool_wait``.
+    """
+
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            if has_request_context():
+                g.pool_wait = g.get('pool_wait', 0.0) + time.monotonic() - started
+
+
+def overloaded():
+    response = jsonify({"error": "Service overloaded, please retry"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(current_app.config.get('ADMISSION_RETRY_AFTER', 1))
+    return response
+
+
+def _cache_hit():
+    # Set on the views by caching.single_flight_cached
+    cache_hit = getattr(current_app.view_functions.get(request.endpoint), 'cache_hit', None)
+    return cache_hit is not None and cache_hit()
+
+
+def init_app(app):
+    if not app.config.get('ADMISSION_ENABLED', True):
+        return
+    controller = AdmissionController(app.config)
+    app.extensions['admission'] = controller
+
+    @app.before_request
+    def admit():
+        route_class = classify_request()
+        if route_class is None:
+            return None
+        if route_class == 'read' and _cache_hit():
+            # Served without touching the database, so it takes no slot
+            g.cache_only = True
+            return None
+        if not controller.try_acquire(route_class):
+            return overloaded()
+        g.admission = (route_class, time.monotonic())
+
+    @app.teardown_request
+    def release(exc):
+        admitted = g.pop('admission', None)
+        if admitted is not None:
+            route_class, started = admitted
+            controller.release(route_class, time.monotonic() - started, g.pop('pool_wait', 0.0))
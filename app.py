@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_swagger_ui import get_swaggerui_blueprint
@@ -6,9 +6,26 @@ from config import Config
 from dotenv import load_dotenv
 import os
 from extensions import db
-from caching import cache
+import caching
+from caching import reset_after_fork
+from limiter import limiter
 from models import User, Post, Comment
 from routes import init_app
+from pubsub import broker
+import warmup
+from warmup import warm_cache_on_start
+import jobs
+import openapi
+import admission
+import trending
+import archive
+import profiling
+import traffic
+import sharding
+import suggest
+import changes
+import batch
+import snapshot
 
 def create_app():
     """
@@ -28,18 +45,52 @@ def create_app():
     migrate = Migrate(app, db)  # Initialize migrate with the app
 
     # Initialize cache with the app
-    cache.init_app(app)
+    caching.init_app(app)
+
+    # Initialize rate limiting with the app
+    limiter.init_app(app)
+
+    # Shed load with a fast 503 before the database falls over
+    admission.init_app(app)
+
+    # Sliding-window view/comment counters for GET /posts/trending
+    trending.init_app(app)
+
+    # Profile requests on demand (X-Profile header or sampling)
+    profiling.init_app(app)
 
     # Reference the models to ensure they are detected
     with app.app_context():
         db.create_all()
 
+    # Posts and comments tables on each shard, when sharded
+    sharding.init_app(app)
+
+    # In-memory title index behind GET /posts/suggest
+    suggest.init_app(app)
+
+    # Memory-mapped post snapshot for anonymous reads, and the command that builds it
+    snapshot.init_app(app)
+
     # Call init_app to register routes
     init_app(app)
+    batch.init_app(app)
+
+    # Start the background job worker for write side effects
+    jobs.init_app(app)
+
+    # Register the comment archival and change log compaction commands
+    archive.init_app(app)
+    changes.init_app(app)
+
+    # Fill the cache with the hottest pages before taking traffic, and
+    # again whenever another worker re-warmed its own
+    warm_cache_on_start(app)
+    warmup.init_app(app)
 
     # Swagger UI configuration
     SWAGGER_URL = '/swagger'
-    API_URL = '/swagger/swagger.yaml'  # Path to your Swagger YAML file
+    API_URL = '/swagger/swagger.json'  # Generated at startup, see openapi.py
 
     swagger_ui_blueprint = get_swaggerui_blueprint(
         SWAGGER_URL,
@@ -52,10 +103,8 @@ def create_app():
     # Register the Swagger UI blueprint
     app.register_blueprint(swagger_ui_blueprint, url_prefix=SWAGGER_URL)
 
-    # Serve the Swagger YAML file
-    @app.route('/swagger/swagger.yaml')
-    def swagger_yaml():
-        return send_from_directory('swagger', 'swagger.yaml')
+    # Serve the OpenAPI spec generated from the schemas and routes, from memory
+    openapi.init_app(app, json_url='/swagger/swagger.json', yaml_url='/swagger/swagger.yaml')
 
     # Define custom error handlers
     @app.errorhandler(404)
@@ -79,7 +128,31 @@ def create_app():
         """
         return jsonify({"error": "Internal server error"}), 500
 
+    # Record requests for replay when TRAFFIC_CAPTURE_FILE is set
+    traffic.init_app(app)
+
     return app
 
 
+def after_fork(app):
+    """
+    Give a worker forked from a preloaded app its own per-process state.
+
+    Called from gunicorn's post_fork hook (see gunicorn.conf.py). Imported
+    code and cached entries stay shared with the parent copy-on-write.
+    """
+    # Pooled connections belong to the parent; drop them without closing its sockets
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+    reset_after_fork()
+    sharding.allocator.reset()
+    limiter.init_app(app)
+    app.extensions.pop('group_commit', None)
+    app.extensions.pop('batch', None)
+    broker.after_fork()
+    jobs.resume_pending_jobs(app)
+
+
 app = create_app()
\ No newline at end of file
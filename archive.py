@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+
+from flask import abort, current_app
+from sqlalchemy import func, insert, select, update
+
+import sharding
+from extensions import db
+from models import Post, Comment, ArchivedComment
+from projection import projection_options
+from purge import delete_in_chunks
+
+
+ARCHIVED_COLUMNS = ('id', 'content', 'date_posted', 'user_id', 'post_id', 'parent_id', 'path', 'depth')
+
+
+def _copy_comments(source, target, post_id, chunk_size):
+    """
+    Copy a post's comments from ``source`` to ``target`` in id order.
+
+    Rows already in ``target`` are skipped, so an interrupted copy can simply
+    be run again. Returns the ids of every row now in both tables.
+    """
+    columns = [getattr(source, name) for name in ARCHIVED_COLUMNS]
+    copied = []
+    while True:
+        rows = db.session.execute(
+            select(*columns)
+            .where(source.post_id == post_id, source.id > (copied[-1] if copied else 0))
+            .order_by(source.id)
+            .limit(chunk_size)
+        ).mappings().all()
+        if not rows:
+            return copied
+        ids = [row['id'] for row in rows]
+        present = set(db.session.scalars(select(target.id).where(target.id.in_(ids))))
+        missing = [dict(row) for row in rows if row['id'] not in present]
+        if missing:
+            # Bulk insert: ids and paths are kept, no per-row events fire.
+            # On the connection of the post's shard, as the ORM can't split it
+            connection = db.session.connection(bind_arguments=sharding.bind_arguments(target, post_id))
+            connection.execute(insert(target.__table__), missing)
+        db.session.commit()
+        copied.extend(ids)
+
+
+def _delete_copied(model, ids, chunk_size):
+    # Only rows known to be in the other table; anything written since stays
+    for start in range(0, len(ids), chunk_size):
+        delete_in_chunks(model, model.id.in_(ids[start:start + chunk_size]), chunk_size=chunk_size)
+
+
+def archive_post(post_id):
+    """
+    Move all of a post's comments to the archive.
+
+    Readers switch to the archive once the copy is complete and the post is
+    flagged; only then are the copied hot rows deleted.
+    """
+    chunk_size = current_app.config.get('ARCHIVE_CHUNK_SIZE', 1000)
+    copied = _copy_comments(Comment, ArchivedComment, post_id, chunk_size)
+    db.session.execute(update(Post).where(Post.id == post_id).values(comments_archived=True))
+    db.session.commit()
+    _delete_copied(Comment, copied, chunk_size)
+
+    # Someone commented while we were copying: keep the thread in one place
+    if db.session.scalar(select(Comment.id).where(Comment.post_id == post_id).limit(1)) is not None:
+        restore_post(post_id)
+
+
+def restore_post(post_id):
+    """
+    Move a post's archived comments back to the hot table.
+    """
+    chunk_size = current_app.config.get('ARCHIVE_CHUNK_SIZE', 1000)
+    copied = _copy_comments(ArchivedComment, Comment, post_id, chunk_size)
+    db.session.execute(update(Post).where(Post.id == post_id).values(comments_archived=False))
+    db.session.commit()
+    _delete_copied(ArchivedComment, copied, chunk_size)
+
+
+def archive_inactive_posts(now=None, limit=None):
+    """
+    Archive the comments of every post with no comment newer than
+    ``ARCHIVE_AFTER_DAYS``. Returns the number of posts archived.
+    """
+    now = now or datetime.now(timezone.utc).replace(tzinfo=None)
+    cutoff = now - timedelta(days=current_app.config.get('ARCHIVE_AFTER_DAYS', 180))
+    post_ids = db.session.scalars(
+        select(Comment.post_id)
+        .group_by(Comment.post_id)
+        .having(func.max(Comment.date_posted) < cutoff)
+        .limit(limit)
+    ).all()
+    for post_id in post_ids:
+        archive_post(post_id)
+    return len(post_ids)
+
+
+def thaw_post(post_id):
+    """
+    Bring an archived post's comments back before writing to its thread.
+    """
+    if db.session.scalar(select(Post.comments_archived).where(Post.id == post_id)):
+        restore_post(post_id)
+
+
+def comment_model_or_404(post_id):
+    """
+    Return the model holding a post's comments: Comment, or ArchivedComment
+    once the post has been archived.
+    """
+    row = db.session.execute(select(Post.comments_archived).where(Post.id == post_id)).first()
+    if row is None:
+        abort(404)
+    return ArchivedComment if row.comments_archived else Comment
+
+
+def get_comment_or_404(id, fields=None):
+    """
+    Look a comment up in the hot table, then in the archive.
+    """
+    for model in (Comment, ArchivedComment):
+        options = projection_options(model, fields) if fields is not None else ()
+        comment = db.session.get(model, id, options=options)
+        if comment is not None:
+            return comment
+    abort(404)
+
+
+def get_hot_comment_or_404(id):
+    """
+    Look a comment up for writing, restoring its post from the archive if needed.
+    """
+    comment = db.session.get(Comment, id)
+    if comment is None:
+        archived = db.session.get(ArchivedComment, id)
+        if archived is None:
+            abort(404)
+        restore_post(archived.post_id)
+        comment = db.session.get(Comment, id)
+    return comment
+
+
+def init_app(app):
+    """
+    Register the ``flask archive-comments`` command.
+    """
+    @app.cli.command('archive-comments')
+    def run_archive():
+        """Move the comments of inactive posts to the archive."""
+        print(f'Archived comments of {archive_inactive_posts()} posts')
@@ -1,3 +1,4 @@
+from flask import request
 from flask_httpauth import HTTPTokenAuth
 from utils.utils import decode_token
 from models import User  # Changed from Customer to User
@@ -8,11 +9,17 @@ token_auth = HTTPTokenAuth(scheme='Bearer')
 
 @token_auth.verify_token
 def verify_token(token):
+    # Sub-requests of POST /batch reuse the user the batch authenticated (see batch.py)
+    if 'blog.batch_user' in request.environ:
+        return request.environ['blog.batch_user']
     # Decode the token to get the user id
     user_id = decode_token(token)
     if user_id is not None:
-        # Get the user with that ID
-        return db.session.get(User, user_id)
+        # Get the user with that ID, unless the account is being deleted
+        user = db.session.get(User, user_id)
+        if user is not None and user.deleted_at is None:
+            return user
+        return None
     else:
         return None
 
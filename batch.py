@@ -0,0 +1,172 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import jsonify, request
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+
+from auth import token_auth
+from extensions import db
+from limiter import limiter
+
+
+# Reads can't see each other's effects, so they may run in any order
+READ_METHODS = frozenset({'GET', 'HEAD'})
+METHODS = READ_METHODS | {'POST', 'PUT', 'PATCH', 'DELETE'}
+# Sub-request headers the batch sets itself, or that make no sense inside it
+RESERVED_HEADERS = frozenset({'authorization', 'accept-encoding', 'content-length', 'host'})
+# Response headers left out of the results
+SKIPPED_HEADERS = frozenset({'Content-Length', 'Content-Encoding', 'Vary'})
+
+_executor_lock = threading.Lock()
+
+
+def _executor(app):
+    # Created on first use, so a worker forked from a preloaded app starts its own threads
+    with _executor_lock:
+        executor = app.extensions.get('batch')
+        if executor is None:
+            executor = app.extensions['batch'] = ThreadPoolExecutor(
+                max_workers=app.config.get('BATCH_MAX_WORKERS', 8), thread_name_prefix='batch')
+        return executor
+
+
+def _validate(spec):
+    if not isinstance(spec, dict):
+        return 'must be an object'
+    path = spec.get('path')
+    if not isinstance(path, str) or not path.startswith('/'):
+        return 'path must be a string starting with /'
+    method = spec.get('method', 'GET')
+    if not isinstance(method, str) or method.upper() not in METHODS:
+        return f"method must be one of {', '.join(sorted(METHODS))}"
+    headers = spec.get('headers', {})
+    if not isinstance(headers, dict) or not all(isinstance(v, str) for v in headers.values()):
+        return 'headers must be an object of strings'
+    return None
+
+
+def _environ(spec, user):
+    """
+    WSGI environ of one sub-request: the client's address and token, and
+    the user the batch already authenticated (see auth.verify_token).
+    """
+    headers = {name: value for name, value in spec.get('headers', {}).items()
+               if name.lower() not in RESERVED_HEADERS}
+    if 'Authorization' in request.headers:
+        headers['Authorization'] = request.headers['Authorization']
+    builder = EnvironBuilder(
+        path=spec['path'],
+        method=spec.get('method', 'GET').upper(),
+        headers=headers,
+        json=spec['body'] if 'body' in spec else None,
+        environ_base={'REMOTE_ADDR': request.remote_addr, 'blog.batch_user': user},
+    )
+    try:
+        return builder.get_environ()
+    finally:
+        builder.close()
+
+
+def _endpoint(app, environ):
+    try:
+        return app.url_map.bind_to_environ(environ).match()[0]
+    except HTTPException:
+        return None  # dispatching gives the 404 or 405
+
+
+def _dispatch(app, environ):
+    """
+    Run one sub-request through the app, hooks, rate limits and error
+    handlers included, in its own app context (so its own session and ``g``).
+    """
+    with app.app_context(), app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as error:
+            response = app.handle_exception(error)
+        try:
+            if response.is_streamed:
+                return {'status': 400, 'headers': {},
+                        'body': {'error': 'Streaming responses are not supported in a batch'}}
+            if response.is_json:
+                body = response.get_json(silent=True)
+            else:
+                body = response.get_data(as_text=True)
+            headers = {name: value for name, value in response.headers.items() if name not in SKIPPED_HEADERS}
+            return {'status': response.status_code, 'headers': headers, 'body': body}
+        finally:
+            response.close()
+
+
+def run_batch(app, environs):
+    """
+    Dispatch sub-requests and return their results in request order.
+
+    Consecutive reads run concurrently on the batch thread pool; each write
+    waits for the reads before it and runs alone, so later sub-requests
+    see its effects.
+    """
+    results = [None] * len(environs)
+    reads = []
+
+    def finish_reads():
+        if len(reads) == 1:
+            i, environ = reads[0]
+            results[i] = _dispatch(app, environ)
+        elif reads:
+            executor = _executor(app)
+            futures = [(i, executor.submit(_dispatch, app, environ)) for i, environ in reads]
+            for i, future in futures:
+                results[i] = future.result()
+        reads.clear()
+
+    for i, environ in enumerate(environs):
+        if environ['REQUEST_METHOD'] in READ_METHODS:
+            reads.append((i, environ))
+            continue
+        finish_reads()
+        results[i] = _dispatch(app, environ)
+    finish_reads()
+    return results
+
+
+def init_app(app):
+    """
+    Register ``POST /batch``.
+    """
+    @app.route('/batch', methods=['POST'])
+    @token_auth.login_required(optional=True)
+    @limiter.limit("30 per minute")
+    def batch():
+        """
+        Run an array of sub-requests (``{"method", "path", "body",
+        "headers"}``) in one round trip and return their ``status``,
+        ``headers`` and ``body`` in the same order.
+
+        The token is checked once for the whole batch. Every sub-request
+        still goes through its route's rate limit.
+        """
+        specs = request.get_json(silent=True)
+        if not isinstance(specs, list) or not specs:
+            return {"error": "Request body must be a non-empty JSON array of sub-requests"}, 400
+        max_requests = app.config['BATCH_MAX_REQUESTS']
+        if len(specs) > max_requests:
+            return {"error": f"At most {max_requests} sub-requests per batch"}, 400
+        for i, spec in enumerate(specs):
+            error = _validate(spec)
+            if error:
+                return {"error": f"Sub-request {i}: {error}"}, 400
+
+        user = token_auth.current_user()
+        if user is None and 'Authorization' in request.headers:
+            return {"error": "Invalid token. Please try again"}, 401
+        if user is not None:
+            # Sub-requests read it from other threads and sessions
+            db.session.expunge(user)
+
+        environs = [_environ(spec, user) for spec in specs]
+        for i, environ in enumerate(environs):
+            if _endpoint(app, environ) == 'batch':
+                return {"error": f"Sub-request {i}: batches can't be nested"}, 400
+        return jsonify(run_batch(app, environs))
@@ -0,0 +1,227 @@
+import pickle
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from flask_caching.backends.base import BaseCache
+
+
+# Rough per-entry bookkeeping cost (dict slots, entry object, key string)
+ENTRY_OVERHEAD = 120
+
+# Halves every 4-bit counter of the frequency sketch in one bytes.translate()
+_HALVE = bytes(i >> 1 for i in range(256))
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of small saturating counters (the "TinyLFU" in W-TinyLFU).
+
+    Counters are halved after ``10 * width`` increments, so the estimate
+    follows recent popularity rather than all-time totals.
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.mask = self.width - 1
+        self.rows = [bytearray(self.width) for _ in range(depth)]
+        self.seeds = [random.getrandbits(64) | 1 for _ in range(depth)]
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        return [((h ^ seed) * 0x9E3779B97F4A7C15 >> 32) & self.mask for seed in self.seeds]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self._indexes(key)):
+            if row[i] < 15:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [bytearray(row.translate(_HALVE)) for row in self.rows]
+            self.additions //= 2
+
+    def frequency(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'expires', 'pickled')
+
+    def __init__(self, value, size, expires, pickled):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.pickled = pickled
+
+
+def _is_immutable(value):
+    if value is None or isinstance(value, (str, bytes, int, float)):
+        return True
+    if isinstance(value, tuple):
+        return all(_is_immutable(item) for item in value)
+    return getattr(value, 'cache_immutable', False)
+
+
+def _sizeof(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_sizeof(item) for item in value)
+    nbytes = getattr(value, 'nbytes', None)
+    return nbytes if nbytes is not None else 16
+
+
+class WTinyLFUCache(BaseCache):
+    """
+    In-process cache bounded by bytes, with W-TinyLFU eviction.
+
+    New entries land in a small LRU window. Entries leaving the window only
+    enter the main segmented LRU (probation + protected) if the frequency
+    sketch says they are requested more often than the entry they would
+    evict, so one-off pages can't flush the popular ones.
+
+    Immutable values (strings, bytes, numbers, tuples of those and objects
+    flagged ``cache_immutable``, like encoded responses) are stored as they
+    are and returned without a copy; anything else is pickled like
+    SimpleCache does.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, window_ratio=0.01, protected_ratio=0.8,
+                 default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self.max_bytes = max_bytes
+        self.window_bytes = max(int(max_bytes * window_ratio), 1)
+        self.protected_bytes = int((max_bytes - self.window_bytes) * protected_ratio)
+        # Assume ~2 KB per entry when sizing the sketch
+        self.sketch = FrequencySketch(min(max(max_bytes // 2048, 1024), 1 << 20))
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        self._sizes = {'window': 0, 'probation': 0, 'protected': 0}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs['max_bytes'] = config.get('CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        return cls(*args, **kwargs)
+
+    @property
+    def used_bytes(self):
+        return sum(self._sizes.values())
+
+    def _segments(self):
+        return (('window', self._window), ('probation', self._probation), ('protected', self._protected))
+
+    def _find(self, key):
+        for name, segment in self._segments():
+            entry = segment.get(key)
+            if entry is not None:
+                return name, segment, entry
+        return None, None, None
+
+    def _remove(self, key):
+        for name, segment in self._segments():
+            entry = segment.pop(key, None)
+            if entry is not None:
+                self._sizes[name] -= entry.size
+                return entry
+        return None
+
+    def _expired(self, entry, now):
+        return entry.expires is not None and entry.expires <= now
+
+    def get(self, key):
+        with self._lock:
+            self.sketch.increment(key)
+            name, segment, entry = self._find(key)
+            if entry is None:
+                return None
+            if self._expired(entry, time.monotonic()):
+                self._remove(key)
+                return None
+            if name == 'probation':
+                # A second hit promotes the entry to the protected segment
+                del self._probation[key]
+                self._sizes['probation'] -= entry.size
+                self._protected[key] = entry
+                self._sizes['protected'] += entry.size
+                self._demote_protected()
+            else:
+                segment.move_to_end(key)
+        return pickle.loads(entry.value) if entry.pickled else entry.value
+
+    def set(self, key, value, timeout=None):
+        timeout = self._normalize_timeout(timeout)
+        pickled = not _is_immutable(value)
+        if pickled:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = _sizeof(value) + len(key) + ENTRY_OVERHEAD
+        if size > self.max_bytes - self.window_bytes:
+            # Could never be admitted; don't flush the cache trying
+            self.delete(key)
+            return False
+        entry = _Entry(value, size, time.monotonic() + timeout if timeout > 0 else None, pickled)
+        with self._lock:
+            self._remove(key)
+            self.sketch.increment(key)
+            self._window[key] = entry
+            self._sizes['window'] += size
+            while self._sizes['window'] > self.window_bytes:
+                candidate_key, candidate = self._window.popitem(last=False)
+                self._sizes['window'] -= candidate.size
+                self._admit(candidate_key, candidate)
+        return True
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            _, _, entry = self._find(key)
+            if entry is not None and not self._expired(entry, time.monotonic()):
+                return False
+            return self.set(key, value, timeout)
+
+    def _admit(self, key, candidate):
+        """
+        Move a window entry into probation if it beats the entries it displaces.
+        """
+        budget = self.max_bytes - self.window_bytes
+        now = time.monotonic()
+        frequency = None
+        while self._sizes['probation'] + self._sizes['protected'] + candidate.size > budget:
+            segment = self._probation or self._protected
+            name = 'probation' if segment is self._probation else 'protected'
+            victim_key, victim = next(iter(segment.items()))
+            if not self._expired(victim, now):
+                if frequency is None:
+                    frequency = self.sketch.frequency(key)
+                if frequency <= self.sketch.frequency(victim_key):
+                    return
+            del segment[victim_key]
+            self._sizes[name] -= victim.size
+        self._probation[key] = candidate
+        self._sizes['probation'] += candidate.size
+
+    def _demote_protected(self):
+        while self._sizes['protected'] > self.protected_bytes:
+            key, entry = self._protected.popitem(last=False)
+            self._sizes['protected'] -= entry.size
+            self._probation[key] = entry
+            self._sizes['probation'] += entry.size
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key) is not None
+
+    def has(self, key):
+        with self._lock:
+            _, _, entry = self._find(key)
+            return entry is not None and not self._expired(entry, time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            for _, segment in self._segments():
+                segment.clear()
+            self._sizes = dict.fromkeys(self._sizes, 0)
+        return True
@@ -1,4 +1,446 @@
-from flask_caching import Cache
-
-
-cache = Cache(config={'CACHE_TYPE': "SimpleCache"})
+import gzip
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import Response, current_app, g, jsonify, make_response, request
+from flask_caching import Cache
+from flask_caching.backends import NullCache, SimpleCache
+
+from admission import overloaded
+from bytecache import WTinyLFUCache
+from pubsub import broker
+
+
+# CACHE_TYPE can point at a shared backend (e.g. RedisCache) so that cached
+# entries and rebuild locks are visible to every worker, not just one process.
+# The default is an in-process cache bounded by CACHE_MAX_BYTES (see bytecache.py).
+cache = Cache(config={'CACHE_TYPE': os.getenv('CACHE_TYPE', "bytecache.WTinyLFUCache")})
+
+# Rebuilds currently running in this process: cache key -> Event set when done
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Bumped on every post write so all cached list_posts pages (and projected
+# get_post variants) go stale at once
+POST_LIST_VERSION_KEY = 'version/post_list'
+
+# Versions of a process-local cache, kept out of it so eviction can't lose them
+_versions = {}
+
+# Invalidations every other worker applies to its own process-local cache
+INVALIDATIONS_CHANNEL = 'cache:invalidations'
+_invalidations_lock = threading.Lock()
+
+# get_post requests seen by this process, used to pick the posts to warm
+_post_hits = Counter()
+_post_hits_lock = threading.Lock()
+
+
+def reset_after_fork():
+    """
+    Forget the parent's in-flight rebuilds and locks in a forked worker.
+
+    Their threads don't exist in the child. Cached entries are kept, so with
+    SimpleCache every worker starts from the parent's warmed cache.
+    """
+    global _inflight_lock, _post_hits_lock, _invalidations_lock
+    _inflight.clear()
+    _inflight_lock = threading.Lock()
+    _post_hits_lock = threading.Lock()
+    _invalidations_lock = threading.Lock()
+
+
+class CachedResponse:
+    """
+    A cached view response reduced to its encoded body, status and headers.
+
+    Hits build a new Response around the stored bytes; nothing is unpickled.
+    Bodies of at least ``CACHE_COMPRESS_MIN_BYTES`` are kept gzipped and
+    sent as is to clients that accept gzip.
+    """
+
+    __slots__ = ('data', 'status', 'headers', 'compressed')
+    cache_immutable = True
+
+    def __init__(self, data, status, headers, compressed):
+        self.data = data
+        self.status = status
+        self.headers = headers
+        self.compressed = compressed
+
+    @classmethod
+    def from_response(cls, response):
+        data = response.get_data()
+        # Content-Length is recomputed, and Content-Encoding is ours to set
+        headers = tuple((name, value) for name, value in response.headers.items()
+                        if name not in ('Content-Length', 'Content-Encoding'))
+        threshold = current_app.config.get('CACHE_COMPRESS_MIN_BYTES', 1024)
+        compressed = bool(threshold) and len(data) >= threshold
+        if compressed:
+            data = gzip.compress(data, compresslevel=6)
+        return cls(data, response.status_code, headers, compressed)
+
+    @property
+    def nbytes(self):
+        return len(self.data) + sum(len(name) + len(value) for name, value in self.headers)
+
+    @property
+    def body(self):
+        return gzip.decompress(self.data) if self.compressed else self.data
+
+    def get_json(self):
+        return json.loads(self.body)
+
+    def to_response(self):
+        if not self.compressed:
+            return Response(self.data, status=self.status, headers=self.headers)
+        if 'gzip' in request.accept_encodings:
+            headers = self.headers + (('Content-Encoding', 'gzip'), ('Vary', 'Accept-Encoding'))
+            return Response(self.data, status=self.status, headers=headers)
+        return Response(self.body, status=self.status, headers=self.headers + (('Vary', 'Accept-Encoding'),))
+
+
+def make_view_cache_key(query_string=False, version_key=None):
+    """
+    Build the cache key for the current request's view.
+
+    ``query_string`` is either True (every argument is part of the key) or a
+    collection of the argument names that are. ``version_key`` may be a
+    callable returning the version key to use, or None for no versioning.
+    """
+    key = f'view/{request.path}'
+    if query_string:
+        args = sorted((k, v) for k, values in request.args.lists() for v in values
+                      if query_string is True or k in query_string)
+        if args:
+            key = f'{key}?{urlencode(args)}'
+    if callable(version_key):
+        version_key = version_key()
+    if version_key:
+        key = f'{key}#{get_version(version_key)}'
+    return key
+
+
+def shared_cache():
+    """
+    Whether ``CACHE_TYPE`` is a backend every worker sees, rather than one
+    kept inside each process.
+    """
+    return not isinstance(cache.cache, (WTinyLFUCache, SimpleCache, NullCache))
+
+
+def get_version(version_key):
+    """
+    Current value of a version key.
+
+    A shared cache may evict it like any entry; a new version is started
+    then, so the pages cached under the lost one are never served again.
+    """
+    if not shared_cache():
+        return _versions.get(version_key, 0)
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, timeout=0)
+        version = cache.get(version_key)
+    return version
+
+
+def bump_version(version_key):
+    """
+    Start a new version, so every entry keyed on the old one goes stale.
+    """
+    version = uuid.uuid4().hex
+    if shared_cache():
+        cache.set(version_key, version, timeout=0)
+    else:
+        _versions[version_key] = version
+    return version
+
+
+def projected_post_version():
+    """
+    Version key for get_post: only projected (``fields=``) variants are
+    versioned, the full representation is invalidated by key.
+    """
+    return POST_LIST_VERSION_KEY if request.args.get('fields') else None
+
+
+def post_cache_key(post_id):
+    """
+    Cache key of the get_post response for a post.
+    """
+    return f'view//posts/{post_id}'
+
+
+def invalidate_post(post_id=None):
+    """
+    Drop the cached list_posts pages and, if given, the cached post itself.
+    """
+    _invalidate([post_cache_key(post_id)] if post_id is not None else [], POST_LIST_VERSION_KEY)
+
+
+def _invalidate(keys, version_key=None):
+    """
+    Delete ``keys`` and bump ``version_key`` here and, when each worker
+    keeps its own cache, in every other worker.
+    """
+    versions = {version_key: bump_version(version_key)} if version_key else {}
+    if keys:
+        cache.delete_many(*keys)
+    if not shared_cache():
+        broker.publish(INVALIDATIONS_CHANNEL, {'pid': os.getpid(), 'keys': keys, 'versions': versions})
+
+
+def apply_invalidations(subscription):
+    """
+    Apply the invalidations other workers published since the last call.
+    """
+    with _invalidations_lock:
+        _apply_invalidations(subscription)
+
+
+def _apply_invalidations(subscription):
+    if subscription.lagged:
+        # Some were dropped: nothing cached here can be trusted
+        subscription.lagged = False
+        subscription.wait(0)
+        _drop_local_cache()
+        return
+    for event in subscription.wait(0):
+        if event['pid'] == os.getpid():
+            continue
+        if event.get('flush'):
+            _drop_local_cache()
+            continue
+        _versions.update(event['versions'])
+        if event['keys']:
+            cache.delete_many(*event['keys'])
+
+
+def _drop_local_cache():
+    cache.clear()
+    for version_key in list(_versions):
+        bump_version(version_key)
+
+
+def _flush_event(channel, event):
+    # An invalidation too large for a datagram arrives without its keys
+    return {'pid': None, 'flush': True}
+
+
+def get_cached_posts(post_ids):
+    """
+    Fetch the cached get_post payloads of many posts in one cache round trip.
+
+    Returns a dict of post id -> serialized post for the fresh entries only.
+    """
+    entries = cache.get_many(*[post_cache_key(post_id) for post_id in post_ids])
+    now = time.time()
+    return {
+        post_id: entry[0].get_json()
+        for post_id, entry in zip(post_ids, entries)
+        if entry is not None and entry[2] > now
+    }
+
+
+def cache_posts(posts_data, timeout=60):
+    """
+    Store serialized posts under their get_post keys in one cache round trip.
+    """
+    stale_timeout = current_app.config.get('CACHE_STALE_TIMEOUT', 30)
+    expires_at = time.time() + timeout
+    cache.set_many(
+        {post_cache_key(data['id']): (CachedResponse.from_response(jsonify(data)), 0.0, expires_at)
+         for data in posts_data},
+        timeout=timeout + stale_timeout
+    )
+
+
+def user_cache_key(user_id):
+    """
+    Cache key of a user's public fields, as side-loaded by ``include=author``.
+    """
+    return f'entity/users/{user_id}'
+
+
+def invalidate_user(user_id):
+    """
+    Drop a user's cached public fields.
+    """
+    _invalidate([user_cache_key(user_id)])
+
+
+def _count_post_hit(post_id):
+    tracked = current_app.config.get('CACHE_HOT_POSTS_TRACKED', 10000)
+    with _post_hits_lock:
+        _post_hits[post_id] += 1
+        if len(_post_hits) > tracked:
+            # Keep the busiest half with their counts halved, so old popularity fades
+            kept = _post_hits.most_common(tracked // 2)
+            _post_hits.clear()
+            _post_hits.update({kept_id: hits // 2 or 1 for kept_id, hits in kept})
+
+
+def track_post_access(f):
+    """
+    Count successful requests per post id, cache hits included. Ids that
+    don't exist (404s) are never counted.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = make_response(f(*args, **kwargs))
+        if response.status_code == 200 and not request.environ.get('blog.warmup'):
+            _count_post_hit(kwargs['id'])
+        return response
+    return decorated_function
+
+
+def hot_post_ids(limit):
+    """
+    Return the ids of the most requested posts, most requested first.
+    """
+    with _post_hits_lock:
+        return [post_id for post_id, _ in _post_hits.most_common(limit)]
+
+
+def seed_post_hits(counts):
+    """
+    Merge previously recorded access counts into this process's counters.
+    """
+    with _post_hits_lock:
+        _post_hits.update(counts)
+
+
+def _should_refresh(entry):
+    """
+    Probabilistic early expiration (XFetch): the closer an entry is to its
+    expiry and the longer it took to compute, the likelier a request is to
+    refresh it before it actually expires.
+    """
+    _, delta, expires_at = entry
+    beta = current_app.config.get('CACHE_EARLY_REFRESH_BETA', 1.0)
+    jitter = -delta * beta * math.log(1.0 - random.random())
+    return time.time() + jitter >= expires_at
+
+
+def _wait_for_entry(key, timeout):
+    """
+    Poll the cache until another worker stores the entry or the timeout runs out.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+        time.sleep(0.01)
+    return None
+
+
+def _rebuild(key, entry, timeout, compute):
+    """
+    Recompute a cached view with single-flight semantics.
+
+    Only one request per process, and one per shared cache backend, runs
+    ``compute``. The others get the stale copy if there is one, or wait for
+    the leader's result.
+    """
+    lock_timeout = current_app.config.get('CACHE_LOCK_TIMEOUT', 5)
+
+    with _inflight_lock:
+        event = _inflight.get(key)
+        leader = event is None
+        if leader:
+            event = _inflight[key] = threading.Event()
+
+    if not leader:
+        if entry is not None:
+            return entry[0].to_response()
+        event.wait(lock_timeout)
+        fresh = cache.get(key)
+        return fresh[0].to_response() if fresh is not None else compute()
+
+    try:
+        lock_key = f'lock/{key}'
+        if not cache.add(lock_key, 1, timeout=lock_timeout):
+            # Another worker is rebuilding this entry
+            if entry is not None:
+                return entry[0].to_response()
+            fresh = _wait_for_entry(key, lock_timeout)
+            return fresh[0].to_response() if fresh is not None else compute()
+
+        try:
+            start = time.time()
+            response = current_app.make_response(compute())
+            delta = time.time() - start
+            if response.status_code == 200:
+                stale_timeout = current_app.config.get('CACHE_STALE_TIMEOUT', 30)
+                cache.set(key, (CachedResponse.from_response(response), delta, time.time() + timeout),
+                          timeout=timeout + stale_timeout)
+            return response
+        finally:
+            cache.delete(lock_key)
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        event.set()
+
+
+def single_flight_cached(timeout=60, query_string=False, version_key=None):
+    """
+    Cache a view like ``cache.cached`` while protecting it from stampedes.
+
+    Entries are refreshed early with a probability that grows as they near
+    expiry, and they are kept for ``CACHE_STALE_TIMEOUT`` more seconds so that
+    concurrent requests can be served the stale copy during a rebuild.
+    Passing ``version_key`` lets a whole family of entries be invalidated by
+    bumping one counter.
+
+    Requests admission control let through as cache hits (``g.cache_only``)
+    are served the entry as is and never rebuild it.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = make_view_cache_key(query_string, version_key)
+            entry = cache.get(key)
+            if entry is not None and (g.get('cache_only') or not _should_refresh(entry)):
+                return entry[0].to_response()
+            if g.get('cache_only'):
+                return overloaded()  # evicted since admission checked
+            return _rebuild(key, entry, timeout, lambda: f(*args, **kwargs))
+
+        def cache_hit():
+            """
+            Whether the current request has an unexpired entry.
+            """
+            entry = cache.get(make_view_cache_key(query_string, version_key))
+            return entry is not None and time.time() < entry[2]
+
+        decorated_function.cache_hit = cache_hit
+        return decorated_function
+    return decorator
+
+
+def init_app(app):
+    """
+    Attach the cache to the app. With a process-local ``CACHE_TYPE``, each
+    request first applies the invalidations published by other workers.
+    """
+    cache.init_app(app)
+    with app.app_context():
+        if shared_cache():
+            return
+    subscription = app.extensions['cache_invalidations'] = broker.subscribe(INVALIDATIONS_CHANNEL)
+    broker.add_resolver(INVALIDATIONS_CHANNEL, _flush_event)
+
+    @app.before_request
+    def apply_published_invalidations():
+        apply_invalidations(subscription)
@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, exists, select
+from sqlalchemy.orm import Session, aliased
+
+from extensions import db
+from includes import included_comments_schema, load_posts, load_users
+from models import User, Post, PostBody, Comment, ArchivedComment, Change
+
+
+# Entity names in the feed. A delete cascades like the purge behind it: a
+# deleted post takes its comments, a deleted user their posts and comments
+# and every comment on their posts. A deleted comment's replies each get
+# their own delete entry.
+TRACKED = {User: 'user', Post: 'post', Comment: 'comment'}
+
+
+def _enabled():
+    return has_app_context() and current_app.config.get('CHANGES_ENABLED', True)
+
+
+def record_change(entity, entity_id, op, session=None):
+    """
+    Log a change that no ORM flush sees (bulk deletes); it is written with
+    the session's next commit.
+    """
+    if _enabled():
+        (session or db.session).add(Change(entity=entity, entity_id=entity_id, op=op))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    # new/dirty/deleted still hold the flushed objects here, ids included
+    if not _enabled():
+        return
+    pending = session.info.setdefault('changes', {})
+    for obj in session.new:
+        entity = TRACKED.get(type(obj))
+        if entity is not None:
+            pending[entity, obj.id] = 'upsert'
+    for obj in session.dirty:
+        if isinstance(obj, PostBody):
+            pending['post', obj.post_id] = 'upsert'
+            continue
+        entity = TRACKED.get(type(obj))
+        if entity is not None and session.is_modified(obj, include_collections=False):
+            # A tombstoned account is gone as far as clients are concerned
+            pending[entity, obj.id] = 'delete' if entity == 'user' and obj.deleted_at else 'upsert'
+    for obj in session.deleted:
+        entity = TRACKED.get(type(obj))
+        if entity is not None:
+            pending[entity, obj.id] = 'delete'
+
+
+@event.listens_for(Session, 'after_flush_postexec')
+def _write_changes(session, flush_context):
+    # Added now, the entries go out in the same commit as the rows they describe
+    pending = session.info.pop('changes', None)
+    if pending:
+        session.add_all(Change(entity=entity, entity_id=entity_id, op=op)
+                        for (entity, entity_id), op in pending.items())
+
+
+def _load_comments(comment_ids):
+    comments = {}
+    for model in (Comment, ArchivedComment):
+        missing = [comment_id for comment_id in comment_ids if comment_id not in comments]
+        if not missing:
+            break
+        for data in included_comments_schema.dump(model.query.filter(model.id.in_(missing))):
+            comments[data['id']] = data
+    return comments
+
+
+LOADERS = {'user': load_users, 'post': load_posts, 'comment': _load_comments}
+
+
+def changes_since(since, limit):
+    """
+    Return the changes after ``since`` in seq order, one per entity.
+
+    Only an entity's latest entry in the page is kept, with the entity's
+    current data (one batched lookup per type); entities that no longer
+    exist come back as deletes. ``next_since`` is the cursor for the next
+    call.
+    """
+    query = select(Change).where(Change.seq > since).order_by(Change.seq).limit(limit)
+    settle = current_app.config.get('CHANGES_SETTLE_SECONDS', 0)
+    if settle:
+        # Leave room for transactions that took an earlier seq but haven't committed yet
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=settle)
+        query = query.where(Change.created_at <= cutoff)
+    rows = db.session.scalars(query).all()
+
+    latest = {}
+    for row in rows:
+        latest.pop((row.entity, row.entity_id), None)
+        latest[row.entity, row.entity_id] = row
+    data = {}
+    for entity, loader in LOADERS.items():
+        ids = [entity_id for kind, entity_id in latest if kind == entity and latest[kind, entity_id].op == 'upsert']
+        if ids:
+            data.update(((entity, entity_id), item) for entity_id, item in loader(ids).items())
+
+    changes = []
+    for key, row in latest.items():
+        item = data.get(key)
+        changes.append({'seq': row.seq, 'entity': row.entity, 'id': row.entity_id,
+                        'op': 'upsert' if item is not None else 'delete', 'data': item})
+    return {
+        'changes': changes,
+        'next_since': rows[-1].seq if rows else since,
+        'has_more': len(rows) == limit,
+    }
+
+
+def compact_changes(chunk_size=None):
+    """
+    Delete every entry superseded by a newer one for the same entity.
+
+    A client resuming from any seq still sees the latest state of every
+    entity changed since, as that entry is never removed.
+    """
+    from purge import delete_in_chunks  # purge records its deletes through this module
+    newer = aliased(Change)
+    superseded = exists().where(newer.entity == Change.entity, newer.entity_id == Change.entity_id,
+                                newer.seq > Change.seq)
+    return delete_in_chunks(Change, superseded, key=Change.seq, chunk_size=chunk_size)
+
+
+def init_app(app):
+    """
+    Register the ``flask compact-changes`` command.
+    """
+    @app.cli.command('compact-changes')
+    def run_compaction():
+        """Drop change log entries superseded by newer ones."""
+        print(f'Removed {compact_changes()} superseded changes')
@@ -20,3 +20,138 @@ class Config:
         raise ValueError(f"Unsupported database type: {DATABASE_TYPE}")
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Set by gunicorn.conf.py: the app is loaded once in the master and forked,
+    # so background threads and sockets are only started in the workers
+    PRELOAD_APP = os.getenv('PRELOAD_APP', 'false').lower() == 'true'
+
+    # Archived comments go to a separate database when set (see archive.py)
+    ARCHIVE_DATABASE_URI = os.getenv('ARCHIVE_DATABASE_URI')
+    SQLALCHEMY_BINDS = {'archive': ARCHIVE_DATABASE_URI} if ARCHIVE_DATABASE_URI else {}
+
+    # Posts and their comments are spread over these databases when set,
+    # comma-separated (see sharding.py); ids are reserved ID_BLOCK_SIZE at a time
+    SHARD_DATABASE_URIS = [uri.strip() for uri in os.getenv('SHARD_DATABASE_URIS', '').split(',') if uri.strip()]
+    SQLALCHEMY_BINDS.update({f'shard{i}': uri for i, uri in enumerate(SHARD_DATABASE_URIS)})
+    ID_BLOCK_SIZE = int(os.getenv('ID_BLOCK_SIZE', '100'))
+
+    # Cache stampede protection (see caching.single_flight_cached)
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL')
+    CACHE_EARLY_REFRESH_BETA = float(os.getenv('CACHE_EARLY_REFRESH_BETA', '1.0'))
+    CACHE_LOCK_TIMEOUT = int(os.getenv('CACHE_LOCK_TIMEOUT', '5'))
+    CACHE_STALE_TIMEOUT = int(os.getenv('CACHE_STALE_TIMEOUT', '30'))
+
+    # Memory budget of the in-process response cache and the body size from
+    # which cached responses are stored gzipped (see bytecache.py)
+    CACHE_MAX_BYTES = int(os.getenv('CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+    CACHE_COMPRESS_MIN_BYTES = int(os.getenv('CACHE_COMPRESS_MIN_BYTES', '1024'))
+
+    # Cache warm-up (see warmup.py)
+    CACHE_WARMUP_ON_START = os.getenv('CACHE_WARMUP_ON_START', 'true').lower() == 'true'
+    CACHE_WARMUP_AFTER_WRITE = os.getenv('CACHE_WARMUP_AFTER_WRITE', 'true').lower() == 'true'
+    CACHE_WARMUP_LIST_PAGES = int(os.getenv('CACHE_WARMUP_LIST_PAGES', '5'))
+    CACHE_WARMUP_HOT_POSTS = int(os.getenv('CACHE_WARMUP_HOT_POSTS', '20'))
+    # Post ids whose request counts are kept to pick the hot set; past this the quieter half is dropped
+    CACHE_HOT_POSTS_TRACKED = int(os.getenv('CACHE_HOT_POSTS_TRACKED', '10000'))
+    CACHE_HOT_SET_FILE = os.getenv('CACHE_HOT_SET_FILE')
+
+    # Per-user token-bucket rate limiting (see limiter.py)
+    RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+    RATE_LIMIT_CAPACITY = int(os.getenv('RATE_LIMIT_CAPACITY', '100000'))
+    # Endpoint name -> limit string, overriding the limit declared on the route
+    RATE_LIMIT_ROUTES = {}
+    # User tier -> multiplier applied to every limit
+    RATE_LIMIT_TIERS = {'standard': 1, 'premium': 5}
+
+    # Adaptive admission control (see admission.py)
+    ADMISSION_ENABLED = os.getenv('ADMISSION_ENABLED', 'true').lower() == 'true'
+    ADMISSION_INITIAL_CONCURRENCY = int(os.getenv('ADMISSION_INITIAL_CONCURRENCY', '16'))
+    ADMISSION_MIN_CONCURRENCY = int(os.getenv('ADMISSION_MIN_CONCURRENCY', '2'))
+    ADMISSION_MAX_CONCURRENCY = int(os.getenv('ADMISSION_MAX_CONCURRENCY', '128'))
+    ADMISSION_TARGET_LATENCY_MS = {'read': 100, 'write': 250, 'auth': 500}
+    # A request that waited longer than this for DB connections backs its class off
+    ADMISSION_TARGET_POOL_WAIT_MS = int(os.getenv('ADMISSION_TARGET_POOL_WAIT_MS', '20'))
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '1'))
+
+    # Background jobs (see jobs.py). Set JOBS_WORKER_ENABLED=false to drain
+    # the queue with `flask worker` instead of in the web processes.
+    JOBS_WORKER_ENABLED = os.getenv('JOBS_WORKER_ENABLED', 'true').lower() == 'true'
+    JOBS_WORKER_THREADS = int(os.getenv('JOBS_WORKER_THREADS', '4'))
+    JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', '1.0'))
+    JOBS_BATCH_SIZE = int(os.getenv('JOBS_BATCH_SIZE', '100'))
+    JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', '5'))
+    JOBS_LEASE_TIMEOUT = int(os.getenv('JOBS_LEASE_TIMEOUT', '300'))
+
+    # Set-based deletes (see purge.py)
+    PURGE_CHUNK_SIZE = int(os.getenv('PURGE_CHUNK_SIZE', '1000'))
+    USER_PURGE_SYNC_LIMIT = int(os.getenv('USER_PURGE_SYNC_LIMIT', '5000'))
+
+    # Opt-in group commit of create_post/create_comment inserts (see group_commit.py)
+    GROUP_COMMIT_ENABLED = os.getenv('GROUP_COMMIT_ENABLED', 'false').lower() == 'true'
+    GROUP_COMMIT_MAX_DELAY_MS = float(os.getenv('GROUP_COMMIT_MAX_DELAY_MS', '5'))
+    GROUP_COMMIT_MAX_BATCH = int(os.getenv('GROUP_COMMIT_MAX_BATCH', '100'))
+    GROUP_COMMIT_TIMEOUT = float(os.getenv('GROUP_COMMIT_TIMEOUT', '10'))
+
+    # Live comment streams (see pubsub.py)
+    SSE_KEEPALIVE_SECONDS = float(os.getenv('SSE_KEEPALIVE_SECONDS', '15'))
+    SSE_BACKLOG_LIMIT = int(os.getenv('SSE_BACKLOG_LIMIT', '500'))
+    # How far before the last event a resumed stream looks again for late commits
+    SSE_RESUME_OVERLAP_SECONDS = float(os.getenv('SSE_RESUME_OVERLAP_SECONDS', '5'))
+    PUBSUB_BRIDGE_ENABLED = os.getenv('PUBSUB_BRIDGE_ENABLED', 'true').lower() == 'true'
+    # Defaults to <instance>/pubsub; created (or reset) to mode 0700
+    PUBSUB_SOCKET_DIR = os.getenv('PUBSUB_SOCKET_DIR')
+
+    # Default depth limit of comment thread responses
+    THREAD_MAX_DEPTH = int(os.getenv('THREAD_MAX_DEPTH', '5'))
+
+    # Maximum number of ids accepted by POST /posts/mget
+    MGET_MAX_IDS = int(os.getenv('MGET_MAX_IDS', '100'))
+
+    # POST /batch: sub-requests per batch and threads running their reads concurrently (see batch.py)
+    BATCH_MAX_REQUESTS = int(os.getenv('BATCH_MAX_REQUESTS', '20'))
+    BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', '8'))
+
+    # Side-loaded ?include= relations: comments per document and how long users stay cached (see includes.py)
+    INCLUDE_MAX_COMMENTS = int(os.getenv('INCLUDE_MAX_COMMENTS', '100'))
+    INCLUDE_CACHE_TIMEOUT = int(os.getenv('INCLUDE_CACHE_TIMEOUT', '300'))
+
+    # Trending posts: sliding window, merge period across workers and list size (see trending.py)
+    TRENDING_ENABLED = os.getenv('TRENDING_ENABLED', 'true').lower() == 'true'
+    TRENDING_WINDOW_MINUTES = int(os.getenv('TRENDING_WINDOW_MINUTES', '60'))
+    TRENDING_MERGE_INTERVAL = float(os.getenv('TRENDING_MERGE_INTERVAL', '10'))
+    TRENDING_COMMENT_WEIGHT = int(os.getenv('TRENDING_COMMENT_WEIGHT', '5'))
+    TRENDING_TOP_K = int(os.getenv('TRENDING_TOP_K', '50'))
+
+    # Change feed for client sync (see changes.py). With concurrent writers (PostgreSQL, MySQL)
+    # set CHANGES_SETTLE_SECONDS to a few seconds so a seq that commits late isn't skipped
+    CHANGES_ENABLED = os.getenv('CHANGES_ENABLED', 'true').lower() == 'true'
+    CHANGES_MAX_LIMIT = int(os.getenv('CHANGES_MAX_LIMIT', '1000'))
+    CHANGES_SETTLE_SECONDS = float(os.getenv('CHANGES_SETTLE_SECONDS', '0'))
+
+    # Title autocomplete (see suggest.py): results per lookup, indexed key length and full rebuild period
+    SUGGEST_ENABLED = os.getenv('SUGGEST_ENABLED', 'true').lower() == 'true'
+    SUGGEST_MAX_RESULTS = int(os.getenv('SUGGEST_MAX_RESULTS', '20'))
+    SUGGEST_MAX_KEY_LENGTH = int(os.getenv('SUGGEST_MAX_KEY_LENGTH', '40'))
+    SUGGEST_REBUILD_INTERVAL = float(os.getenv('SUGGEST_REBUILD_INTERVAL', '600'))
+
+    # Memory-mapped post snapshot for anonymous reads (see snapshot.py): how old it may be when served,
+    # how often a worker rebuilds it (0 leaves that to `flask build-snapshot`) and how often workers check for a new one
+    SNAPSHOT_ENABLED = os.getenv('SNAPSHOT_ENABLED', 'false').lower() == 'true'
+    SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH')
+    SNAPSHOT_MAX_AGE = float(os.getenv('SNAPSHOT_MAX_AGE', '300'))
+    SNAPSHOT_BUILD_INTERVAL = float(os.getenv('SNAPSHOT_BUILD_INTERVAL', '60'))
+    SNAPSHOT_CHECK_INTERVAL = float(os.getenv('SNAPSHOT_CHECK_INTERVAL', '1'))
+
+    # Hot/cold comment archival: posts without comments for this many days move to the archive
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '180'))
+    ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', '1000'))
+
+    # On-demand profiling: X-Profile: 1 with X-Profile-Key, or a sampled share of requests (see profiling.py)
+    PROFILING_KEY = os.getenv('PROFILING_KEY')
+    PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+    PROFILING_DIR = os.getenv('PROFILING_DIR')
+    PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES', '100'))
+
+    # Traffic capture for replay load tests (see traffic.py and replay.py)
+    TRAFFIC_CAPTURE_FILE = os.getenv('TRAFFIC_CAPTURE_FILE')
+    TRAFFIC_CAPTURE_MAX_BODY = int(os.getenv('TRAFFIC_CAPTURE_MAX_BODY', str(64 * 1024)))
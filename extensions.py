@@ -1,4 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 
+import sharding
+from admission import TimedQueuePool
 
-db = SQLAlchemy()
+
+# Timed checkouts feed connection waits into admission control; Flask-SQLAlchemy
+# still picks StaticPool for in-memory SQLite
+db = SQLAlchemy(session_options=sharding.session_options(), engine_options={'poolclass': TimedQueuePool})
@@ -0,0 +1,155 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import abort, current_app, jsonify
+from sqlalchemy.exc import SQLAlchemyError
+
+from extensions import db
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Unit:
+    """
+    The new rows of one request, committed (or failed) together.
+    """
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.future = Future()
+
+
+class GroupCommitWriter:
+    """
+    Single writer thread that commits the inserts of many requests in one
+    transaction, trading a few milliseconds of latency for one fsync per
+    batch instead of one per request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_delay = app.config.get('GROUP_COMMIT_MAX_DELAY_MS', 5) / 1000.0
+        self.max_batch = app.config.get('GROUP_COMMIT_MAX_BATCH', 100)
+        self.batches = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, objects):
+        """
+        Queue new objects for the next batch. The returned future resolves
+        once they are durable, with the objects detached but still loaded.
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='group-commit', daemon=True)
+                self._thread.start()
+        unit = _Unit(objects)
+        self._queue.put(unit)
+        return unit.future
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0].objects)
+            deadline = time.monotonic() + self.max_delay
+            while rows < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    unit = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(unit)
+                rows += len(unit.objects)
+            with self.app.app_context():
+                self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            self._commit(batch)
+        except SQLAlchemyError:
+            # One bad row must not fail the whole batch: retry unit by unit
+            for unit in batch:
+                try:
+                    self._commit([unit])
+                except SQLAlchemyError as e:
+                    unit.future.set_exception(e)
+        except Exception as e:
+            # Never leave a request waiting on a batch that blew up
+            logger.exception("Group commit of %d units failed", len(batch))
+            for unit in batch:
+                if not unit.future.done():
+                    unit.future.set_exception(e)
+
+    def _commit(self, batch):
+        # A private session that keeps attributes loaded after commit, so the
+        # requests can serialize their rows once they are handed back; made
+        # like db.session so rows are routed to their bind (or shard)
+        with db.session.session_factory(expire_on_commit=False) as session:
+            try:
+                for unit in batch:
+                    session.add_all(unit.objects)
+                session.commit()
+            except SQLAlchemyError as e:
+                session.rollback()
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    return
+                raise
+            session.expunge_all()
+        self.batches += 1
+        for unit in batch:
+            unit.future.set_result(unit.objects)
+
+
+def _commit_pending(app):
+    response = jsonify({"error": "The write is taking longer than expected and may still be applied; "
+                                 "check whether it was before retrying"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config.get('ADMISSION_RETRY_AFTER', 1))
+    return response
+
+
+def commit():
+    """
+    Commit the request's session, through the group-commit writer when it is
+    enabled and the session only holds new rows.
+
+    If the writer doesn't commit them within ``GROUP_COMMIT_TIMEOUT``
+    seconds, the request ends with a 503 saying the write may still be
+    applied.
+    """
+    app = current_app._get_current_object()
+    session = db.session
+    if not app.config.get('GROUP_COMMIT_ENABLED') or session.dirty or session.deleted:
+        session.commit()
+        return
+
+    writer = app.extensions.get('group_commit')
+    if writer is None:
+        writer = app.extensions.setdefault('group_commit', GroupCommitWriter(app))
+
+    objects = list(session.new)
+    for obj in objects:
+        if obj in session:
+            session.expunge(obj)
+    jobs_enqueued = session.info.pop('jobs_enqueued', False)
+    session.commit()
+
+    try:
+        writer.submit(objects).result(timeout=app.config.get('GROUP_COMMIT_TIMEOUT', 10))
+    except TimeoutError:
+        # The batch is still queued or committing, so this is not a failure:
+        # retrying blindly could write the rows twice
+        abort(_commit_pending(app))
+    # Re-attach the committed rows so serializing them can lazy load relations
+    session.add_all(objects)
+
+    if jobs_enqueued and 'jobs' in app.extensions:
+        app.extensions['jobs'].notify()
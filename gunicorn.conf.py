@@ -0,0 +1,60 @@
+"""
+Production gunicorn settings: ``gunicorn -c gunicorn.conf.py``.
+
+The app is imported once in the master and forked, so workers share its
+code (and the warmed cache) copy-on-write and a worker restart takes
+milliseconds. ``post_fork`` gives each worker its own connections, locks,
+sockets and threads.
+"""
+import gc
+import os
+
+# Read by config.py when app.py is imported below
+os.environ.setdefault('PRELOAD_APP', 'true')
+
+
+def cpu_count():
+    # Respect CPU affinity/cgroup pinning where the platform exposes it
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+wsgi_app = 'app:app'
+preload_app = True
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+
+# gthread serves GUNICORN_THREADS requests at once per worker, but an open SSE
+# stream (GET /posts/<id>/comments/stream) holds one of those threads until the
+# client leaves. Route the stream paths to a second pool started with
+# GUNICORN_WORKER_CLASS=gevent, where an idle stream costs a greenlet.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('GUNICORN_WORKERS', 2 * cpu_count() + 1))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+
+if worker_class == 'gevent':
+    # Patch before app.py is preloaded, so the locks, threads and sockets it
+    # creates at import are cooperative too
+    from gevent import monkey
+    monkey.patch_all()
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG', '-')
+errorlog = os.getenv('GUNICORN_ERRORLOG', '-')
+
+
+def when_ready(server):
+    # Move everything the master imported out of the collector's reach, so
+    # collections in the workers don't write to (and un-share) those pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import app, after_fork
+    after_fork(app)
@@ -0,0 +1,156 @@
+import gzip
+import json
+from functools import wraps
+
+from flask import current_app, jsonify, make_response, request
+from marshmallow import ValidationError
+from sqlalchemy.orm import load_only, selectinload
+
+from caching import cache, cache_posts, get_cached_posts, user_cache_key
+from models import User, Post, Comment, ArchivedComment
+from schemas import UserSchema, PostSchema, CommentSchema
+
+
+# Public fields of side-loaded users (never the email)
+AUTHOR_FIELDS = ('id', 'name', 'username')
+author_schema = UserSchema(many=True, only=AUTHOR_FIELDS)
+post_schema = PostSchema()
+# Side-loaded comments point at their post by post_id only
+included_comments_schema = CommentSchema(many=True, exclude=('post',))
+
+
+def parse_include(allowed):
+    """
+    Read the ``include`` query parameter and validate it against the
+    relations the endpoint can side-load.
+
+    Returns a tuple of relation names (empty when nothing was asked for).
+    """
+    raw = request.args.get('include')
+    if not raw:
+        return ()
+    requested = tuple(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    unknown = [name for name in requested if name not in allowed]
+    if unknown or not requested:
+        raise ValidationError({'include': [f"Unknown relation(s): {', '.join(unknown) or raw}"]})
+    return requested
+
+
+def load_users(user_ids):
+    """
+    Return user id -> public fields, from the per-user cache and one
+    IN (...) query for the misses. Deleted users are left out.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    entries = cache.get_many(*[user_cache_key(user_id) for user_id in user_ids])
+    found = {user_id: entry for user_id, entry in zip(user_ids, entries) if entry is not None}
+    misses = [user_id for user_id in user_ids if user_id not in found]
+    if misses:
+        users = User.query.options(load_only(*[getattr(User, name) for name in AUTHOR_FIELDS])) \
+            .filter(User.id.in_(misses), User.deleted_at.is_(None))
+        loaded = author_schema.dump(users)
+        cache.set_many({user_cache_key(data['id']): data for data in loaded},
+                       timeout=current_app.config.get('INCLUDE_CACHE_TIMEOUT', 300))
+        found.update((data['id'], data) for data in loaded)
+    return found
+
+
+def load_posts(post_ids):
+    """
+    Return post id -> get_post payload, from the post cache and one
+    IN (...) query for the misses.
+    """
+    post_ids = list(dict.fromkeys(post_ids))
+    found = get_cached_posts(post_ids) if post_ids else {}
+    misses = [post_id for post_id in post_ids if post_id not in found]
+    if misses:
+        loaded = post_schema.dump(Post.query.options(selectinload(Post.body)).filter(Post.id.in_(misses)), many=True)
+        cache_posts(loaded)
+        found.update((data['id'], data) for data in loaded)
+    return found
+
+
+def load_comments(post_ids):
+    """
+    Return the first ``INCLUDE_MAX_COMMENTS`` comments of the given posts in
+    thread order: one query on the hot table, and one on the archive for
+    posts that had none there.
+    """
+    post_ids = list(dict.fromkeys(post_ids))
+    limit = current_app.config.get('INCLUDE_MAX_COMMENTS', 100)
+    comments = []
+    for model in (Comment, ArchivedComment):
+        if not post_ids:
+            break
+        rows = model.query.filter(model.post_id.in_(post_ids)).order_by(model.post_id, model.path).limit(limit).all()
+        comments += included_comments_schema.dump(rows)
+        seen = {row.post_id for row in rows}
+        post_ids = [post_id for post_id in post_ids if post_id not in seen]
+    return comments
+
+
+def _primary_items(data):
+    items = data if isinstance(data, list) else data.get('items', [data])
+    # Comment trees nest replies under their parents
+    stack = list(reversed(items))
+    while stack:
+        item = stack.pop()
+        yield item
+        stack.extend(reversed(item.get('replies', ())))
+
+
+def build_included(items, include):
+    """
+    Side-load the ``include`` relations of serialized posts or comments,
+    one batched lookup per relation, each entity listed once.
+    """
+    items = list(items)
+    included = {}
+    comments = []
+    if 'comments' in include:
+        comments = included['comments'] = load_comments(item['id'] for item in items)
+    if 'post' in include:
+        posts = load_posts(item['post_id'] for item in items if item.get('post_id') is not None)
+        included['posts'] = [posts[post_id] for post_id in sorted(posts)]
+    if 'author' in include:
+        # Authors of everything in the document, included comments too
+        users = load_users(item['user_id'] for item in items + comments if item.get('user_id') is not None)
+        included['users'] = [users[user_id] for user_id in sorted(users)]
+    return included
+
+
+def with_included(*relations):
+    """
+    Let a view side-load related entities with ``?include=``.
+
+    Goes above the view's cache decorator: the primary data is served (and
+    cached) as usual and the included entities come from their own caches.
+    A bare object or list is wrapped as ``{"data": ..., "included": ...}``;
+    paginated responses get an ``included`` key next to ``items``.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            try:
+                include = parse_include(relations)
+            except ValidationError as err:
+                return err.messages, 400
+            response = make_response(f(*args, **kwargs))
+            if not include or response.status_code != 200:
+                return response
+            data = _response_json(response)
+            included = build_included(_primary_items(data), include)
+            if isinstance(data, dict) and 'items' in data:
+                return jsonify(dict(data, included=included))
+            return jsonify({'data': data, 'included': included})
+        return decorated_function
+    return decorator
+
+
+def _response_json(response):
+    # Cached responses may come back gzipped for clients that accept it
+    if response.headers.get('Content-Encoding') == 'gzip':
+        return json.loads(gzip.decompress(response.get_data()))
+    return response.get_json()
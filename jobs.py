@@ -0,0 +1,219 @@
+import logging
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app, has_app_context
+from sqlalchemy import and_, delete, event, or_, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from extensions import db
+from models import Job
+
+
+logger = logging.getLogger(__name__)
+
+# Job kind -> handler called with the list of payloads of one batch
+_handlers = {}
+
+
+def job_handler(kind):
+    """
+    Register a function as the handler for a kind of background job.
+
+    Handlers receive every payload of a batch at once, so they can
+    coalesce the work (one cache warm-up for twenty writes, and so on).
+    """
+    def decorator(f):
+        _handlers[kind] = f
+        return f
+    return decorator
+
+
+def enqueue(kind, **payload):
+    """
+    Queue a job in the current database transaction (transactional outbox).
+
+    The job row is only written if the request's commit succeeds, and the
+    worker is woken once it has.
+    """
+    db.session.add(Job(kind=kind, payload=payload))
+    db.session.info['jobs_enqueued'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_worker(session):
+    if session.info.pop('jobs_enqueued', False) and has_app_context():
+        worker = current_app.extensions.get('jobs')
+        if worker is not None:
+            worker.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_enqueued(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def claim_jobs(limit, lease_timeout):
+    """
+    Atomically claim up to ``limit`` runnable jobs for this caller.
+
+    Jobs whose lease ran out (their worker died mid-batch) are claimed again.
+    """
+    now = _utcnow()
+    runnable = or_(
+        and_(Job.status == 'pending', Job.run_after <= now),
+        and_(Job.status == 'running', Job.claimed_at < now - timedelta(seconds=lease_timeout))
+    )
+    ids = db.session.scalars(select(Job.id).where(runnable).order_by(Job.id).limit(limit)).all()
+    if not ids:
+        return []
+
+    token = uuid.uuid4().hex
+    db.session.execute(
+        update(Job).where(Job.id.in_(ids), runnable)
+        .values(status='running', claimed_by=token, claimed_at=now)
+    )
+    db.session.commit()
+    return db.session.scalars(select(Job).where(Job.claimed_by == token).order_by(Job.id)).all()
+
+
+def _run_batch(app, kind, job_ids, payloads):
+    """
+    Run one batch of same-kind jobs and record the outcome.
+    """
+    with app.app_context():
+        try:
+            handler = _handlers[kind]
+            handler(payloads)
+        except Exception as e:
+            logger.exception("Background job batch %s failed", kind)
+            db.session.rollback()
+            _retry_or_fail(app, job_ids, repr(e))
+        else:
+            db.session.execute(delete(Job).where(Job.id.in_(job_ids)))
+            db.session.commit()
+
+
+def _retry_or_fail(app, job_ids, error):
+    max_attempts = app.config.get('JOBS_MAX_ATTEMPTS', 5)
+    now = _utcnow()
+    for job in db.session.scalars(select(Job).where(Job.id.in_(job_ids))):
+        job.attempts += 1
+        job.last_error = error
+        job.claimed_by = None
+        if job.attempts >= max_attempts:
+            job.status = 'failed'
+        else:
+            # Exponential backoff: 2, 4, 8... seconds
+            job.status = 'pending'
+            job.run_after = now + timedelta(seconds=2 ** job.attempts)
+    db.session.commit()
+
+
+def run_pending_jobs(app, executor=None):
+    """
+    Claim runnable jobs, group them by kind and run each group as a batch.
+
+    Batches run on ``executor`` if one is given, inline otherwise. Returns
+    the number of jobs claimed.
+    """
+    with app.app_context():
+        try:
+            jobs = claim_jobs(app.config.get('JOBS_BATCH_SIZE', 100),
+                              app.config.get('JOBS_LEASE_TIMEOUT', 300))
+        except SQLAlchemyError as e:
+            logger.warning("Could not claim background jobs: %s", e)
+            db.session.rollback()
+            return 0
+        batches = defaultdict(list)
+        for job in jobs:
+            batches[job.kind].append(job)
+        work = [(kind, [job.id for job in group], [job.payload for job in group])
+                for kind, group in batches.items()]
+
+    if executor is None:
+        for kind, job_ids, payloads in work:
+            _run_batch(app, kind, job_ids, payloads)
+    else:
+        wait([executor.submit(_run_batch, app, *batch) for batch in work])
+    return len(jobs)
+
+
+class JobWorker:
+    """
+    Drains the job table on a thread pool inside the current process.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self.run, name='job-worker', daemon=True)
+                self._thread.start()
+
+    def notify(self):
+        if self.app.config.get('JOBS_WORKER_ENABLED', True):
+            self.start()
+            self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run(self):
+        """
+        Poll for jobs until stopped, sleeping until woken when the queue is empty.
+        """
+        poll_interval = self.app.config.get('JOBS_POLL_INTERVAL', 1.0)
+        with ThreadPoolExecutor(max_workers=self.app.config.get('JOBS_WORKER_THREADS', 4)) as executor:
+            while not self._stop.is_set():
+                if not run_pending_jobs(self.app, executor):
+                    self._wake.wait(poll_interval)
+                    self._wake.clear()
+
+
+def init_app(app):
+    """
+    Attach a job worker to the app and register the ``flask worker`` command.
+    """
+    worker = JobWorker(app)
+    app.extensions['jobs'] = worker
+
+    @app.cli.command('worker')
+    def run_worker():
+        """Drain the background job queue in the foreground."""
+        worker.run()
+
+    # A preloaded master never runs jobs; each worker resumes them after fork
+    if not app.config.get('PRELOAD_APP', False):
+        resume_pending_jobs(app)
+
+
+def resume_pending_jobs(app):
+    """
+    Start the worker if a previous process left jobs behind.
+    """
+    if not app.config.get('JOBS_WORKER_ENABLED', True):
+        return
+    with app.app_context():
+        try:
+            leftover = db.session.scalar(select(Job.id).where(Job.status != 'failed').limit(1))
+        except SQLAlchemyError:
+            leftover = None
+    if leftover is not None:
+        app.extensions['jobs'].start()
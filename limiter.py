@@ -1,8 +1,127 @@
-from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
-
-
-limiter = Limiter(
-    key_func=get_remote_address,
-    storage_uri="memory://"
-)
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, jsonify, request
+
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+LIMIT_PATTERN = re.compile(r'^\s*(\d+)\s*(?:per|/)\s*(second|minute|hour|day)s?\s*$')
+
+
+def parse_limit(limit_value):
+    """
+    Parse "10 per minute" or "10/minute" into (amount, period in seconds).
+    """
+    match = LIMIT_PATTERN.match(limit_value)
+    if not match:
+        raise ValueError(f"Invalid rate limit: {limit_value!r}")
+    return int(match.group(1)), PERIODS[match.group(2)]
+
+
+def get_remote_address():
+    return request.remote_addr
+
+
+def _current_user():
+    """
+    The user of the request's bearer token, if it carries a valid one, so
+    routes that don't require a token still throttle per user.
+    """
+    # Set by flask_httpauth's login_required, which wraps this decorator
+    if 'flask_httpauth_user' in g:
+        return g.flask_httpauth_user
+    from auth import token_auth  # auth imports the app, which imports this module
+    auth = token_auth.get_auth()
+    if auth is None:
+        return None
+    # An invalid token falls back to the client address, as if there were none
+    return token_auth.authenticate(auth, None) or None
+
+
+class TokenBucketTable:
+    """
+    Token buckets in a fixed-capacity LRU table.
+
+    Each key costs two floats (tokens left, time of last update). When the
+    table is full the least recently used key is evicted, which simply gives
+    that client a full bucket again.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now):
+        """
+        Take one token. Returns 0 if allowed, else the seconds until a token is available.
+        """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = burst
+                if len(self._buckets) >= self.capacity:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                self._buckets.move_to_end(key)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+
+class RateLimiter:
+    """
+    Per-user token-bucket rate limiting.
+
+    Requests are keyed on the user of a valid bearer token, whether or not
+    the route requires one, and on the route's ``key_func`` (the client IP)
+    otherwise. Limits
+    can be overridden per endpoint with ``RATE_LIMIT_ROUTES`` and scaled per
+    user tier with ``RATE_LIMIT_TIERS``.
+    """
+
+    def init_app(self, app):
+        if app.config.get('RATE_LIMIT_ENABLED', True):
+            app.extensions['rate_limiter'] = TokenBucketTable(app.config.get('RATE_LIMIT_CAPACITY', 100000))
+
+    def limit(self, limit_value, key_func=None):
+        default_limit = parse_limit(limit_value)
+        key_func = key_func or get_remote_address
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                table = current_app.extensions.get('rate_limiter')
+                # Cache warm-up renders pages itself and has no client to throttle
+                if table is None or request.environ.get('blog.warmup'):
+                    return f(*args, **kwargs)
+
+                endpoint = request.endpoint
+                override = current_app.config.get('RATE_LIMIT_ROUTES', {}).get(endpoint)
+                amount, period = parse_limit(override) if override else default_limit
+
+                user = _current_user()
+                if user:
+                    identity = f'user:{user.id}'
+                    tier = getattr(user, 'tier', None) or 'standard'
+                    amount *= current_app.config.get('RATE_LIMIT_TIERS', {}).get(tier, 1)
+                else:
+                    identity = f'ip:{key_func()}'
+
+                retry_after = table.take((endpoint, identity), amount / period, amount, time.monotonic())
+                if retry_after:
+                    response = jsonify({"error": "Rate limit exceeded"})
+                    return response, 429, {'Retry-After': str(math.ceil(retry_after))}
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+
+limiter = RateLimiter()
@@ -0,0 +1,115 @@
+"""Move post content into post_bodies and precompute excerpts
+
+Revision ID: 5c1e0a7d9b23
+Revises:
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import zlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e0a7d9b23'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# As of this revision; see models.BODY_COMPRESSION_THRESHOLD and models.make_excerpt
+BODY_COMPRESSION_THRESHOLD = 1024
+EXCERPT_LENGTH = 200
+CHUNK_SIZE = 1000
+
+posts = sa.table(
+    'posts',
+    sa.column('id', sa.Integer),
+    sa.column('content', sa.String),
+    sa.column('excerpt', sa.String),
+)
+post_bodies = sa.table(
+    'post_bodies',
+    sa.column('post_id', sa.Integer),
+    sa.column('data', sa.LargeBinary),
+    sa.column('compressed', sa.Boolean),
+)
+
+
+def _excerpt(text):
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    cut = text[:EXCERPT_LENGTH - 1]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip() + '…'
+
+
+def _columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # Databases created by db.create_all() already have the new layout, and
+    # an app started on an old one has created the empty post_bodies table
+    bind = op.get_bind()
+    if 'post_bodies' not in sa.inspect(bind).get_table_names():
+        op.create_table(
+            'post_bodies',
+            sa.Column('post_id', sa.Integer(), sa.ForeignKey('posts.id'), primary_key=True),
+            sa.Column('data', sa.LargeBinary(), nullable=False),
+            sa.Column('compressed', sa.Boolean(), nullable=False),
+        )
+    columns = _columns('posts')
+    if 'excerpt' not in columns:
+        with op.batch_alter_table('posts') as batch_op:
+            batch_op.add_column(sa.Column('excerpt', sa.String(length=255), nullable=True))
+    if 'content' not in columns:
+        return
+
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(posts.c.id, posts.c.content)
+            .where(posts.c.id > last_id, posts.c.content.isnot(None))
+            .where(~sa.exists().where(post_bodies.c.post_id == posts.c.id))
+            .order_by(posts.c.id).limit(CHUNK_SIZE)
+        ).all()
+        if not rows:
+            break
+        bodies = []
+        for post_id, content in rows:
+            data = content.encode('utf-8')
+            compressed = len(data) >= BODY_COMPRESSION_THRESHOLD
+            bodies.append({'post_id': post_id, 'data': zlib.compress(data) if compressed else data,
+                           'compressed': compressed})
+            bind.execute(posts.update().where(posts.c.id == post_id).values(excerpt=_excerpt(content)))
+        bind.execute(post_bodies.insert(), bodies)
+        last_id = rows[-1].id
+
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('content')
+
+
+def downgrade():
+    bind = op.get_bind()
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.add_column(sa.Column('content', sa.String(length=255), nullable=True))
+
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(post_bodies.c.post_id, post_bodies.c.data, post_bodies.c.compressed)
+            .where(post_bodies.c.post_id > last_id)
+            .order_by(post_bodies.c.post_id).limit(CHUNK_SIZE)
+        ).all()
+        if not rows:
+            break
+        for post_id, data, compressed in rows:
+            text = (zlib.decompress(data) if compressed else data).decode('utf-8')
+            bind.execute(posts.update().where(posts.c.id == post_id).values(content=text))
+        last_id = rows[-1].post_id
+
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('excerpt')
+    op.drop_table('post_bodies')
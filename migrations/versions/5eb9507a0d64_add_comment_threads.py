@@ -0,0 +1,71 @@
+"""Add parent_id, path and depth to comments for threaded replies
+
+Revision ID: 5eb9507a0d64
+Revises: fdcd24007f47
+Create Date: 2026-10-19 17:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5eb9507a0d64'
+down_revision = 'fdcd24007f47'
+branch_labels = None
+depends_on = None
+
+CHUNK_SIZE = 1000
+
+comments = sa.table(
+    'comments',
+    sa.column('id', sa.Integer),
+    sa.column('parent_id', sa.Integer),
+    sa.column('path', sa.String),
+    sa.column('depth', sa.Integer),
+)
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {column['name'] for column in inspector.get_columns('comments')}
+    indexes = {index['name'] for index in inspector.get_indexes('comments')}
+    with op.batch_alter_table('comments') as batch_op:
+        if 'parent_id' not in columns:
+            batch_op.add_column(sa.Column('parent_id', sa.Integer(), nullable=True))
+            batch_op.create_foreign_key('fk_comments_parent_id_comments', 'comments',
+                                        ['parent_id'], ['id'], ondelete='SET NULL')
+        if 'path' not in columns:
+            batch_op.add_column(sa.Column('path', sa.String(length=255), nullable=True))
+        if 'depth' not in columns:
+            batch_op.add_column(sa.Column('depth', sa.Integer(), nullable=False, server_default='0'))
+        if 'ix_comments_parent_id' not in indexes:
+            batch_op.create_index('ix_comments_parent_id', ['parent_id'])
+        if 'ix_comments_path' not in indexes:
+            batch_op.create_index('ix_comments_path', ['path'])
+        if 'ix_comments_post_path' not in indexes:
+            batch_op.create_index('ix_comments_post_path', ['post_id', 'path'])
+
+    # Every comment from before threads is top-level: its path is its own id
+    bind = op.get_bind()
+    while True:
+        ids = bind.execute(
+            sa.select(comments.c.id).where(comments.c.path.is_(None), comments.c.parent_id.is_(None))
+            .order_by(comments.c.id).limit(CHUNK_SIZE)
+        ).scalars().all()
+        if not ids:
+            break
+        for comment_id in ids:
+            bind.execute(comments.update().where(comments.c.id == comment_id)
+                         .values(path=f'{comment_id:010d}/', depth=0))
+
+
+def downgrade():
+    with op.batch_alter_table('comments') as batch_op:
+        batch_op.drop_index('ix_comments_post_path')
+        batch_op.drop_index('ix_comments_path')
+        batch_op.drop_index('ix_comments_parent_id')
+        batch_op.drop_constraint('fk_comments_parent_id_comments', type_='foreignkey')
+        batch_op.drop_column('depth')
+        batch_op.drop_column('path')
+        batch_op.drop_column('parent_id')
@@ -0,0 +1,83 @@
+"""Add the job queue, trending snapshots, id blocks and change feed tables
+
+Revision ID: 941f4b3cc43b
+Revises: ba97ad092adf
+Create Date: 2026-10-19 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '941f4b3cc43b'
+down_revision = 'ba97ad092adf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+
+    if 'jobs' not in tables:
+        op.create_table(
+            'jobs',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('kind', sa.String(length=64), nullable=False),
+            sa.Column('payload', sa.JSON(), nullable=False),
+            sa.Column('status', sa.String(length=16), nullable=False),
+            sa.Column('attempts', sa.Integer(), nullable=False),
+            sa.Column('run_after', sa.DateTime(), nullable=False),
+            sa.Column('claimed_by', sa.String(length=32), nullable=True),
+            sa.Column('claimed_at', sa.DateTime(), nullable=True),
+            sa.Column('last_error', sa.Text(), nullable=True),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_jobs_kind', 'jobs', ['kind'])
+        op.create_index('ix_jobs_status', 'jobs', ['status'])
+        op.create_index('ix_jobs_claimed_by', 'jobs', ['claimed_by'])
+
+    if 'trending_snapshots' not in tables:
+        op.create_table(
+            'trending_snapshots',
+            sa.Column('worker', sa.String(length=64), nullable=False),
+            sa.Column('post_id', sa.Integer(), nullable=False),
+            sa.Column('views', sa.Integer(), nullable=False),
+            sa.Column('comments', sa.Integer(), nullable=False),
+            sa.Column('updated_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('worker', 'post_id'),
+        )
+        op.create_index('ix_trending_snapshots_updated_at', 'trending_snapshots', ['updated_at'])
+
+    if 'id_blocks' not in tables:
+        op.create_table(
+            'id_blocks',
+            sa.Column('name', sa.String(length=64), nullable=False),
+            sa.Column('next_value', sa.BigInteger(), nullable=False),
+            sa.PrimaryKeyConstraint('name'),
+        )
+
+    if 'changes' not in tables:
+        op.create_table(
+            'changes',
+            sa.Column('seq', sa.Integer(), nullable=False),
+            sa.Column('entity', sa.String(length=16), nullable=False),
+            sa.Column('entity_id', sa.Integer(), nullable=False),
+            sa.Column('op', sa.String(length=8), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=False),
+            sa.PrimaryKeyConstraint('seq'),
+            sqlite_autoincrement=True,
+        )
+        op.create_index('ix_changes_entity', 'changes', ['entity', 'entity_id', 'seq'])
+
+
+def downgrade():
+    op.drop_index('ix_changes_entity', table_name='changes')
+    op.drop_table('changes')
+    op.drop_table('id_blocks')
+    op.drop_index('ix_trending_snapshots_updated_at', table_name='trending_snapshots')
+    op.drop_table('trending_snapshots')
+    op.drop_index('ix_jobs_claimed_by', table_name='jobs')
+    op.drop_index('ix_jobs_status', table_name='jobs')
+    op.drop_index('ix_jobs_kind', table_name='jobs')
+    op.drop_table('jobs')
@@ -0,0 +1,71 @@
+"""Add the comment archive and posts.comments_archived
+
+Revision ID: ba97ad092adf
+Revises: f01dbb9a5579
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ba97ad092adf'
+down_revision = 'f01dbb9a5579'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = inspector.get_table_names()
+
+    if 'comments_archived' not in {column['name'] for column in inspector.get_columns('posts')}:
+        with op.batch_alter_table('posts') as batch_op:
+            batch_op.add_column(sa.Column('comments_archived', sa.Boolean(), nullable=False, server_default=sa.false()))
+
+    # With ARCHIVE_DATABASE_URI the archive lives in that database, where create_all makes it
+    if 'comments_archive' not in tables and not os.getenv('ARCHIVE_DATABASE_URI'):
+        op.create_table(
+            'comments_archive',
+            sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+            sa.Column('content', sa.Text(), nullable=False),
+            sa.Column('date_posted', sa.DateTime(), nullable=False),
+            sa.Column('user_id', sa.Integer(), nullable=False),
+            sa.Column('post_id', sa.Integer(), nullable=False),
+            sa.Column('parent_id', sa.Integer(), nullable=True),
+            sa.Column('path', sa.String(length=255), nullable=True),
+            sa.Column('depth', sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('path'),
+        )
+        op.create_index('ix_comments_archive_user_id', 'comments_archive', ['user_id'])
+        op.create_index('ix_comments_archive_post_path', 'comments_archive', ['post_id', 'path'])
+
+    if bind.dialect.name != 'sqlite':
+        return  # other databases never hand out a sequence value twice
+    table_sql = bind.execute(sa.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'comments'")).scalar()
+    if 'AUTOINCREMENT' in table_sql.upper():
+        return
+    # Without AUTOINCREMENT SQLite reuses the ids of deleted rows, and
+    # archived comments keep their ids
+    with op.batch_alter_table('comments', recreate='always', table_kwargs={'sqlite_autoincrement': True}):
+        pass
+    last_ids = ['SELECT MAX(id) FROM comments']
+    if 'comments_archive' in sa.inspect(bind).get_table_names():
+        last_ids.append('SELECT MAX(id) FROM comments_archive')
+    last_id = max((bind.execute(sa.text(query)).scalar() or 0) for query in last_ids)
+    bind.execute(sa.text("DELETE FROM sqlite_sequence WHERE name = 'comments'"))
+    bind.execute(sa.text("INSERT INTO sqlite_sequence (name, seq) VALUES ('comments', :seq)"), {'seq': last_id})
+
+
+def downgrade():
+    if not os.getenv('ARCHIVE_DATABASE_URI'):
+        op.drop_index('ix_comments_archive_post_path', table_name='comments_archive')
+        op.drop_index('ix_comments_archive_user_id', table_name='comments_archive')
+        op.drop_table('comments_archive')
+    with op.batch_alter_table('posts') as batch_op:
+        batch_op.drop_column('comments_archived')
@@ -0,0 +1,32 @@
+"""Add users.tier for per-tier rate limits
+
+Revision ID: f01dbb9a5579
+Revises: 5eb9507a0d64
+Create Date: 2026-10-19 17:50:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f01dbb9a5579'
+down_revision = '5eb9507a0d64'
+branch_labels = None
+depends_on = None
+
+
+def _columns(table):
+    return {column['name'] for column in sa.inspect(op.get_bind()).get_columns(table)}
+
+
+def upgrade():
+    # Existing accounts start on the standard tier
+    if 'tier' not in _columns('users'):
+        with op.batch_alter_table('users') as batch_op:
+            batch_op.add_column(sa.Column('tier', sa.String(length=32), nullable=False, server_default='standard'))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_column('tier')
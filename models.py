@@ -1,7 +1,30 @@
+import os
+import zlib
 from datetime import datetime, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
 from extensions import db
+from sqlalchemy import event, select, update
 from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.orm.attributes import set_committed_value
+
+# Post bodies at least this many bytes long are stored zlib-compressed
+BODY_COMPRESSION_THRESHOLD = 1024
+# Length of the precomputed excerpt returned by list endpoints
+EXCERPT_LENGTH = 200
+# Deepest reply level a comment path (11 characters per level) can hold
+MAX_COMMENT_DEPTH = 20
+
+
+def make_excerpt(text, length=EXCERPT_LENGTH):
+    """
+    Truncate text to at most ``length`` characters, on a word boundary if possible.
+    """
+    if len(text) <= length:
+        return text
+    cut = text[:length - 1]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip() + '…'
 
 class User(db.Model):
     __tablename__ = 'users'  # Table name in the database
@@ -11,6 +34,10 @@ class User(db.Model):
     username: Mapped[str] = mapped_column(db.String(255), unique=True, nullable=False)
     email: Mapped[str] = mapped_column(db.String(255), unique=True, nullable=False)
     password: Mapped[str] = mapped_column(db.String(255), nullable=False)
+    # Rate-limit tier, see RATE_LIMIT_TIERS
+    tier: Mapped[str] = mapped_column(db.String(32), nullable=False, default='standard', server_default='standard')
+    # Set when a large account is awaiting its background purge
+    deleted_at: Mapped[datetime] = mapped_column(db.DateTime, nullable=True)
 
     # Set the hashed password
     def set_password(self, password):
@@ -25,15 +52,148 @@ class Post(db.Model):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     title: Mapped[str] = mapped_column(db.String(255), nullable=False)
-    content: Mapped[str] = mapped_column(db.String(255), nullable=True)
+    excerpt: Mapped[str] = mapped_column(db.String(255), nullable=True)
     user_id: Mapped[int] = mapped_column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Set once the post's comments have been moved to comments_archive (see archive.py)
+    comments_archived: Mapped[bool] = mapped_column(db.Boolean, nullable=False, default=False, server_default=db.false())
     comments: Mapped[list['Comment']] = relationship('Comment', backref='post', lazy=True)
+    # The full body lives in its own table and is only loaded when accessed
+    body: Mapped['PostBody'] = relationship('PostBody', uselist=False, lazy='select',
+                                            cascade='all, delete-orphan')
+
+    @property
+    def content(self):
+        return self.body.text if self.body is not None else None
+
+    # Setting the content also refreshes the precomputed excerpt
+    @content.setter
+    def content(self, value):
+        if value is None:
+            self.body = None
+            self.excerpt = None
+            return
+        if self.body is None:
+            self.body = PostBody()
+        self.body.text = value
+        self.excerpt = make_excerpt(value)
+
+class PostBody(db.Model):
+    __tablename__ = 'post_bodies'  # Table name in the database
+
+    post_id: Mapped[int] = mapped_column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    data: Mapped[bytes] = mapped_column(db.LargeBinary, nullable=False)
+    compressed: Mapped[bool] = mapped_column(db.Boolean, default=False, nullable=False)
+
+    @property
+    def text(self):
+        data = zlib.decompress(self.data) if self.compressed else self.data
+        return data.decode('utf-8')
+
+    # Compress transparently once the body crosses the size threshold
+    @text.setter
+    def text(self, value):
+        data = value.encode('utf-8')
+        self.compressed = len(data) >= BODY_COMPRESSION_THRESHOLD
+        self.data = zlib.compress(data) if self.compressed else data
 
 class Comment(db.Model):
     __tablename__ = 'comments'  # Table name in the database
 
     id: Mapped[int] = mapped_column(primary_key=True)
     content: Mapped[str] = mapped_column(db.Text, nullable=False)
-    date_posted: Mapped[datetime] = mapped_column(db.DateTime, default=datetime.now(timezone.utc))
+    date_posted: Mapped[datetime] = mapped_column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     user_id: Mapped[int] = mapped_column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     post_id: Mapped[int] = mapped_column(db.Integer, db.ForeignKey('posts.id'), nullable=False)
+    # Replies outlive a parent removed by a bulk delete; their path still places them in the thread
+    parent_id: Mapped[int] = mapped_column(db.Integer, db.ForeignKey('comments.id', ondelete='SET NULL'), nullable=True, index=True)
+    # Materialized path of zero-padded ancestor ids ("0000000001/0000000007/"),
+    # so a whole subtree is one range scan on the path index
+    path: Mapped[str] = mapped_column(db.String(255), nullable=True, index=True)
+    depth: Mapped[int] = mapped_column(db.Integer, nullable=False, default=0)
+
+    # AUTOINCREMENT stops SQLite from reusing the ids of comments moved to the archive
+    __table_args__ = (db.Index('ix_comments_post_path', 'post_id', 'path'), {'sqlite_autoincrement': True})
+
+    @staticmethod
+    def subtree_bounds(path):
+        """
+        Return the [low, high) path range covering a comment and its replies.
+
+        '/' sorts right before '0', so every descendant path falls in the range.
+        """
+        return path, path[:-1] + '0'
+
+@event.listens_for(Comment, 'after_insert')
+def _set_comment_path(mapper, connection, target):
+    # The path includes the comment's own id, which only exists after insert
+    prefix, depth = '', 0
+    if target.parent_id is not None:
+        parent_path, parent_depth = connection.execute(
+            select(Comment.path, Comment.depth).where(Comment.id == target.parent_id)
+        ).one()
+        prefix, depth = parent_path, parent_depth + 1
+    path = f'{prefix}{target.id:010d}/'
+    connection.execute(update(Comment.__table__).where(Comment.id == target.id).values(path=path, depth=depth))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'depth', depth)
+
+class ArchivedComment(db.Model):
+    __tablename__ = 'comments_archive'  # Table name in the database
+    # Kept in its own SQLite file when ARCHIVE_DATABASE_URI is set
+    __bind_key__ = 'archive' if os.getenv('ARCHIVE_DATABASE_URI') else None
+
+    # Same columns as comments; no foreign keys, the archive may be another database
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    content: Mapped[str] = mapped_column(db.Text, nullable=False)
+    date_posted: Mapped[datetime] = mapped_column(db.DateTime)
+    user_id: Mapped[int] = mapped_column(db.Integer, nullable=False, index=True)
+    post_id: Mapped[int] = mapped_column(db.Integer, nullable=False)
+    parent_id: Mapped[int] = mapped_column(db.Integer, nullable=True)
+    path: Mapped[str] = mapped_column(db.String(255), nullable=True, unique=True)
+    depth: Mapped[int] = mapped_column(db.Integer, nullable=False, default=0)
+    post: Mapped['Post'] = relationship('Post', primaryjoin='foreign(ArchivedComment.post_id) == Post.id', viewonly=True)
+
+    __table_args__ = (db.Index('ix_comments_archive_post_path', 'post_id', 'path'),)
+
+class Job(db.Model):
+    __tablename__ = 'jobs'  # Table name in the database
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    kind: Mapped[str] = mapped_column(db.String(64), nullable=False, index=True)
+    payload: Mapped[dict] = mapped_column(db.JSON, nullable=False, default=dict)
+    status: Mapped[str] = mapped_column(db.String(16), nullable=False, default='pending', index=True)
+    attempts: Mapped[int] = mapped_column(db.Integer, nullable=False, default=0)
+    run_after: Mapped[datetime] = mapped_column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    claimed_by: Mapped[str] = mapped_column(db.String(32), nullable=True, index=True)
+    claimed_at: Mapped[datetime] = mapped_column(db.DateTime, nullable=True)
+    last_error: Mapped[str] = mapped_column(db.Text, nullable=True)
+
+class TrendingSnapshot(db.Model):
+    __tablename__ = 'trending_snapshots'  # Table name in the database
+
+    # One row per worker process and post: that worker's counts for the window
+    worker: Mapped[str] = mapped_column(db.String(64), primary_key=True)
+    post_id: Mapped[int] = mapped_column(db.Integer, primary_key=True)
+    views: Mapped[int] = mapped_column(db.Integer, nullable=False, default=0)
+    comments: Mapped[int] = mapped_column(db.Integer, nullable=False, default=0)
+    updated_at: Mapped[datetime] = mapped_column(db.DateTime, nullable=False, index=True)
+
+class IdBlock(db.Model):
+    __tablename__ = 'id_blocks'  # Table name in the database
+
+    # Next unreserved id sequence number per sharded table (see sharding.IdAllocator)
+    name: Mapped[str] = mapped_column(db.String(64), primary_key=True)
+    next_value: Mapped[int] = mapped_column(db.BigInteger, nullable=False)
+
+class Change(db.Model):
+    __tablename__ = 'changes'  # Table name in the database
+
+    # Position in the change feed (see changes.py); AUTOINCREMENT never hands a seq out twice
+    seq: Mapped[int] = mapped_column(primary_key=True)
+    entity: Mapped[str] = mapped_column(db.String(16), nullable=False)
+    entity_id: Mapped[int] = mapped_column(db.Integer, nullable=False)
+    op: Mapped[str] = mapped_column(db.String(8), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+
+    # Finds the newer entries that supersede one during compaction
+    __table_args__ = (db.Index('ix_changes_entity', 'entity', 'entity_id', 'seq'), {'sqlite_autoincrement': True})
@@ -0,0 +1,190 @@
+import gzip
+import hashlib
+import json
+import re
+
+from flask import Response, request
+from marshmallow import fields
+
+from schemas import UserSchema, PostSchema, CommentSchema
+
+try:
+    import yaml
+except ImportError:  # JSON is valid YAML, so the spec can still be served
+    yaml = None
+
+
+COMPONENT_SCHEMAS = {
+    'User': UserSchema,
+    'Post': PostSchema,
+    'Comment': CommentSchema,
+}
+
+# Request/response bodies per endpoint; everything else about a path comes
+# from the URL map
+ENDPOINT_BODIES = {
+    'create_user': ('User', 'User'),
+    'get_user': (None, 'User'),
+    'update_user': ('User', 'User'),
+    'create_post': ('Post', 'Post'),
+    'get_post': (None, 'Post'),
+    'update_post': ('Post', 'Post'),
+    'list_posts': (None, ['Post']),
+    'create_comment': ('Comment', 'Comment'),
+    'get_comment': (None, 'Comment'),
+    'update_comment': ('Comment', 'Comment'),
+}
+
+FIELD_TYPES = [
+    (fields.Email, {'type': 'string', 'format': 'email'}),
+    (fields.DateTime, {'type': 'string', 'format': 'date-time'}),
+    (fields.Int, {'type': 'integer'}),
+    (fields.Float, {'type': 'number'}),
+    (fields.Bool, {'type': 'boolean'}),
+    (fields.Str, {'type': 'string'}),
+]
+
+# <converter(args):name> or <name> in a werkzeug rule
+RULE_ARGUMENT = re.compile(r'<(?:(\w+)(?:\([^)]*\))?:)?(\w+)>')
+
+SUCCESS_STATUS = {'POST': '201', 'DELETE': '204'}
+
+
+def field_to_openapi(field):
+    if isinstance(field, fields.Nested):
+        name = next(key for key, schema in COMPONENT_SCHEMAS.items() if isinstance(field.schema, schema))
+        return {'$ref': f'#/components/schemas/{name}'}
+    if isinstance(field, fields.List):
+        return {'type': 'array', 'items': field_to_openapi(field.inner)}
+    prop = next((dict(spec) for kind, spec in FIELD_TYPES if isinstance(field, kind)), {})
+    if field.dump_only:
+        prop['readOnly'] = True
+    if field.load_only:
+        prop['writeOnly'] = True
+    if field.allow_none:
+        prop['nullable'] = True
+    return prop
+
+
+def schema_to_openapi(schema_class):
+    schema = schema_class()
+    properties = {name: field_to_openapi(field) for name, field in schema.fields.items()}
+    required = [name for name, field in schema.fields.items() if field.required]
+    spec = {'type': 'object', 'properties': properties}
+    if required:
+        spec['required'] = required
+    return spec
+
+
+def _requires_token(view):
+    # Walk the decorator chain looking for flask_httpauth's login_required
+    while view is not None:
+        if 'login_required' in getattr(view.__code__, 'co_qualname', ''):
+            return True
+        view = getattr(view, '__wrapped__', None)
+    return False
+
+
+def _body_schema(ref):
+    if isinstance(ref, list):
+        return {'type': 'array', 'items': {'$ref': f'#/components/schemas/{ref[0]}'}}
+    return {'$ref': f'#/components/schemas/{ref}'}
+
+
+def build_spec(app, skip_endpoints=()):
+    """
+    Build the OpenAPI document from the marshmallow schemas and the URL map.
+    """
+    paths = {}
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if rule.endpoint == 'static' or '.' in rule.endpoint or rule.endpoint in skip_endpoints:
+            continue
+        view = app.view_functions[rule.endpoint]
+        path = RULE_ARGUMENT.sub(r'{\2}', rule.rule)
+        parameters = [
+            {'name': name, 'in': 'path', 'required': True,
+             'schema': {'type': 'integer' if converter == 'int' else 'string'}}
+            for converter, name in RULE_ARGUMENT.findall(rule.rule)
+        ]
+        request_ref, response_ref = ENDPOINT_BODIES.get(rule.endpoint, (None, None))
+        doc = (view.__doc__ or '').strip().splitlines()
+
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            status = SUCCESS_STATUS.get(method, '200')
+            success = {'description': 'Success'}
+            if response_ref and status != '204':
+                success['content'] = {'application/json': {'schema': _body_schema(response_ref)}}
+            operation = {
+                'operationId': rule.endpoint,
+                'summary': doc[0] if doc else rule.endpoint.replace('_', ' ').capitalize(),
+                'responses': {status: success, '400': {'description': 'Bad Request'}},
+            }
+            if parameters:
+                operation['parameters'] = parameters
+            if request_ref and method in ('POST', 'PUT'):
+                operation['requestBody'] = {
+                    'required': True,
+                    'content': {'application/json': {'schema': _body_schema(request_ref)}},
+                }
+            if _requires_token(view):
+                operation['security'] = [{'bearerAuth': []}]
+                operation['responses']['401'] = {'description': 'Unauthorized'}
+            paths.setdefault(path, {})[method.lower()] = operation
+
+    return {
+        'openapi': '3.0.1',
+        'info': {
+            'title': 'Blog API',
+            'description': 'API documentation for the Blog application.',
+            'version': '1.0.0',
+        },
+        'components': {
+            'schemas': {name: schema_to_openapi(schema) for name, schema in COMPONENT_SCHEMAS.items()},
+            'securitySchemes': {'bearerAuth': {'type': 'http', 'scheme': 'bearer', 'bearerFormat': 'JWT'}},
+        },
+        'paths': paths,
+    }
+
+
+class EncodedDocument:
+    """
+    A document kept pre-encoded, pre-compressed and ETagged in memory.
+    """
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9)
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+
+    def response(self):
+        if self.etag in request.if_none_match:
+            return Response(status=304, headers={'ETag': f'"{self.etag}"'})
+        headers = {'ETag': f'"{self.etag}"', 'Vary': 'Accept-Encoding', 'Cache-Control': 'public, max-age=300'}
+        if 'gzip' in request.accept_encodings:
+            headers['Content-Encoding'] = 'gzip'
+            return Response(self.gzipped, mimetype=self.mimetype, headers=headers)
+        return Response(self.body, mimetype=self.mimetype, headers=headers)
+
+
+def init_app(app, json_url, yaml_url):
+    """
+    Register the spec routes and build the spec once, after every other
+    route has been registered.
+    """
+    documents = {}
+
+    @app.route(json_url)
+    def openapi_json():
+        return documents['json'].response()
+
+    @app.route(yaml_url)
+    def openapi_yaml():
+        return documents['yaml'].response()
+
+    spec = build_spec(app, skip_endpoints={'openapi_json', 'openapi_yaml'})
+    json_body = json.dumps(spec, separators=(',', ':')).encode('utf-8')
+    yaml_body = yaml.safe_dump(spec, sort_keys=False).encode('utf-8') if yaml else json_body
+    documents['json'] = EncodedDocument(json_body, 'application/json')
+    documents['yaml'] = EncodedDocument(yaml_body, 'application/yaml')
+    app.extensions['openapi'] = spec
@@ -0,0 +1,171 @@
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from flask import current_app, g, has_app_context, jsonify, request, send_from_directory
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger(__name__)
+
+# cProfile can only run one profiler at a time on Python 3.12+, so profiled
+# requests are serialized; a request that finds it busy simply isn't profiled
+_profiler_lock = threading.Lock()
+
+
+class ProfileRun:
+    """
+    The profiler and SQL log of one profiled request.
+    """
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.statements = []
+        self.started = time.perf_counter()
+
+
+def _authorized():
+    key = current_app.config.get('PROFILING_KEY')
+    return bool(key) and hmac.compare_digest(request.headers.get('X-Profile-Key', ''), key)
+
+
+def _should_profile():
+    if request.headers.get('X-Profile') == '1' and _authorized():
+        return True
+    rate = current_app.config.get('PROFILING_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    run = g.get('profile') if has_app_context() else None
+    if run is not None:
+        context._profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    run = g.get('profile') if has_app_context() else None
+    if run is not None:
+        started = getattr(context, '_profile_started', None)
+        elapsed = (time.perf_counter() - started) * 1000 if started is not None else None
+        # Parameters are left out: they can hold passwords and personal data
+        run.statements.append({'statement': statement, 'duration_ms': elapsed, 'executemany': executemany})
+
+
+def _write_profile(run, response_status):
+    directory = current_app.config['PROFILING_DIR']
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')
+    name = f'{stamp}-{request.endpoint or "unknown"}-{uuid.uuid4().hex[:8]}'
+
+    run.profiler.dump_stats(os.path.join(directory, f'{name}.prof'))
+    summary = io.StringIO()
+    pstats.Stats(run.profiler, stream=summary).sort_stats('cumulative').print_stats(30)
+    metadata = {
+        'name': name,
+        'method': request.method,
+        'path': request.full_path.rstrip('?'),
+        'endpoint': request.endpoint,
+        'status': response_status,
+        'duration_ms': (time.perf_counter() - run.started) * 1000,
+        'sql': run.statements,
+        'summary': summary.getvalue(),
+    }
+    with open(os.path.join(directory, f'{name}.json'), 'w') as f:
+        json.dump(metadata, f)
+    _rotate(directory, current_app.config.get('PROFILING_MAX_FILES', 100))
+
+
+def _rotate(directory, keep):
+    names = sorted(entry[:-5] for entry in os.listdir(directory) if entry.endswith('.json'))
+    for name in names[:-keep] if keep else ():
+        for suffix in ('.json', '.prof'):
+            try:
+                os.remove(os.path.join(directory, name + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def init_app(app):
+    """
+    Profile requests that carry ``X-Profile: 1`` with the right
+    ``X-Profile-Key``, or a random ``PROFILING_SAMPLE_RATE`` share of them.
+
+    Nothing is registered unless profiling is configured, so by default
+    requests pay no overhead at all.
+    """
+    if not app.config.get('PROFILING_KEY') and not app.config.get('PROFILING_SAMPLE_RATE'):
+        return
+    if not app.config.get('PROFILING_DIR'):
+        app.config['PROFILING_DIR'] = os.path.join(app.instance_path, 'profiles')
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_profile():
+        if not _should_profile() or not _profiler_lock.acquire(blocking=False):
+            return
+        run = g.profile = ProfileRun()
+        run.profiler.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        run = g.pop('profile', None)
+        if run is None:
+            return response
+        run.profiler.disable()
+        _profiler_lock.release()
+        try:
+            _write_profile(run, response.status_code)
+        except OSError as e:
+            logger.warning("Could not write profile: %s", e)
+        return response
+
+    @app.teardown_request
+    def abandon_profile(exc):
+        # after_request didn't run (unhandled error): stop without writing
+        run = g.pop('profile', None)
+        if run is not None:
+            run.profiler.disable()
+            _profiler_lock.release()
+
+    @app.route('/admin/profiles', methods=['GET'])
+    def list_profiles():
+        """
+        List the stored request profiles, newest first.
+        """
+        if not _authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        directory = current_app.config['PROFILING_DIR']
+        if not os.path.isdir(directory):
+            return jsonify([])
+        profiles = []
+        for entry in sorted(os.listdir(directory), reverse=True):
+            if entry.endswith('.json'):
+                with open(os.path.join(directory, entry)) as f:
+                    metadata = json.load(f)
+                profiles.append({key: metadata[key] for key in ('name', 'method', 'path', 'status', 'duration_ms')}
+                                | {'sql_statements': len(metadata['sql'])})
+        return jsonify(profiles)
+
+    @app.route('/admin/profiles/<name>', methods=['GET'])
+    def get_profile(name):
+        """
+        Return a profile with its SQL, or the raw pstats file with ?format=prof.
+        """
+        if not _authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        directory = current_app.config['PROFILING_DIR']
+        if request.args.get('format') == 'prof':
+            return send_from_directory(directory, f'{name}.prof', as_attachment=True)
+        return send_from_directory(directory, f'{name}.json')
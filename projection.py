@@ -0,0 +1,53 @@
+from functools import lru_cache
+
+from flask import request
+from marshmallow import ValidationError
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only, selectinload
+
+
+def parse_fields(schema, allowed=None):
+    """
+    Read the ``fields`` query parameter and validate it against the fields
+    ``schema`` can dump (optionally narrowed to ``allowed``).
+
+    Returns a tuple of field names, or None when no projection was asked for.
+    """
+    raw = request.args.get('fields')
+    if not raw:
+        return None
+    requested = tuple(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    dumpable = {name for name, field in schema.fields.items() if not field.load_only}
+    if allowed is not None:
+        dumpable &= set(allowed)
+    unknown = [name for name in requested if name not in dumpable]
+    if unknown or not requested:
+        raise ValidationError({'fields': [f"Unknown field(s): {', '.join(unknown) or raw}"]})
+    return requested
+
+
+def projection_options(model, fields, loaders=None):
+    """
+    Build loader options that read only the columns behind ``fields``.
+
+    The primary key is always loaded. Requested relationships are batch
+    loaded, and ``loaders`` maps schema fields that are not plain columns
+    (like ``Post.content``) to the loader option they need.
+    """
+    mapper = inspect(model)
+    columns = [getattr(model, name) for name in fields if name in mapper.column_attrs]
+    options = [load_only(model.id, *columns)]
+    for name in fields:
+        if name in mapper.relationships:
+            options.append(selectinload(getattr(model, name)))
+        elif loaders and name in loaders:
+            options.append(loaders[name])
+    return options
+
+
+@lru_cache(maxsize=256)
+def projected_schema(schema_class, fields, many=False):
+    """
+    Return a (cached) schema instance that dumps only ``fields``.
+    """
+    return schema_class(only=fields, many=many)
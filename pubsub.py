@@ -0,0 +1,200 @@
+import glob
+import json
+import logging
+import os
+import socket
+import threading
+from collections import defaultdict, deque
+from fnmatch import fnmatchcase
+
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+    """
+    A subscriber's mailbox. Idle subscribers cost one Event and one deque.
+    """
+
+    def __init__(self, channel, maxlen=100):
+        self.channel = channel
+        self.events = deque(maxlen=maxlen)
+        self.lagged = False
+        self._ready = threading.Event()
+
+    def push(self, event):
+        if len(self.events) == self.events.maxlen:
+            # The client is too slow; it will reconnect and resume from its last id
+            self.lagged = True
+        self.events.append(event)
+        self._ready.set()
+
+    def wait(self, timeout):
+        """
+        Wait for events and return them all, or an empty list on timeout.
+        """
+        if self._ready.wait(timeout):
+            self._ready.clear()
+        drained = []
+        while self.events:
+            drained.append(self.events.popleft())
+        return drained
+
+
+class Broker:
+    """
+    In-process publish/subscribe with an optional cross-worker bridge.
+
+    Each worker binds a Unix datagram socket in a directory only the app's
+    user can enter; a publish is delivered locally and sent to every other
+    worker's socket, whose listener thread re-publishes it to its own
+    subscribers.
+    """
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self._socket = None
+        self._sender = None
+        self._socket_path = None
+        self._socket_dir = None
+        self._pid = None
+        self._app = None
+        self._resolvers = []
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel)
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def publish(self, channel, event):
+        """
+        Deliver an event (a JSON-serializable dict) to subscribers in every worker.
+        """
+        self._deliver(channel, event)
+        self._broadcast(channel, event)
+
+    def _deliver(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.push(event)
+
+    def init_app(self, app):
+        """
+        Attach the broker to the app and bind this process's bridge socket.
+
+        With ``PRELOAD_APP`` the socket is only bound by each worker, in
+        ``after_fork``.
+        """
+        self._app = app
+        if not app.config.get('PRELOAD_APP', False):
+            self._bind()
+
+    def add_resolver(self, pattern, resolve):
+        """
+        Register ``resolve(channel, event)`` for the channels matching the
+        glob ``pattern``. It rebuilds an event that arrived from another
+        worker without its payload because it was too large for a datagram,
+        and runs inside an app context. Such events on other channels are
+        dropped.
+        """
+        self._resolvers = [(p, r) for p, r in self._resolvers if p != pattern] + [(pattern, resolve)]
+
+    def _resolver(self, channel):
+        for pattern, resolve in self._resolvers:
+            if fnmatchcase(channel, pattern):
+                return resolve
+        return None
+
+    def after_fork(self):
+        """
+        Drop the sockets inherited from the parent and bind this worker's own.
+        """
+        for sock in (self._socket, self._sender):
+            if sock is not None:
+                sock.close()
+        self._socket = self._sender = None
+        self._pid = None
+        if self._app is not None:
+            self._bind()
+
+    def _bind(self):
+        app = self._app
+        if not app.config.get('PUBSUB_BRIDGE_ENABLED', True) or not hasattr(socket, 'AF_UNIX'):
+            return
+        if self._pid == os.getpid():
+            return
+        # Anyone who can write to the directory can inject events, so it is private to this user
+        self._socket_dir = app.config.get('PUBSUB_SOCKET_DIR') or os.path.join(app.instance_path, 'pubsub')
+        os.makedirs(self._socket_dir, mode=0o700, exist_ok=True)
+        os.chmod(self._socket_dir, 0o700)
+        self._socket_path = os.path.join(self._socket_dir, f'{os.getpid()}.sock')
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self._socket_path)
+        # Sends never block a request: a worker whose queue is full misses the event
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._pid = os.getpid()
+        threading.Thread(target=self._listen, args=(self._socket,), name='pubsub-bridge', daemon=True).start()
+
+    def _broadcast(self, channel, event):
+        if self._socket is None or self._pid != os.getpid():
+            return
+        message = json.dumps({'channel': channel, 'event': event}).encode('utf-8')
+        for path in glob.glob(os.path.join(self._socket_dir, '*.sock')):
+            if path == self._socket_path:
+                continue
+            try:
+                self._sender.sendto(message, path)
+            except BlockingIOError:
+                logger.warning("Pub/sub peer %s is not keeping up; event dropped", path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # That worker is gone
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError:
+                # Too large for one datagram: send a reference the peer can resolve
+                reference = {'channel': channel, 'event': {'id': event.get('id')}, 'partial': True}
+                try:
+                    self._sender.sendto(json.dumps(reference).encode('utf-8'), path)
+                except OSError as e:
+                    logger.warning("Could not forward event to %s: %s", path, e)
+
+    def _listen(self, sock):
+        while True:
+            try:
+                data = sock.recv(1 << 20)
+            except OSError:
+                return
+            try:
+                message = json.loads(data)
+                channel, event = message['channel'], message['event']
+                if message.get('partial'):
+                    resolve = self._resolver(channel)
+                    if resolve is None:
+                        continue
+                    with self._app.app_context():
+                        event = resolve(channel, event)
+                    if event is None:
+                        continue
+            except Exception:
+                logger.exception("Dropped malformed pub/sub message")
+                continue
+            self._deliver(channel, event)
+
+
+broker = Broker()
@@ -0,0 +1,130 @@
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import delete, func, select, union_all
+
+from caching import invalidate_post
+from changes import record_change
+from extensions import db
+from jobs import enqueue, job_handler
+from models import User, Post, PostBody, Comment, ArchivedComment
+from snapshot import post_changed
+from suggest import title_changed
+
+
+def delete_in_chunks(model, condition, key=None, chunk_size=None, record=None):
+    """
+    Delete the rows of ``model`` matching ``condition`` in bounded chunks.
+
+    Each chunk is ``DELETE ... WHERE key IN (SELECT key ... LIMIT n)`` in its
+    own transaction, so locks are held briefly and no row is ever loaded
+    into the session. With ``record`` (an entity name of the change log),
+    each chunk's keys are selected first and a delete is logged for every
+    one of them in the same transaction. Returns the number of rows deleted.
+    """
+    key = key if key is not None else model.id
+    chunk_size = chunk_size or current_app.config.get('PURGE_CHUNK_SIZE', 1000)
+    # The extra derived table keeps MySQL happy with LIMIT inside IN (...)
+    chunk = select(key).where(condition).limit(chunk_size).subquery()
+    statement = delete(model).where(key.in_(select(chunk.c[0]))).execution_options(synchronize_session=False)
+
+    deleted = 0
+    while True:
+        if record is None:
+            count = db.session.execute(statement).rowcount
+        else:
+            ids = db.session.scalars(select(key).where(condition).limit(chunk_size)).all()
+            for entity_id in ids:
+                record_change(record, entity_id, 'delete')
+            if ids:
+                db.session.execute(delete(model).where(key.in_(ids)).execution_options(synchronize_session=False))
+            count = len(ids)
+        db.session.commit()
+        deleted += count
+        if count < chunk_size:
+            return deleted
+
+
+def purge_post(post_id):
+    """
+    Delete a post, its body and all of its comments without loading them.
+    """
+    delete_in_chunks(Comment, Comment.post_id == post_id)
+    delete_in_chunks(ArchivedComment, ArchivedComment.post_id == post_id)
+    delete_in_chunks(PostBody, PostBody.post_id == post_id, key=PostBody.post_id)
+    record_change('post', post_id, 'delete')
+    db.session.execute(delete(Post).where(Post.id == post_id).execution_options(synchronize_session=False))
+    db.session.commit()
+
+
+def purge_user(user_id):
+    """
+    Delete a user, everything they wrote and every comment on their posts.
+
+    Each deleted post is dropped from the cache and published like a
+    delete_post, so every worker stops serving it.
+    """
+    user_posts = select(Post.id).where(Post.user_id == user_id)
+    delete_in_chunks(Comment, Comment.user_id == user_id)
+    delete_in_chunks(Comment, Comment.post_id.in_(user_posts))
+    # The archive may be another database, so no subquery against posts there
+    post_ids = db.session.scalars(user_posts).all()
+    delete_in_chunks(ArchivedComment, ArchivedComment.user_id == user_id)
+    for start in range(0, len(post_ids), 500):
+        delete_in_chunks(ArchivedComment, ArchivedComment.post_id.in_(post_ids[start:start + 500]))
+    delete_in_chunks(PostBody, PostBody.post_id.in_(user_posts), key=PostBody.post_id)
+    delete_in_chunks(Post, Post.user_id == user_id, record='post')
+    record_change('user', user_id, 'delete')
+    db.session.execute(delete(User).where(User.id == user_id).execution_options(synchronize_session=False))
+    db.session.commit()
+    for post_id in post_ids:
+        invalidate_post(post_id)
+        title_changed(post_id, None)
+        post_changed(post_id)
+
+
+def _owned_rows(user_id, limit):
+    """
+    Count the rows a user purge would delete, stopping at ``limit``: their
+    posts and comments, and everyone's comments on their posts (hot and
+    archived). Comments of theirs on their own posts count twice.
+    """
+    user_posts = select(Post.id).where(Post.user_id == user_id)
+    owned = union_all(
+        select(Comment.id).where(Comment.user_id == user_id),
+        select(Post.id).where(Post.user_id == user_id),
+        select(Comment.id).where(Comment.post_id.in_(user_posts))
+    ).limit(limit).subquery()
+    count = db.session.scalar(select(func.count()).select_from(owned))
+    if count >= limit:
+        return count
+    # The archive may be another database; the user has fewer than ``limit`` posts here
+    post_ids = db.session.scalars(user_posts).all()
+    archived = select(ArchivedComment.id).where(
+        (ArchivedComment.user_id == user_id) | ArchivedComment.post_id.in_(post_ids)
+    ).limit(limit - count).subquery()
+    return count + db.session.scalar(select(func.count()).select_from(archived))
+
+
+def delete_user_account(user):
+    """
+    Delete a user synchronously, or tombstone them and purge in the background
+    when they own more than ``USER_PURGE_SYNC_LIMIT`` rows.
+
+    Returns True if the purge was deferred.
+    """
+    limit = current_app.config.get('USER_PURGE_SYNC_LIMIT', 5000)
+    if _owned_rows(user.id, limit + 1) <= limit:
+        purge_user(user.id)
+        return False
+
+    user.deleted_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    enqueue('purge_user', user_id=user.id)
+    db.session.commit()
+    return True
+
+
+@job_handler('purge_user')
+def _run_user_purges(payloads):
+    for user_id in {payload['user_id'] for payload in payloads}:
+        purge_user(user_id)
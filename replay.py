@@ -0,0 +1,212 @@
+"""
+Replay a traffic capture (see traffic.py) against a running server.
+
+    python replay.py capture.jsonl --url http://127.0.0.1:8000 --speed 2 --clients 16
+    python replay.py capture.jsonl --start-server --workers 4 --speed 0
+
+Tokens are not captured; requests made as ``user:<id>`` are re-signed for
+that user with ``--secret-key`` (the replay server's SECRET_KEY).
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+
+import jwt
+
+
+def load_capture(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class TokenTranslator:
+    """
+    Mint a token per captured identity, signed for the replay server.
+    """
+
+    def __init__(self, secret_key):
+        self.secret_key = secret_key
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, identity):
+        if not identity or not self.secret_key:
+            return None
+        if identity == 'invalid':
+            return 'invalid'
+        with self._lock:
+            token = self._tokens.get(identity)
+            if token is None:
+                now = datetime.now(timezone.utc)
+                payload = {'exp': now + timedelta(days=1), 'iat': now, 'sub': identity.split(':', 1)[1]}
+                token = self._tokens[identity] = jwt.encode(payload, self.secret_key, algorithm='HS256')
+            return token
+
+
+def _encode_body(record):
+    body = record.get('body')
+    if not body:
+        return None
+    if 'json' in body:
+        return json.dumps(body['json']).encode('utf-8')
+    return base64.b64decode(body['base64'])
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Replayer:
+    """
+    Sends captured requests on a pool of keep-alive clients, paced by the
+    capture's own timing divided by ``speed`` (0 sends as fast as possible).
+    """
+
+    def __init__(self, base_url, clients=8, speed=1.0, translate=None, timeout=30):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.clients = clients
+        self.speed = speed
+        self.translate = translate or (lambda identity: None)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._results = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return connection
+
+    def send(self, record):
+        path = record['path'] + (f"?{record['query']}" if record.get('query') else '')
+        headers = dict(record.get('headers') or {})
+        token = self.translate(record.get('auth'))
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        started = time.perf_counter()
+        try:
+            connection = self._connection()
+            connection.request(record['method'], path, body=_encode_body(record), headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            # Drop the connection; the next request on this client reconnects
+            self._local.connection = None
+            status = None
+        latency = (time.perf_counter() - started) * 1000
+        endpoint = record.get('endpoint') or f"{record['method']} {record['path']}"
+        with self._lock:
+            self._results[endpoint].append((latency, status, record.get('status')))
+
+    def run(self, records):
+        records = [record for record in records if not record.get('truncated')]
+        origin = records[0]['offset'] if records else 0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.clients) as executor:
+            for record in records:
+                if self.speed > 0:
+                    delay = start + (record['offset'] - origin) / self.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(self.send, record)
+        return self.report(time.monotonic() - start)
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint, results in sorted(self._results.items()):
+            latencies = sorted(latency for latency, _, _ in results)
+            errors = sum(1 for _, status, _ in results if status is None or status >= 500)
+            mismatches = sum(1 for _, status, captured in results if captured is not None and status != captured)
+            endpoints[endpoint] = {
+                'requests': len(results),
+                'error_rate': errors / len(results),
+                'status_mismatches': mismatches,
+                'p50_ms': percentile(latencies, 0.5),
+                'p90_ms': percentile(latencies, 0.9),
+                'p99_ms': percentile(latencies, 0.99),
+                'max_ms': latencies[-1],
+            }
+        total = sum(summary['requests'] for summary in endpoints.values())
+        return {'elapsed_s': elapsed, 'requests': total,
+                'throughput_rps': total / elapsed if elapsed else None, 'endpoints': endpoints}
+
+
+def print_report(report, out=sys.stdout):
+    out.write(f"{report['requests']} requests in {report['elapsed_s']:.1f}s "
+              f"({report['throughput_rps'] or 0:.1f} req/s)\n\n")
+    out.write(f"{'endpoint':<28}{'count':>8}{'errors':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}\n")
+    for endpoint, summary in report['endpoints'].items():
+        out.write(f"{endpoint:<28}{summary['requests']:>8}{summary['error_rate']:>8.1%} "
+                  f"{summary['p50_ms']:>8.1f}{summary['p90_ms']:>9.1f}{summary['p99_ms']:>9.1f}{summary['max_ms']:>9.1f}\n")
+
+
+def start_server(port, workers):
+    """
+    Start gunicorn with the production config on localhost and wait for it.
+    """
+    env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_BIND=f'127.0.0.1:{port}')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py'], env=env,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError('gunicorn exited during startup')
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start listening within 30s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured traffic and report latency per endpoint.')
+    parser.add_argument('capture', help='JSONL file written with TRAFFIC_CAPTURE_FILE')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='server to replay against')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier; 0 for no pacing')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--secret-key', default=os.getenv('SECRET_KEY'), help="replay server's SECRET_KEY, to re-sign tokens")
+    parser.add_argument('--start-server', action='store_true', help='start a local gunicorn for the replay')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='gunicorn workers with --start-server')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.start_server:
+        server = start_server(urlsplit(args.url).port or 8000, args.workers)
+    try:
+        replayer = Replayer(args.url, clients=args.clients, speed=args.speed,
+                            translate=TokenTranslator(args.secret_key))
+        report = replayer.run(load_capture(args.capture))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,80 @@
-from flask import request, jsonify
+import json
+from datetime import timedelta
+from flask import Response, current_app, request, jsonify
 from marshmallow import ValidationError
 from werkzeug.security import generate_password_hash, check_password_hash
 from utils.utils import encode_token
 from auth import token_auth
-from models import User, Post, Comment
-from schemas import UserSchema, PostSchema, CommentSchema
-from caching import cache
+from models import User, Post, Comment, MAX_COMMENT_DEPTH
+from schemas import UserSchema, PostSchema, CommentSchema, comments_schema
+from caching import single_flight_cached, track_post_access, invalidate_post, invalidate_user, projected_post_version, POST_LIST_VERSION_KEY
 from limiter import limiter
 from models import db  # Import the db object
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import joinedload
+from warmup import schedule_warmup
+from projection import parse_fields, projection_options, projected_schema
+from purge import purge_post, delete_user_account, delete_in_chunks
+from threads import fetch_page, subtree_query, build_tree
+import group_commit
+import sharding
+from pubsub import broker
+from trending import count_view, record_comment, trending_posts
+from archive import thaw_post, comment_model_or_404, get_comment_or_404, get_hot_comment_or_404
+from includes import with_included, load_posts
+from suggest import suggest, title_changed
+from snapshot import snapshot_post, snapshot_posts, post_changed
+from changes import changes_since
 
 #function to get remote address
 def get_remote_address():
     return request.remote_addr
 
+def comment_channel(post_id):
+    return f'post:{post_id}:comments'
+
+def load_comment_event(channel, event):
+    """
+    Rebuild a comment event forwarded by another worker without its payload.
+    """
+    comment = db.session.get(Comment, event['id'])
+    return {'id': comment.id, 'data': comment_schema.dump(comment)} if comment else None
+
+def format_sse(event_id, data):
+    return f'id: {event_id}\nevent: comment\ndata: {json.dumps(data)}\n\n'
+
+def missed_comments_query(model, post_id, last_id):
+    """
+    Comments a stream client may have missed after the comment ``last_id``.
+
+    Writers commit out of id order, so ids after the last one seen aren't
+    enough: everything dated up to ``SSE_RESUME_OVERLAP_SECONDS`` before it
+    is sent again, and clients drop the ids they already have.
+    """
+    query = model.query.filter(model.post_id == post_id, model.id != last_id)
+    last = db.session.get(model, last_id)
+    if last is None or last.post_id != post_id or last.date_posted is None:
+        query = query.filter(model.id > last_id)
+    else:
+        overlap = timedelta(seconds=current_app.config['SSE_RESUME_OVERLAP_SECONDS'])
+        query = query.filter(model.date_posted >= last.date_posted - overlap)
+    return query.order_by(model.date_posted, model.id)
+
 # Schemas
 user_schema = UserSchema()
 post_schema = PostSchema()
 comment_schema = CommentSchema()
 
+# Fields returned by list_posts (the full content is only served by get_post)
+POST_LIST_FIELDS = ('excerpt', 'id', 'title', 'user_id')
+post_list_schema = PostSchema(many=True, only=POST_LIST_FIELDS)
+
 
 
 def init_app(app):
+    broker.init_app(app)
+    broker.add_resolver(comment_channel('*'), load_comment_event)
+
     @app.route('/')
     def index():
         return {"message": "Welcome to the Blog API"}
@@ -34,7 +87,7 @@ def init_app(app):
         try:
             data = request.json
             credentials = user_schema.load(data, partial=True)
-            user = User.query.filter_by(username=credentials['username']).first()
+            user = User.query.filter_by(username=credentials['username'], deleted_at=None).first()
             if user and check_password_hash(user.password, credentials['password']):
                 auth_token = encode_token(user.id)
                 return {'token': auth_token}, 200
@@ -78,7 +131,7 @@ def init_app(app):
         if not username or not password:
             return jsonify({'error': 'Username and password are required'}), 400
 
-        user = User.query.filter_by(username=username).first()
+        user = User.query.filter_by(username=username, deleted_at=None).first()
         if user and check_password_hash(user.password, password):
             token = encode_token(user.id)
             return jsonify({'token': token}), 200
@@ -115,11 +168,17 @@ def init_app(app):
 
     @app.route('/users/<int:id>', methods=["GET"])
     @token_auth.login_required
-    @cache.cached(timeout=60)
+    @single_flight_cached(timeout=60, query_string=True)
     def get_user(id):
-        user = User.query.get_or_404(id)
-        user_data = user_schema.dump(user)
-        return jsonify(user_data)
+        try:
+            fields = parse_fields(user_schema)
+        except ValidationError as err:
+            return err.messages, 400
+        if fields is None:
+            user = User.query.filter_by(id=id, deleted_at=None).first_or_404()
+            return jsonify(user_schema.dump(user))
+        user = User.query.options(*projection_options(User, fields)).filter_by(id=id, deleted_at=None).first_or_404()
+        return jsonify(projected_schema(UserSchema, fields).dump(user))
 
     @app.route('/users/<int:id>', methods=["PUT"])
     @token_auth.login_required
@@ -137,6 +196,7 @@ def init_app(app):
             for key, value in user_data.items():
                 setattr(user, key, value)
             db.session.commit()
+            invalidate_user(id)
             return jsonify(user_schema.dump(user))  # Corrected line
         except ValidationError as err:
             return err.messages, 400
@@ -149,8 +209,10 @@ def init_app(app):
         if logged_in_user.id != id:
             return {"error": "Unauthorized"}, 401
         user = User.query.get_or_404(id)
-        db.session.delete(user)
-        db.session.commit()
+        invalidate_user(id)
+        # Large accounts are tombstoned now and purged by a background job
+        if delete_user_account(user):
+            return '', 202
         return '', 204
 
     # Post Routes
@@ -169,7 +231,11 @@ def init_app(app):
                 user_id=logged_in_user.id  # Assuming the post is created by the logged-in user
             )
             db.session.add(new_post)
-            db.session.commit()
+            schedule_warmup(app)
+            group_commit.commit()
+            invalidate_post()
+            title_changed(new_post.id, new_post.title)
+            post_changed(new_post.id)
             return jsonify(post_schema.dump(new_post)), 201  # Created
         except ValidationError as err:
             return jsonify(err.messages), 400  # Bad request
@@ -193,7 +259,12 @@ def init_app(app):
             for key, value in loaded_data.items():
                 setattr(post, key, value)
             
+            schedule_warmup(app)
             db.session.commit()
+            invalidate_post(id)
+            post_changed(id)
+            if 'title' in loaded_data:
+                title_changed(id, post.title)
             
             # Serialize the updated post instance
             result = post_schema.dump(post)
@@ -203,11 +274,22 @@ def init_app(app):
             return jsonify(err.messages), 400
 
     @app.route('/posts/<int:id>', methods=["GET"])
-    @cache.cached(timeout=60)
+    @count_view
+    @track_post_access
+    @snapshot_post
+    @with_included('author', 'comments')
+    @single_flight_cached(timeout=60, query_string=('fields',), version_key=projected_post_version)
     def get_post(id):
-        post = Post.query.get_or_404(id)
-        post_data = post_schema.dump(post)
-        return jsonify(post_data)
+        try:
+            fields = parse_fields(post_schema)
+        except ValidationError as err:
+            return err.messages, 400
+        if fields is None:
+            post = Post.query.options(joinedload(Post.body)).get_or_404(id)
+            return jsonify(post_schema.dump(post))
+        options = projection_options(Post, fields, loaders={'content': joinedload(Post.body)})
+        post = Post.query.options(*options).get_or_404(id)
+        return jsonify(projected_schema(PostSchema, fields).dump(post))
 
     @app.route('/posts/<int:id>', methods=["DELETE"])
     @token_auth.login_required
@@ -217,38 +299,93 @@ def init_app(app):
         post = Post.query.get_or_404(id)
         if post.user_id != logged_in_user.id:
             return jsonify({"error": "Unauthorized"}), 401
-        db.session.delete(post)
+        purge_post(id)
+        schedule_warmup(app)
         db.session.commit()
+        invalidate_post(id)
+        title_changed(id, None)
+        post_changed(id)
         return jsonify({"message": "Post deleted successfully"}), 204
     
     @app.route('/posts', methods=['GET'])
-    @cache.cached(timeout=60, query_string=True)
+    @snapshot_posts
+    @with_included('author')
+    @single_flight_cached(timeout=60, query_string=True, version_key=POST_LIST_VERSION_KEY)
     @limiter.limit("10 per minute", key_func=get_remote_address)
     def list_posts():
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 10, type=int)
         search = request.args.get('search', '', type=str)
+        try:
+            fields = parse_fields(post_schema, allowed=POST_LIST_FIELDS) or POST_LIST_FIELDS
+        except ValidationError as err:
+            return err.messages, 400
         
         try:
-            # Using SQLAlchemy to query with LIKE for SQLite
-            query = Post.query.filter(Post.title.like(f'%{search}%')).paginate(page=page, per_page=per_page, error_out=False)
-            posts = query.items
+            # Using SQLAlchemy to query with LIKE for SQLite, reading only the requested columns
+            query = Post.query.options(*projection_options(Post, fields)) \
+                .filter(Post.title.like(f'%{search}%'))
+            if sharding.enabled():
+                # Scatter to every shard and merge the pages in id order
+                posts = sharding.gather_page(query, Post.id, page, per_page)
+            else:
+                posts = query.paginate(page=page, per_page=per_page, error_out=False).items
             
             # Serialize data with the desired fields
-            serialized_posts = []
-            for post in posts:
-                serialized_posts.append({
-                    'content': post.content,
-                    'id': post.id,
-                    'title': post.title,
-                    'user_id': post.user_id
-                })
-            
-            # Return JSON response
-            return jsonify(serialized_posts)
+            schema = post_list_schema if fields == POST_LIST_FIELDS else projected_schema(PostSchema, fields, many=True)
+            return jsonify(schema.dump(posts))
         except SQLAlchemyError as e:
             return jsonify({"error": str(e)}), 500
 
+    @app.route('/posts/suggest', methods=["GET"])
+    @limiter.limit("120 per minute", key_func=get_remote_address)
+    def suggest_posts():
+        """
+        Title autocomplete from the in-memory prefix index; no database access.
+        """
+        query = request.args.get('q', '', type=str)
+        limit = min(max(request.args.get('limit', 10, type=int), 1), app.config['SUGGEST_MAX_RESULTS'])
+        return jsonify(suggest(query, limit))
+
+    @app.route('/posts/trending', methods=["GET"])
+    @limiter.limit("60 per minute", key_func=get_remote_address)
+    def trending_posts_view():
+        """
+        Posts with the most views and comments over the trending window.
+        """
+        limit = min(max(request.args.get('limit', 10, type=int), 1), app.config['TRENDING_TOP_K'])
+        top = trending_posts(limit)
+
+        # One IN (...) query for the K summaries; deleted posts drop out
+        summaries = {
+            data['id']: data for data in post_list_schema.dump(
+                Post.query.options(*projection_options(Post, POST_LIST_FIELDS))
+                .filter(Post.id.in_([entry['post_id'] for entry in top]))
+            )
+        }
+        return jsonify([
+            dict(summaries[entry['post_id']], views=entry['views'], comments=entry['comments'], score=entry['score'])
+            for entry in top if entry['post_id'] in summaries
+        ])
+
+    @app.route('/posts/mget', methods=["POST"])
+    @limiter.limit("30 per minute", key_func=get_remote_address)
+    def mget_posts():
+        if not request.is_json:
+            return {"error": "Request body must be application/json"}, 400  # Bad Request
+
+        ids = request.json.get('ids') if isinstance(request.json, dict) else None
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            return {"error": "ids must be a list of integers"}, 400  # Bad Request
+        if len(ids) > app.config['MGET_MAX_IDS']:
+            return {"error": f"At most {app.config['MGET_MAX_IDS']} ids per request"}, 400  # Bad Request
+
+        # Cached posts, then every miss with a single IN (...) query
+        found = load_posts(ids)
+
+        # Keep the request order; ids that don't exist come back as null
+        return jsonify([found.get(post_id) for post_id in ids])
+
     @app.route('/comments', methods=["POST"])
     @token_auth.login_required
     @limiter.limit("10 per minute", key_func=get_remote_address)
@@ -266,17 +403,32 @@ def init_app(app):
             post_id = comment_data.get('post_id')
             if not post_id:
                 return {"error": "Post ID is required"}, 400  # Bad Request
+
+            # Writing to an archived thread brings it back to the hot table first
+            thaw_post(post_id)
+
+            # Replies must belong to the same post as their parent
+            parent_id = comment_data.get('parent_id')
+            if parent_id is not None:
+                parent = db.session.get(Comment, parent_id)
+                if parent is None or parent.post_id != post_id:
+                    return {"error": "Parent comment not found on this post"}, 400  # Bad Request
+                if parent.depth + 1 > MAX_COMMENT_DEPTH:
+                    return {"error": "Reply nesting is too deep"}, 400  # Bad Request
             
-            # Create the new comment
+            # Create the new comment (its thread path is set on insert)
             new_comment = Comment(
                 content=comment_data['content'],
                 user_id=logged_in_user.id,
-                post_id=post_id
+                post_id=post_id,
+                parent_id=parent_id
             )
             db.session.add(new_comment)
-            db.session.commit()
+            group_commit.commit()
 
             serialized_comment = comment_schema.dump(new_comment)
+            broker.publish(comment_channel(post_id), {'id': new_comment.id, 'data': serialized_comment})
+            record_comment(post_id)
             return jsonify(serialized_comment), 201  # Created
 
 
@@ -285,18 +437,24 @@ def init_app(app):
 
     @app.route('/comments/<int:id>', methods=["GET"])
     @token_auth.login_required
-    @cache.cached(timeout=60)
+    @with_included('author', 'post')
+    @single_flight_cached(timeout=60, query_string=True)
     def get_comment(id):
-        comment = Comment.query.get_or_404(id)
-        comment_data = comment_schema.dump(comment)
-        return jsonify(comment_data)
+        try:
+            fields = parse_fields(comment_schema)
+        except ValidationError as err:
+            return err.messages, 400
+        # Falls through to the archive for comments on inactive posts
+        comment = get_comment_or_404(id, fields)
+        schema = comment_schema if fields is None else projected_schema(CommentSchema, fields)
+        return jsonify(schema.dump(comment))
 
     @app.route('/comments/<int:id>', methods=["PUT"])
     @token_auth.login_required
     @limiter.limit("10 per minute", key_func=get_remote_address)
     def update_comment(id):
         logged_in_user = token_auth.current_user()
-        comment = Comment.query.get_or_404(id)
+        comment = get_hot_comment_or_404(id)
         
         if comment.user_id != logged_in_user.id:
             return jsonify({"error": "Unauthorized"}), 401
@@ -305,6 +463,8 @@ def init_app(app):
             data = request.json
             # Load the data into the schema, but without updating the instance
             loaded_data = comment_schema.load(data, partial=True)
+            if 'parent_id' in loaded_data or 'post_id' in loaded_data:
+                return jsonify({"error": "Comments cannot be moved"}), 400
             
             # Update the comment instance with the loaded data
             for key, value in loaded_data.items():
@@ -325,9 +485,114 @@ def init_app(app):
     @limiter.limit("10 per minute", key_func=get_remote_address)
     def delete_comment(id):
         logged_in_user = token_auth.current_user()
-        comment = Comment.query.get_or_404(id)
+        comment = get_hot_comment_or_404(id)
         if comment.user_id != logged_in_user.id:
             return {"error": "Unauthorized"}, 401
-        db.session.delete(comment)
-        db.session.commit()
+        # Deleting a comment takes its replies with it; each gets its own change log entry
+        low, high = Comment.subtree_bounds(comment.path)
+        delete_in_chunks(Comment, (Comment.path >= low) & (Comment.path < high), record='comment')
         return '', 204
+
+    @app.route('/changes', methods=["GET"])
+    @token_auth.login_required
+    @limiter.limit("60 per minute", key_func=get_remote_address)
+    def list_changes():
+        """
+        Users, posts and comments changed after ``since``, in order, for
+        clients that keep a local copy: call again with ``next_since``
+        while ``has_more`` is true.
+        """
+        since = request.args.get('since', 0, type=int)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), app.config['CHANGES_MAX_LIMIT'])
+        return jsonify(changes_since(since, limit))
+
+    @app.route('/posts/<int:id>/comments/stream', methods=["GET"])
+    @token_auth.login_required
+    def stream_post_comments(id):
+        model = comment_model_or_404(id)
+        last_id = request.headers.get('Last-Event-ID', type=int)
+
+        # Subscribe before reading the backlog so nothing falls in between
+        subscription = broker.subscribe(comment_channel(id))
+        backlog = []
+        if last_id is not None:
+            try:
+                missed = missed_comments_query(model, id, last_id).limit(app.config['SSE_BACKLOG_LIMIT'])
+                backlog = comments_schema.dump(missed)
+            except BaseException:
+                broker.unsubscribe(subscription)
+                raise
+        # Comments published since subscribing may be in the backlog too
+        resent = {data['id'] for data in backlog}
+        keepalive = app.config['SSE_KEEPALIVE_SECONDS']
+
+        # The generator needs no request context, so the database session is
+        # released as soon as this view returns, however long the stream lasts
+        def events():
+            try:
+                for data in backlog:
+                    yield format_sse(data['id'], data)
+                while True:
+                    pending = subscription.wait(keepalive)
+                    if subscription.lagged:
+                        # Dropped events: end the stream, the client resumes from its last event
+                        return
+                    if not pending:
+                        yield ': keepalive\n\n'
+                    for event in pending:
+                        if event['id'] not in resent:
+                            yield format_sse(event['id'], event['data'])
+            finally:
+                broker.unsubscribe(subscription)
+
+        response = Response(events(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # A generator that never starts (HEAD, a rejected /batch sub-request) never
+        # reaches its finally; closing the response releases the subscription too
+        response.call_on_close(lambda: broker.unsubscribe(subscription))
+        return response
+
+    @app.route('/comments/<int:id>/thread', methods=["GET"])
+    @token_auth.login_required
+    @with_included('author', 'post')
+    def get_comment_thread(id):
+        root = get_comment_or_404(id)
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 50, type=int)
+        max_depth = request.args.get('depth', app.config['THREAD_MAX_DEPTH'], type=int)
+
+        comments, has_next = fetch_page(subtree_query(root, max_depth), page, per_page)
+        return jsonify({
+            'items': build_tree(comments, comments_schema.dump(comments)),
+            'page': page,
+            'per_page': per_page,
+            'has_next': has_next
+        })
+
+    @app.route('/posts/<int:id>/comments', methods=["GET"])
+    @token_auth.login_required
+    @with_included('author', 'post')
+    def list_post_comments(id):
+        # A post's comments are either all hot or all archived
+        model = comment_model_or_404(id)
+        page = request.args.get('page', 1, type=int)
+        per_page = request.args.get('per_page', 50, type=int)
+        tree = request.args.get('tree', 0, type=int)
+
+        query = model.query.filter_by(post_id=id)
+        if tree:
+            # Whole threads in depth-first order from the (post_id, path) index
+            max_depth = request.args.get('depth', app.config['THREAD_MAX_DEPTH'], type=int)
+            query = query.filter(model.depth <= max_depth).order_by(model.path)
+        else:
+            # Ids from sharded allocation aren't in creation order
+            query = query.order_by(model.date_posted, model.id)
+
+        comments, has_next = fetch_page(query, page, per_page)
+        serialized = comments_schema.dump(comments)
+        return jsonify({
+            'items': build_tree(comments, serialized) if tree else serialized,
+            'page': page,
+            'per_page': per_page,
+            'has_next': has_next
+        })
@@ -11,15 +11,17 @@ class PostSchema(Schema):
     id = fields.Int(dump_only=True)
     title = fields.Str()
     content = fields.Str()
-    date_posted = fields.DateTime(dump_only=True)
-    author = fields.Nested(UserSchema, only=['id', 'username'])
+    excerpt = fields.Str(dump_only=True)
+    user_id = fields.Int(dump_only=True)
 
 class CommentSchema(Schema):
     id = fields.Int(dump_only=True)
     content = fields.Str(required=True)
     date_posted = fields.DateTime(dump_only=True)
     post_id = fields.Int(required=True)
-    author = fields.Nested(UserSchema, only=['id', 'username'])
+    parent_id = fields.Int(allow_none=True)
+    depth = fields.Int(dump_only=True)
+    user_id = fields.Int(dump_only=True)
     post = fields.Nested(PostSchema, only=['id', 'title'])
 
 # Create instances of the schemas for different use cases
@@ -0,0 +1,255 @@
+"""
+Horizontal sharding of posts and their comments.
+
+With ``SHARD_DATABASE_URIS`` set, posts, post bodies and comments live on
+``shard0`` ... ``shardN-1`` while users, jobs and everything else stay in
+the main ("global") database. A post goes to its author's shard
+(``user_id % N``); its body and comments follow it, so a thread is always
+read from one database.
+
+Ids encode the shard: ``id = seq * N + shard``, with ``seq`` handed out in
+blocks from the global ``id_blocks`` table, so they are unique across
+shards and any post or comment id routes on its own. Resharding (changing
+N) is not supported.
+
+The session class is chosen at import time, so an unsharded deployment
+keeps Flask-SQLAlchemy's plain session with no routing overhead.
+"""
+import threading
+
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import MetaData, event, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter, BooleanClauseList
+from sqlalchemy.sql.schema import Column, Table
+from sqlalchemy.sql.util import find_tables
+
+from config import Config
+
+
+SHARD_COUNT = len(Config.SHARD_DATABASE_URIS)
+SHARD_IDS = [f'shard{i}' for i in range(SHARD_COUNT)]
+SHARDED_TABLES = frozenset({'posts', 'post_bodies', 'comments'})
+# Columns whose value alone tells which shard holds the row
+ROUTING_COLUMNS = frozenset({
+    ('posts', 'id'), ('posts', 'user_id'), ('post_bodies', 'post_id'), ('comments', 'id'), ('comments', 'post_id'),
+})
+
+
+def enabled():
+    return SHARD_COUNT > 0
+
+
+def shard_for(key):
+    """
+    Return the shard of a post or comment id (or of a post's author id).
+    """
+    return SHARD_IDS[key % SHARD_COUNT]
+
+
+def _bind_name(table):
+    return table.metadata.info.get('bind_key') or 'global'
+
+
+class IdAllocator:
+    """
+    Hands out sequence numbers per table from blocks reserved in the
+    ``id_blocks`` table, one short transaction per ``block_size`` ids.
+
+    Each process draws from its own block, so ids are unique but don't
+    follow creation order: comments are ordered by ``date_posted``.
+    """
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def next(self, engine, name):
+        with self._lock:
+            current, end = self._blocks.get(name, (0, 0))
+            if current >= end:
+                current, end = self._reserve(engine, name)
+            self._blocks[name] = (current + 1, end)
+            return current
+
+    def _reserve(self, engine, name):
+        from models import IdBlock
+        table = IdBlock.__table__
+        while True:
+            try:
+                with engine.begin() as connection:
+                    # The row lock taken by the UPDATE keeps the block ours until commit
+                    if connection.execute(update(table).where(table.c.name == name)
+                                          .values(next_value=table.c.next_value + self.block_size)).rowcount:
+                        end = connection.scalar(select(table.c.next_value).where(table.c.name == name))
+                        return end - self.block_size, end
+                    connection.execute(insert(table).values(name=name, next_value=1 + self.block_size))
+                    return 1, 1 + self.block_size
+            except IntegrityError:
+                # Another process created the row first; take the next block from it
+                continue
+
+    def reset(self):
+        """
+        Forget reserved blocks, so a forked worker never reuses its parent's ids.
+        """
+        with self._lock:
+            self._blocks.clear()
+
+
+allocator = IdAllocator(Config.ID_BLOCK_SIZE)
+
+
+def _assign_ids(session, flush_context, instances):
+    # Rows are routed by id, so new posts and comments need theirs before the INSERT
+    engine = session.get_bind(shard_id='global')
+    for obj in session.new:
+        table = obj.__table__.name
+        if table == 'posts' and obj.id is None:
+            obj.id = allocator.next(engine, 'posts') * SHARD_COUNT + obj.user_id % SHARD_COUNT
+            if obj.body is not None:
+                obj.body.post_id = obj.id
+        elif table == 'comments' and obj.id is None:
+            obj.id = allocator.next(engine, 'comments') * SHARD_COUNT + obj.post_id % SHARD_COUNT
+
+
+def choose_shard(mapper, instance, clause=None, **kw):
+    """
+    Shard an object is written to.
+    """
+    if mapper is None:
+        return 'global'
+    table = mapper.local_table
+    if table.name not in SHARDED_TABLES:
+        return _bind_name(table)
+    key = None
+    if instance is not None:
+        key = instance.post_id if table.name == 'post_bodies' else instance.id
+    if key is None:
+        raise ValueError(f'Cannot choose a shard for {mapper.class_.__name__} without its id')
+    return shard_for(key)
+
+
+def identity_shards(mapper, primary_key, **kw):
+    """
+    Shards to look in for a primary key (session.get, lazy loads).
+    """
+    table = mapper.local_table
+    return [shard_for(primary_key[0])] if table.name in SHARDED_TABLES else [_bind_name(table)]
+
+
+def _shards_from_criteria(statement):
+    """
+    Narrow a statement to the shards named by an ``=`` or ``IN`` comparison
+    on a routing column in its top-level WHERE conjunction, or return None.
+    """
+    where = getattr(statement, 'whereclause', None)
+    if where is None:
+        return None
+    clauses = where.clauses if isinstance(where, BooleanClauseList) and where.operator is operators.and_ else (where,)
+    for clause in clauses:
+        if not (isinstance(clause, BinaryExpression) and isinstance(clause.left, Column)
+                and isinstance(clause.right, BindParameter)):
+            continue
+        if (clause.left.table.name, clause.left.name) not in ROUTING_COLUMNS:
+            continue
+        value = clause.right.effective_value
+        if clause.operator is operators.eq and isinstance(value, int):
+            return [shard_for(value)]
+        if (clause.operator is operators.in_op and isinstance(value, (list, tuple))
+                and all(isinstance(item, int) for item in value)):
+            # An empty IN () matches nothing; any one shard can say so
+            return sorted({shard_for(item) for item in value}) or SHARD_IDS[:1]
+    return None
+
+
+def execute_shards(orm_context):
+    """
+    Shards a statement runs on: the one its criteria name, or all of them.
+    Results from several shards are concatenated.
+    """
+    statement = orm_context.statement
+    tables = [table for table in find_tables(statement, include_crud=True) if isinstance(table, Table)]
+    if not any(table.name in SHARDED_TABLES for table in tables):
+        return [_bind_name(tables[0]) if tables else 'global']
+    if orm_context.is_insert:
+        raise ValueError('Insert into sharded tables with the ORM or on a shard connection (see bind_arguments)')
+    return _shards_from_criteria(statement) or SHARD_IDS
+
+
+class ShardRoutingSession(ShardedSession, FlaskSession):
+    """
+    Flask-SQLAlchemy session that routes sharded tables by id and
+    everything else by its bind key.
+    """
+
+    def __init__(self, db, **kwargs):
+        shards = {'global' if key is None else key: engine for key, engine in db.engines.items()}
+        super().__init__(shard_chooser=choose_shard, identity_chooser=identity_shards,
+                         execute_chooser=execute_shards, shards=shards, db=db, **kwargs)
+        event.listen(self, 'before_flush', _assign_ids)
+
+
+def session_options():
+    """
+    Options for the SQLAlchemy extension: the routing session when sharded.
+    """
+    return {'class_': ShardRoutingSession} if enabled() else {}
+
+
+def bind_arguments(model, post_id):
+    """
+    Bind arguments reaching the database that holds ``post_id``'s rows of ``model``.
+    """
+    arguments = {'mapper': model.__mapper__}
+    if enabled() and model.__table__.name in SHARDED_TABLES:
+        arguments['shard_id'] = shard_for(post_id)
+    return arguments
+
+
+def gather_page(query, order_by, page, per_page):
+    """
+    Fetch one page of ``query`` across all shards.
+
+    Every shard returns its first ``page * per_page`` rows in ``order_by``
+    order; the merged rows are sorted and sliced, so deep pages cost more.
+    """
+    page = max(page, 1)
+    rows = query.order_by(order_by).limit(page * per_page).all()
+    rows.sort(key=lambda row: getattr(row, order_by.key))
+    return rows[(page - 1) * per_page:page * per_page]
+
+
+def _shard_metadata(metadata):
+    """
+    Copy the sharded tables without their foreign keys to global tables,
+    which don't exist on the shards.
+    """
+    shard_metadata = MetaData()
+    for table in metadata.sorted_tables:
+        if table.name not in SHARDED_TABLES:
+            continue
+        copy = table.to_metadata(shard_metadata)
+        for constraint in list(copy.foreign_key_constraints):
+            if constraint.elements[0].target_fullname.split('.')[0] not in SHARDED_TABLES:
+                copy.constraints.discard(constraint)
+                for element in constraint.elements:
+                    element.parent.foreign_keys.discard(element)
+                    copy.foreign_keys.discard(element)
+    return shard_metadata
+
+
+def init_app(app):
+    """
+    Create the sharded tables on every shard.
+    """
+    if not enabled():
+        return
+    db = app.extensions['sqlalchemy']
+    with app.app_context():
+        metadata = _shard_metadata(db.metadata)
+        for shard_id in SHARD_IDS:
+            metadata.create_all(db.engines[shard_id])
@@ -0,0 +1,319 @@
+"""
+Read-only, memory-mapped snapshot of posts for anonymous reads.
+
+A builder periodically exports every post to one file: a header, fixed-width
+arrays of post ids and byte offsets, and pre-encoded JSON, both the
+get_post payload and the list_posts item of each post. Workers map the file
+read-only, so they all share one copy through the page cache, and answer
+anonymous ``GET /posts/<id>`` and ``GET /posts`` from it without touching
+SQLAlchemy.
+
+Layout (native byte order; the file never leaves the machine)::
+
+    header   magic, version, build start time, post count
+    ids      count x int64, ascending
+    posts    (count + 1) x int64 file offsets of the get_post payloads
+    items    (count + 1) x int64 file offsets of the list items
+    blobs    payloads, then list items each followed by a comma, so a
+             page is one contiguous slice
+
+A snapshot older than ``SNAPSHOT_MAX_AGE`` is not served. Posts written
+since the build are published on ``POSTS_CHANNEL``; they, and every list
+page once any post changed, are served from the database until the next
+snapshot.
+"""
+import fcntl
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from functools import wraps
+
+from flask import current_app, request
+from sqlalchemy.orm import selectinload
+
+from models import Post
+from pubsub import broker
+from schemas import PostSchema
+
+
+# Post writes, so every worker stops serving the affected entries from its mapping
+POSTS_CHANNEL = 'posts:changed'
+
+MAGIC = b'BLOGSNAP'
+VERSION = 1
+HEADER = struct.Struct('=8sIxxxxdq')
+OFFSET_SIZE = array('q').itemsize
+SEPARATORS = (',', ':')  # the compact separators jsonify uses
+
+
+class Snapshot:
+    """
+    One mapped snapshot file.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.built_at, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} post snapshot')
+        # Views into the mapping; the mmap is unmapped once the last of them is dropped
+        view = memoryview(self._map)
+        start = HEADER.size
+        self._ids = view[start:start + self.count * OFFSET_SIZE].cast('q')
+        start += self.count * OFFSET_SIZE
+        self._posts = view[start:start + (self.count + 1) * OFFSET_SIZE].cast('q')
+        start += (self.count + 1) * OFFSET_SIZE
+        self._items = view[start:start + (self.count + 1) * OFFSET_SIZE].cast('q')
+
+    def post(self, post_id):
+        """
+        The get_post payload of a post, or None if it isn't in the snapshot.
+        """
+        i = bisect_left(self._ids, post_id)
+        if i == self.count or self._ids[i] != post_id:
+            return None
+        return self._map[self._posts[i]:self._posts[i + 1]]
+
+    def page(self, page, per_page):
+        """
+        A page of list items in id order, as a JSON array.
+        """
+        start = min((page - 1) * per_page, self.count)
+        end = min(start + per_page, self.count)
+        if start == end:
+            return b'[]'
+        # Drop the comma after the last item
+        return b'[' + self._map[self._items[start]:self._items[end] - 1] + b']'
+
+
+def build_snapshot(path, chunk_size=1000):
+    """
+    Export every post to a new snapshot at ``path``, replacing the old one
+    atomically. Returns the number of posts written.
+    """
+    from routes import POST_LIST_FIELDS  # routes serves through this module
+    post_schema = PostSchema()
+    item_schema = PostSchema(only=POST_LIST_FIELDS)
+    dumps = current_app.json.dumps
+    built_at = time.time()
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    ids, post_offsets, item_offsets = array('q'), array('q', [0]), array('q', [0])
+    with tempfile.TemporaryFile(dir=directory) as posts, tempfile.TemporaryFile(dir=directory) as items:
+        last_id = 0
+        while True:
+            # Keyset pages in id order; with sharding each shard returns its
+            # first rows after last_id and the merged smallest are the next page
+            rows = Post.query.options(selectinload(Post.body)).filter(Post.id > last_id) \
+                .order_by(Post.id).limit(chunk_size).all()
+            rows.sort(key=lambda row: row.id)
+            rows = rows[:chunk_size]
+            if not rows:
+                break
+            for post in rows:
+                ids.append(post.id)
+                post_offsets.append(post_offsets[-1] + posts.write(dumps(post_schema.dump(post), separators=SEPARATORS).encode()))
+                item_offsets.append(item_offsets[-1] + items.write(dumps(item_schema.dump(post), separators=SEPARATORS).encode() + b','))
+            last_id = rows[-1].id
+
+        count = len(ids)
+        posts_start = HEADER.size + (3 * count + 2) * OFFSET_SIZE
+        items_start = posts_start + post_offsets[-1]
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                out.write(HEADER.pack(MAGIC, VERSION, built_at, count))
+                ids.tofile(out)
+                array('q', (posts_start + offset for offset in post_offsets)).tofile(out)
+                array('q', (items_start + offset for offset in item_offsets)).tofile(out)
+                for blobs in (posts, items):
+                    blobs.seek(0)
+                    shutil.copyfileobj(blobs, out)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return count
+
+
+class SnapshotReader:
+    """
+    A worker's view of the snapshot file: remapped when a new one appears,
+    with the posts changed since it was built left to the database.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.path = app.config['SNAPSHOT_PATH']
+        self.max_age = app.config.get('SNAPSHOT_MAX_AGE', 300)
+        self.check_interval = app.config.get('SNAPSHOT_CHECK_INTERVAL', 1.0)
+        self.build_interval = app.config.get('SNAPSHOT_BUILD_INTERVAL', 60)
+        self.subscription = broker.subscribe(POSTS_CHANNEL)
+        self.snapshot = None
+        self._checked_at = 0.0
+        self._changed = {}  # post id -> time of its last change
+        self._lists_changed_at = 0.0
+        self._invalid_before = 0.0
+        self._lock = threading.Lock()
+        self._builder = None
+
+    def _load(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.snapshot = None
+            return
+        current = self.snapshot
+        if current is not None and (current.stat.st_ino, current.stat.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+            return
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError):
+            self.app.logger.exception('Could not map the post snapshot')
+            self.snapshot = None
+            return
+        # Changes from before the build started are in it; later ones may not be
+        self._changed = {post_id: at for post_id, at in self._changed.items() if at >= snapshot.built_at}
+        self.snapshot = snapshot
+
+    def refresh(self):
+        """
+        Apply published changes and pick up a new snapshot file; returns the
+        snapshot to serve from, or None.
+        """
+        with self._lock:
+            now = time.time()
+            if self.subscription.lagged:
+                # Changes were missed; serve nothing from snapshots built before now
+                self.subscription.lagged = False
+                self._invalid_before = now
+            for event in self.subscription.wait(0):
+                self._changed[event['id']] = now
+                self._lists_changed_at = now
+            if time.monotonic() - self._checked_at >= self.check_interval:
+                self._checked_at = time.monotonic()
+                self._load()
+                if self.build_interval:
+                    self._start_builder()
+            snapshot = self.snapshot
+            if snapshot is None or snapshot.built_at < self._invalid_before or now - snapshot.built_at > self.max_age:
+                return None
+            return snapshot
+
+    def post(self, post_id):
+        snapshot = self.refresh()
+        if snapshot is None or post_id in self._changed:
+            return None
+        return snapshot.post(post_id)
+
+    def page(self, page, per_page):
+        snapshot = self.refresh()
+        if snapshot is None or self._lists_changed_at >= snapshot.built_at:
+            return None
+        return snapshot.page(page, per_page)
+
+    def _start_builder(self):
+        # Started on first use, so a worker forked from a preloaded app runs its own
+        if self._builder is None or not self._builder.is_alive():
+            self._builder = threading.Thread(target=self._run_builder, name='snapshot-builder', daemon=True)
+            self._builder.start()
+
+    def _run_builder(self):
+        """
+        Rebuild the snapshot every ``SNAPSHOT_BUILD_INTERVAL`` seconds. Every
+        worker runs one; a file lock lets only one of them build at a time.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock:
+            while True:
+                try:
+                    age = time.time() - os.stat(self.path).st_mtime
+                except FileNotFoundError:
+                    age = self.build_interval
+                if age >= self.build_interval:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        pass  # another worker is building
+                    else:
+                        try:
+                            with self.app.app_context():
+                                build_snapshot(self.path)
+                        except Exception:
+                            self.app.logger.exception('Building the post snapshot failed')
+                        finally:
+                            fcntl.flock(lock, fcntl.LOCK_UN)
+                        age = 0
+                time.sleep(max(self.build_interval - age, self.check_interval))
+
+
+def post_changed(post_id):
+    """
+    Publish a post write, so every worker serves that post and the list
+    pages from the database until the next snapshot.
+    """
+    if 'snapshot' in current_app.extensions:
+        broker.publish(POSTS_CHANNEL, {'id': post_id})
+
+
+def _serve(lookup):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            reader = current_app.extensions.get('snapshot')
+            # Only anonymous reads: a client with a token may expect to read its own writes.
+            # Cache warmup renders the views themselves, and starts no builder in a preloading master
+            if reader is not None and 'Authorization' not in request.headers and not request.environ.get('blog.warmup'):
+                body = lookup(reader, **kwargs)
+                if body is not None:
+                    return current_app.response_class(body + b'\n', mimetype='application/json')
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def _post_lookup(reader, id):
+    # ?fields= and ?include= responses aren't in the snapshot
+    return None if request.args else reader.post(id)
+
+
+def _page_lookup(reader):
+    if set(request.args) - {'page', 'per_page'}:
+        return None
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
+    if page < 1 or per_page < 1:
+        return None  # paginate's own handling of these applies
+    return reader.page(page, per_page)
+
+
+# Serve get_post and list_posts from the snapshot when possible
+snapshot_post = _serve(_post_lookup)
+snapshot_posts = _serve(_page_lookup)
+
+
+def init_app(app):
+    """
+    Serve anonymous post reads from the snapshot when ``SNAPSHOT_ENABLED``,
+    and register the ``flask build-snapshot`` command.
+    """
+    if not app.config.get('SNAPSHOT_PATH'):
+        app.config['SNAPSHOT_PATH'] = os.path.join(app.instance_path, 'posts.snapshot')
+    if app.config.get('SNAPSHOT_ENABLED', False):
+        app.extensions['snapshot'] = SnapshotReader(app)
+
+    @app.cli.command('build-snapshot')
+    def run_build():
+        """Export all posts to the read-only snapshot file."""
+        print(f"Wrote {build_snapshot(app.config['SNAPSHOT_PATH'])} posts to {app.config['SNAPSHOT_PATH']}")
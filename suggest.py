@@ -0,0 +1,241 @@
+import logging
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+
+from flask import current_app
+from sqlalchemy import select
+
+from extensions import db
+from models import Post
+from pubsub import broker
+
+
+logger = logging.getLogger(__name__)
+
+# Title changes published by the write routes, applied by every worker's index
+TITLES_CHANNEL = 'posts:titles'
+
+_NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize(text):
+    """
+    Case-fold, strip accents and punctuation and collapse whitespace, so
+    "Café au Lait!" and "cafe au lait" index and match alike.
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+
+class PrefixIndex:
+    """
+    Prefix index over normalized post titles.
+
+    Two sorted arrays of keys, each paired with a compact array of post
+    ids: whole titles, and the rest of the title from each later word, so
+    "world" finds "Hello World". A lookup is a binary search plus a scan of
+    the matching entries, and updates are a bisect and a memmove.
+    Keys are cut to ``max_key_length`` characters to bound memory; longer
+    queries are checked against the full title.
+    """
+
+    def __init__(self, max_key_length=40):
+        self.max_key_length = max_key_length
+        self.built_at = 0.0
+        self._titles = {}  # post id -> (title, normalized title)
+        self._starts = ([], array('q'))
+        self._words = ([], array('q'))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._titles)
+
+    def _keys(self, normalized):
+        starts = [normalized[:self.max_key_length]]
+        words = [normalized[i + 1:i + 1 + self.max_key_length]
+                 for i, ch in enumerate(normalized) if ch == ' ']
+        return starts, words
+
+    def build(self, rows):
+        """
+        Replace the whole index with ``(post_id, title)`` rows.
+        """
+        titles, starts, words = {}, [], []
+        for post_id, title in rows:
+            normalized = normalize(title or '')
+            if not normalized:
+                continue
+            titles[post_id] = (title, normalized)
+            start_keys, word_keys = self._keys(normalized)
+            starts += ((key, post_id) for key in start_keys)
+            words += ((key, post_id) for key in word_keys)
+        starts.sort()
+        words.sort()
+        with self._lock:
+            self._titles = titles
+            self._starts = ([key for key, _ in starts], array('q', (post_id for _, post_id in starts)))
+            self._words = ([key for key, _ in words], array('q', (post_id for _, post_id in words)))
+            self.built_at = time.monotonic()
+
+    @staticmethod
+    def _insert(segment, key, post_id):
+        keys, ids = segment
+        i = bisect_right(keys, key)
+        keys.insert(i, key)
+        ids.insert(i, post_id)
+
+    @staticmethod
+    def _delete(segment, key, post_id):
+        keys, ids = segment
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            if ids[i] == post_id:
+                del keys[i]
+                del ids[i]
+                return
+            i += 1
+
+    def update(self, post_id, title):
+        """
+        Index a post under its (new) title, or drop it when ``title`` is None.
+        """
+        with self._lock:
+            previous = self._titles.pop(post_id, None)
+            if previous is not None:
+                start_keys, word_keys = self._keys(previous[1])
+                for key in start_keys:
+                    self._delete(self._starts, key, post_id)
+                for key in word_keys:
+                    self._delete(self._words, key, post_id)
+            normalized = normalize(title or '')
+            if not normalized:
+                return
+            self._titles[post_id] = (title, normalized)
+            start_keys, word_keys = self._keys(normalized)
+            for key in start_keys:
+                self._insert(self._starts, key, post_id)
+            for key in word_keys:
+                self._insert(self._words, key, post_id)
+
+    def search(self, query, limit=10):
+        """
+        Posts whose title, or a word of it onwards, starts with ``query``:
+        title matches first, each group in alphabetical order.
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        key = prefix[:self.max_key_length]
+        results, seen = [], set()
+        with self._lock:
+            for keys, ids in (self._starts, self._words):
+                i = bisect_left(keys, key)
+                while i < len(keys) and len(results) < limit and keys[i].startswith(key):
+                    post_id = ids[i]
+                    i += 1
+                    if post_id in seen:
+                        continue
+                    title, normalized = self._titles[post_id]
+                    if len(prefix) > self.max_key_length and ' ' + prefix not in ' ' + normalized:
+                        continue
+                    seen.add(post_id)
+                    results.append({'id': post_id, 'title': title})
+        return results
+
+
+class SuggestIndex:
+    """
+    A worker's prefix index, kept current from the title change channel.
+
+    Changes made by any worker arrive through the pub/sub bridge and are
+    applied before each lookup. Every ``SUGGEST_REBUILD_INTERVAL`` seconds,
+    and whenever changes were missed, a background thread rebuilds the
+    index from the database (picking up bulk deletes the routes don't
+    publish) and swaps it in; lookups keep using the old one meanwhile.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.max_key_length = app.config.get('SUGGEST_MAX_KEY_LENGTH', 40)
+        self.rebuild_interval = app.config.get('SUGGEST_REBUILD_INTERVAL', 600)
+        self.index = PrefixIndex(self.max_key_length)
+        self.subscription = broker.subscribe(TITLES_CHANNEL)
+        # One thread applies changes at a time, so they land in publish order
+        self._lock = threading.Lock()
+        self._rebuild_due = 0.0
+        self._rebuilding = False
+        self._replay = None  # changes applied while a rebuild scans, replayed onto its result
+
+    def rebuild(self):
+        """
+        Build a new index from the database and swap it in.
+        """
+        with self._lock:
+            self.subscription.lagged = False
+            self._rebuild_due = time.monotonic() + self.rebuild_interval
+            self._replay = []
+        index = PrefixIndex(self.max_key_length)
+        try:
+            index.build(db.session.execute(select(Post.id, Post.title)))
+        finally:
+            with self._lock:
+                replay, self._replay = self._replay, None
+        with self._lock:
+            # A change the scan already saw is applied again, which is harmless
+            for event in replay:
+                index.update(event['id'], event.get('title'))
+            self.index = index
+
+    def _run_rebuild(self):
+        try:
+            with self.app.app_context():
+                self.rebuild()
+        except Exception:
+            logger.exception('Rebuilding the title index failed')
+        finally:
+            self._rebuilding = False
+
+    def refresh(self):
+        with self._lock:
+            if not self._rebuilding and (self.subscription.lagged or time.monotonic() >= self._rebuild_due):
+                # Not retried before the next interval if it fails, unless changes are missed again
+                self._rebuilding = True
+                self._rebuild_due = time.monotonic() + self.rebuild_interval
+                threading.Thread(target=self._run_rebuild, name='suggest-rebuild', daemon=True).start()
+            for event in self.subscription.wait(0):
+                self.index.update(event['id'], event.get('title'))
+                if self._replay is not None:
+                    self._replay.append(event)
+
+    def search(self, query, limit):
+        self.refresh()
+        return self.index.search(query, limit)
+
+
+def title_changed(post_id, title):
+    """
+    Publish a post's new title (None once deleted) to every worker's index.
+    """
+    if 'suggest' in current_app.extensions:
+        broker.publish(TITLES_CHANNEL, {'id': post_id, 'title': title})
+
+
+def suggest(query, limit=10):
+    index = current_app.extensions.get('suggest')
+    return index.search(query, limit) if index is not None else []
+
+
+def init_app(app):
+    """
+    Build the title index at startup (before workers fork, when preloaded).
+    """
+    if not app.config.get('SUGGEST_ENABLED', True):
+        return
+    index = app.extensions['suggest'] = SuggestIndex(app)
+    with app.app_context():
+        index.rebuild()
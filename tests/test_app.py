@@ -1,8 +1,14 @@
+import threading
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 from app import create_app, db
-from models import User, Post, Comment
+from caching import cache, _inflight, post_cache_key, seed_post_hits, get_version, POST_LIST_VERSION_KEY
+from warmup import warm_cache
+from models import User, Post, PostBody, Comment, Job, EXCERPT_LENGTH
+from jobs import enqueue, job_handler, run_pending_jobs
 from faker import Faker
+from sqlalchemy import event
 
 fake = Faker()
 
@@ -10,8 +16,11 @@ class TestBlogAPI(unittest.TestCase):
     def setUp(self):
         self.app = create_app()
         self.app.config["testing"] = True  # Pass 'testing' config
+        self.app.config["CACHE_WARMUP_AFTER_WRITE"] = False
+        self.app.config["JOBS_WORKER_ENABLED"] = False
         self.client = self.app.test_client()
         with self.app.app_context():
+            cache.clear()
             db.create_all()
     
     def tearDown(self):
@@ -372,3 +381,1514 @@ class TestBlogAPI(unittest.TestCase):
 
         response = self.client.delete(f'/comments/{comment_id}')
         self.assertEqual(response.status_code, 204)
+
+    # Caching
+    def test_get_post_serves_stale_copy_during_rebuild(self):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Old Title', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+
+        response = self.client.get(f'/posts/{post_id}')
+        self.assertEqual(response.json['title'], 'Old Title')
+
+        key = f'view//posts/{post_id}'
+        with self.app.app_context():
+            Post.query.get(post_id).title = 'New Title'
+            db.session.commit()
+            # Expire the entry and pretend another request is already rebuilding it
+            cached_response, delta, _ = cache.get(key)
+            cache.set(key, (cached_response, delta, time.time() - 1))
+        _inflight[key] = threading.Event()
+        try:
+            response = self.client.get(f'/posts/{post_id}')
+            self.assertEqual(response.json['title'], 'Old Title')
+        finally:
+            _inflight.pop(key).set()
+
+        response = self.client.get(f'/posts/{post_id}')
+        self.assertEqual(response.json['title'], 'New Title')
+
+    def test_list_posts_single_flight_under_concurrency(self):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Post(title='Test Post', content='Test Content', user_id=user.id))
+            db.session.commit()
+
+        import routes
+        calls = []
+        original_jsonify = routes.jsonify
+
+        def slow_jsonify(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.05)
+            return original_jsonify(*args, **kwargs)
+
+        results = []
+
+        def fetch():
+            results.append(self.app.test_client().get('/posts?page=1').status_code)
+
+        with patch('routes.jsonify', side_effect=slow_jsonify):
+            threads = [threading.Thread(target=fetch) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, [200] * 5)
+        self.assertEqual(len(calls), 1)
+
+    @patch('auth.decode_token')
+    def test_create_post_invalidates_list_pages(self, mock_decode_token):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        self.assertEqual(self.client.get('/posts').json, [])
+        self.client.post('/posts', json={"title": "Fresh Post", "content": "Test Content"})
+
+        response = self.client.get('/posts')
+        self.assertEqual([post['title'] for post in response.json], ['Fresh Post'])
+
+    def test_warm_cache_precomputes_hot_posts(self):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Hot Post', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+
+        seed_post_hits({post_id: 100})
+        warm_cache(self.app)
+
+        with self.app.app_context():
+            cached_response, _, _ = cache.get(post_cache_key(post_id))
+            self.assertEqual(cached_response.get_json()['title'], 'Hot Post')
+            self.assertIsNotNone(cache.get(f'view//posts?page=1#{get_version(POST_LIST_VERSION_KEY)}'))
+
+    def test_post_hits_skip_missing_posts_and_stay_bounded(self):
+        from caching import _post_hits, hot_post_ids
+        _post_hits.clear()
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Hot Post', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            post_id = post.id
+
+        for _ in range(3):
+            self.client.get(f'/posts/{post_id}')
+        for bogus_id in range(900000, 900010):
+            self.assertEqual(self.client.get(f'/posts/{bogus_id}').status_code, 404)
+        self.assertEqual(hot_post_ids(20), [post_id])
+
+        self.app.config['CACHE_HOT_POSTS_TRACKED'] = 4
+        seed_post_hits({n: 1 for n in range(1000, 1004)})
+        self.client.get(f'/posts/{post_id}')
+        # Over the bound, the busiest half is kept with halved counts
+        self.assertEqual(dict(_post_hits), {post_id: 2, 1000: 1})
+        _post_hits.clear()
+
+    def test_mget_posts_keeps_request_order(self):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            first = Post(title='First', content='Test Content', user_id=user.id)
+            second = Post(title='Second', content='Test Content', user_id=user.id)
+            db.session.add_all([first, second])
+            db.session.flush()
+            first_id, second_id = first.id, second.id
+            db.session.commit()
+
+        # Warm one of the two posts so the request mixes cache hits and misses
+        self.client.get(f'/posts/{first_id}')
+
+        response = self.client.post('/posts/mget', json={"ids": [second_id, 999, first_id, second_id]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post and post['title'] for post in response.json], ['Second', None, 'First', 'Second'])
+
+        with self.app.app_context():
+            cached_response, _, _ = cache.get(post_cache_key(second_id))
+            self.assertEqual(cached_response.get_json()['title'], 'Second')
+
+    def test_mget_posts_rejects_invalid_ids(self):
+        response = self.client.post('/posts/mget', json={"ids": "1,2"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_large_post_body_is_compressed_and_listed_as_excerpt(self):
+        body = 'word ' * 2000
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Long Post', content=body, user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+
+            stored = db.session.get(PostBody, post_id)
+            self.assertTrue(stored.compressed)
+            self.assertLess(len(stored.data), len(body))
+
+        response = self.client.get('/posts')
+        listed = response.json[0]
+        self.assertNotIn('content', listed)
+        self.assertLessEqual(len(listed['excerpt']), EXCERPT_LENGTH)
+        self.assertTrue(body.startswith(listed['excerpt'].rstrip('…')))
+
+        response = self.client.get(f'/posts/{post_id}')
+        self.assertEqual(response.json['content'], body)
+
+    @patch('auth.decode_token')
+    def test_migrations_upgrade_a_baseline_database(self, mock_decode_token):
+        import os
+        from flask_migrate import upgrade
+        from werkzeug.security import generate_password_hash
+        body = 'word ' * 300
+        with self.app.app_context():
+            # The schema the baseline models created, before any migration
+            db.drop_all()
+            for statement in (
+                'CREATE TABLE users (id INTEGER NOT NULL, name VARCHAR(255) NOT NULL, username VARCHAR(255) NOT NULL, '
+                'email VARCHAR(255) NOT NULL, password VARCHAR(255) NOT NULL, PRIMARY KEY (id), UNIQUE (username), '
+                'UNIQUE (email))',
+                'CREATE TABLE posts (id INTEGER NOT NULL, title VARCHAR(255) NOT NULL, content VARCHAR, '
+                'user_id INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(user_id) REFERENCES users (id))',
+                'CREATE TABLE comments (id INTEGER NOT NULL, content TEXT NOT NULL, date_posted DATETIME NOT NULL, '
+                'user_id INTEGER NOT NULL, post_id INTEGER NOT NULL, PRIMARY KEY (id), '
+                'FOREIGN KEY(user_id) REFERENCES users (id), FOREIGN KEY(post_id) REFERENCES posts (id))',
+            ):
+                db.session.execute(db.text(statement))
+            db.session.execute(db.text("INSERT INTO users VALUES (1, 'Test User', 'testuser', 'test@example.com', :password)"),
+                               {'password': generate_password_hash('testpass')})
+            db.session.execute(db.text("INSERT INTO posts (id, title, content, user_id) VALUES "
+                                       "(1, 'Short', 'Short body', 1), (2, 'Long', :body, 1), (3, 'Empty', NULL, 1)"),
+                               {'body': body})
+            db.session.execute(db.text("INSERT INTO comments VALUES "
+                                       "(1, 'First', '2020-01-01 00:00:00', 1, 1), (2, 'Second', '2020-01-02 00:00:00', 1, 1)"))
+            db.session.commit()
+            try:
+                upgrade(directory=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations'))
+                columns = {column['name'] for column in db.inspect(db.engine).get_columns('posts')}
+                self.assertNotIn('content', columns)
+                self.assertTrue(db.session.get(PostBody, 2).compressed)
+                self.assertIsNone(db.session.get(Post, 3).body)
+                self.assertEqual(set(db.metadata.tables) - set(db.inspect(db.engine).get_table_names()), set())
+            finally:
+                db.session.execute(db.text('DROP TABLE IF EXISTS alembic_version'))
+                db.session.commit()
+
+        response = self.client.post('/token', json={"username": "testuser", "password": "testpass"})
+        self.assertEqual(response.status_code, 200)
+        mock_decode_token.return_value = 1
+        headers = {'Authorization': 'Bearer token'}
+        self.assertEqual(self.client.get('/posts/1').json['content'], 'Short body')
+        self.assertEqual(self.client.get('/posts/2').json['content'], body)
+        listed = {post['title']: post['excerpt'] for post in self.client.get('/posts').json}
+        self.assertEqual(listed['Short'], 'Short body')
+        self.assertLessEqual(len(listed['Long']), EXCERPT_LENGTH)
+        self.assertIsNone(listed['Empty'])
+
+        # Existing comments became top-level threads, and new ones get fresh ids
+        response = self.client.get('/posts/1/comments', headers=headers)
+        comments = response.json['items']
+        self.assertEqual([comment['content'] for comment in comments], ['First', 'Second'])
+        self.assertEqual(self.client.delete('/comments/2', headers=headers).status_code, 204)
+        response = self.client.post('/comments', headers=headers, json={"content": "Third", "post_id": 1})
+        self.assertEqual(response.status_code, 201)
+        self.assertGreater(response.json['id'], 2)
+
+    def test_get_post_sparse_fieldset_projects_columns(self):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Test Post', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+            engine = db.engine
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            response = self.client.get(f'/posts/{post_id}?fields=id,title')
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(response.json, {'id': post_id, 'title': 'Test Post'})
+        post_queries = [statement for statement in statements if 'FROM posts' in statement]
+        self.assertTrue(post_queries)
+        self.assertNotIn('posts.excerpt', post_queries[0])
+        self.assertNotIn('post_bodies', ' '.join(statements))
+
+        # The projection is part of the cache key
+        response = self.client.get(f'/posts/{post_id}')
+        self.assertEqual(response.json['content'], 'Test Content')
+
+    def test_list_posts_rejects_unknown_fields(self):
+        response = self.client.get('/posts?fields=id,content')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fields', response.json)
+
+    def test_byte_cache_evicts_by_size_and_keeps_popular_entries(self):
+        from bytecache import WTinyLFUCache
+        store = WTinyLFUCache(max_bytes=64 * 1024, window_ratio=0.05)
+        store.set('popular', b'x' * 4096)
+        for _ in range(5):
+            store.get('popular')
+        # A scan of one-off entries much larger than the budget
+        for n in range(100):
+            store.set(f'scan/{n}', b'y' * 4096)
+        self.assertLessEqual(store.used_bytes, store.max_bytes)
+        self.assertEqual(store.get('popular'), b'x' * 4096)
+        self.assertFalse(store.set('huge', b'z' * 128 * 1024))
+
+    def test_evicting_the_list_version_never_revives_old_pages(self):
+        from caching import invalidate_post
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Post(title='Old Title', content='Test Content', user_id=user.id))
+            db.session.commit()
+        self.client.get('/posts')
+        with self.app.app_context():
+            old_version = get_version(POST_LIST_VERSION_KEY)
+            Post.query.one().title = 'New Title'
+            db.session.commit()
+            invalidate_post()
+            # The in-process cache may evict any entry; the version isn't one of them
+            cache.delete(POST_LIST_VERSION_KEY)
+            self.assertNotEqual(get_version(POST_LIST_VERSION_KEY), old_version)
+        self.assertEqual(self.client.get('/posts').json[0]['title'], 'New Title')
+
+        # A shared backend that loses the key starts a new version instead of a default one
+        with self.app.app_context(), patch('caching.shared_cache', return_value=True):
+            version = get_version(POST_LIST_VERSION_KEY)
+            self.assertNotIn(version, (None, 0, old_version))
+            self.assertEqual(get_version(POST_LIST_VERSION_KEY), version)
+
+    def test_invalidations_from_other_workers_reach_this_workers_cache(self):
+        import os
+        from caching import INVALIDATIONS_CHANNEL
+        from pubsub import broker
+        from warmup import WARMUP_CHANNEL
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Old Title', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            post_id = post.id
+        self.client.get('/posts')
+        self.client.get(f'/posts/{post_id}')
+
+        # Another worker updates the post and publishes its invalidation over the bridge
+        with self.app.app_context():
+            db.session.get(Post, post_id).title = 'New Title'
+            db.session.commit()
+        broker._deliver(INVALIDATIONS_CHANNEL, {'pid': os.getpid() + 1, 'keys': [post_cache_key(post_id)],
+                                                'versions': {POST_LIST_VERSION_KEY: 'other-worker'}})
+        self.assertEqual(self.client.get(f'/posts/{post_id}').json['title'], 'New Title')
+        self.assertEqual(self.client.get('/posts').json[0]['title'], 'New Title')
+        with self.app.app_context():
+            self.assertEqual(get_version(POST_LIST_VERSION_KEY), 'other-worker')
+
+            # ...and re-warms its cache, so this worker re-warms its own
+            cache.delete(post_cache_key(post_id))
+            seed_post_hits({post_id: 1})
+        broker._deliver(WARMUP_CHANNEL, {'pid': os.getpid() + 1})
+        deadline = time.time() + 5
+        with self.app.app_context():
+            while cache.get(post_cache_key(post_id)) is None and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertIsNotNone(cache.get(post_cache_key(post_id)))
+
+    def test_cached_list_page_is_stored_compressed(self):
+        self.app.config["CACHE_COMPRESS_MIN_BYTES"] = 16
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Post(title='Test Post', content='Test Content', user_id=user.id))
+            db.session.commit()
+        self.client.get('/posts')
+        with self.app.app_context():
+            cached_response, _, _ = cache.get(f'view//posts#{get_version(POST_LIST_VERSION_KEY)}')
+        self.assertTrue(cached_response.compressed)
+
+        response = self.client.get('/posts', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        response = self.client.get('/posts')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.json[0]['title'], 'Test Post')
+
+    # Background jobs
+    @patch('auth.decode_token')
+    def test_write_queues_job_with_its_commit(self, mock_decode_token):
+        self.app.config["CACHE_WARMUP_AFTER_WRITE"] = True
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        response = self.client.post('/posts', json={"title": "Test Post", "content": "Test Content"})
+        self.assertEqual(response.status_code, 201)
+        with self.app.app_context():
+            self.assertEqual([job.kind for job in Job.query.all()], ['warm_cache'])
+
+            # A rolled back transaction takes its jobs with it
+            enqueue('warm_cache')
+            db.session.rollback()
+            self.assertEqual(Job.query.count(), 1)
+
+        self.assertEqual(run_pending_jobs(self.app), 1)
+        with self.app.app_context():
+            self.assertEqual(Job.query.count(), 0)
+
+    def test_failed_job_batch_is_retried_with_backoff(self):
+        seen = []
+
+        @job_handler('test_failing')
+        def failing(payloads):
+            seen.append(payloads)
+            raise RuntimeError('boom')
+
+        with self.app.app_context():
+            enqueue('test_failing', n=1)
+            enqueue('test_failing', n=2)
+            db.session.commit()
+
+        self.assertEqual(run_pending_jobs(self.app), 2)
+        self.assertEqual(seen, [[{'n': 1}, {'n': 2}]])
+        with self.app.app_context():
+            jobs = Job.query.all()
+            self.assertEqual({job.status for job in jobs}, {'pending'})
+            self.assertEqual({job.attempts for job in jobs}, {1})
+            self.assertIn('boom', jobs[0].last_error)
+        # Backed off, so nothing is runnable right away
+        self.assertEqual(run_pending_jobs(self.app), 0)
+
+    # Set-based deletes
+    @patch('auth.decode_token')
+    def test_delete_post_removes_comments_in_chunks(self, mock_decode_token):
+        self.app.config["PURGE_CHUNK_SIZE"] = 2
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Test Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.add_all([Comment(content=f'Comment {i}', post_id=post_id, user_id=user_id) for i in range(5)])
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        response = self.client.delete(f'/posts/{post_id}')
+        self.assertEqual(response.status_code, 204)
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(Post, post_id))
+            self.assertIsNone(db.session.get(PostBody, post_id))
+            self.assertEqual(Comment.query.count(), 0)
+
+    @patch('auth.decode_token')
+    def test_delete_large_user_is_tombstoned_then_purged(self, mock_decode_token):
+        self.app.config["USER_PURGE_SYNC_LIMIT"] = 2
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Test Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.flush()
+            db.session.add_all([Comment(content=f'Comment {i}', post_id=post.id, user_id=user_id) for i in range(3)])
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        response = self.client.delete(f'/users/{user_id}')
+        self.assertEqual(response.status_code, 202)
+        with self.app.app_context():
+            self.assertIsNotNone(db.session.get(User, user_id).deleted_at)
+        self.assertEqual(self.client.get(f'/users/{user_id}').status_code, 401)
+
+        run_pending_jobs(self.app)
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(User, user_id))
+            self.assertEqual(Post.query.count(), 0)
+            self.assertEqual(Comment.query.count(), 0)
+
+    @patch('auth.decode_token')
+    def test_deleting_a_user_drops_their_posts_from_the_cache(self, mock_decode_token):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Cached Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+        self.assertEqual(self.client.get(f'/posts/{post_id}').status_code, 200)
+        self.assertEqual(len(self.client.get('/posts').json), 1)
+        mock_decode_token.return_value = user_id
+
+        self.assertEqual(self.client.delete(f'/users/{user_id}').status_code, 204)
+        self.assertEqual(self.client.get(f'/posts/{post_id}').status_code, 404)
+        self.assertEqual(self.client.get('/posts').json, [])
+        with self.app.app_context():
+            from models import Change
+            self.assertIsNone(cache.get(post_cache_key(post_id)))
+            self.assertEqual(Change.query.filter_by(entity='post', entity_id=post_id, op='delete').count(), 1)
+
+    @patch('auth.decode_token')
+    def test_comments_by_others_on_a_users_posts_count_toward_the_sync_limit(self, mock_decode_token):
+        from datetime import datetime
+        from models import ArchivedComment
+        self.app.config["USER_PURGE_SYNC_LIMIT"] = 3
+        with self.app.app_context():
+            author = User(name='Author', username='author', email='author@example.com', password='testpass')
+            reader = User(name='Reader', username='reader', email='reader@example.com', password='testpass')
+            db.session.add_all([author, reader])
+            db.session.flush()
+            author_id = author.id
+            posts = [Post(title=f'Post {n}', content='Content', user_id=author_id) for n in range(2)]
+            db.session.add_all(posts)
+            db.session.flush()
+            db.session.add(Comment(content='Hot', post_id=posts[0].id, user_id=reader.id))
+            db.session.add(ArchivedComment(id=1000, content='Cold', post_id=posts[1].id, user_id=reader.id,
+                                           path='0000001000', depth=0, date_posted=datetime(2020, 1, 1)))
+            db.session.commit()
+        mock_decode_token.return_value = author_id
+
+        # Two posts, one hot and one archived comment: over the limit of 3
+        self.assertEqual(self.client.delete(f'/users/{author_id}').status_code, 202)
+
+    # Threaded comments
+    @patch('auth.decode_token')
+    def test_comment_thread_is_nested_and_depth_limited(self, mock_decode_token):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Test Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        def reply(content, parent_id=None):
+            body = {"content": content, "post_id": post_id, "parent_id": parent_id}
+            return self.client.post('/comments', json=body).json['id']
+
+        root = reply('root')
+        child = reply('child', root)
+        reply('grandchild', child)
+        reply('second child', root)
+        reply('other thread')
+
+        response = self.client.get(f'/comments/{root}/thread?depth=1')
+        self.assertEqual(response.status_code, 200)
+        [tree] = response.json['items']
+        self.assertEqual(tree['content'], 'root')
+        self.assertEqual([node['content'] for node in tree['replies']], ['child', 'second child'])
+        self.assertEqual(tree['replies'][0]['replies'], [])
+
+        response = self.client.get(f'/posts/{post_id}/comments?tree=1')
+        self.assertEqual([node['content'] for node in response.json['items']], ['root', 'other thread'])
+        self.assertEqual(response.json['items'][0]['replies'][0]['replies'][0]['content'], 'grandchild')
+
+        # Deleting a comment removes its whole subtree
+        self.assertEqual(self.client.delete(f'/comments/{child}').status_code, 204)
+        response = self.client.get(f'/posts/{post_id}/comments')
+        self.assertEqual([node['content'] for node in response.json['items']], ['root', 'second child', 'other thread'])
+
+    @patch('auth.decode_token')
+    def test_reply_to_comment_on_other_post_is_rejected(self, mock_decode_token):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            first = Post(title='First', content='Test Content', user_id=user_id)
+            second = Post(title='Second', content='Test Content', user_id=user_id)
+            db.session.add_all([first, second])
+            db.session.flush()
+            comment = Comment(content='Test Comment', post_id=first.id, user_id=user_id)
+            db.session.add(comment)
+            db.session.flush()
+            comment_id, second_id = comment.id, second.id
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        response = self.client.post('/comments', json={"content": "reply", "post_id": second_id, "parent_id": comment_id})
+        self.assertEqual(response.status_code, 400)
+
+    # Group commit
+    @patch('auth.decode_token')
+    def test_group_commit_batches_concurrent_comments(self, mock_decode_token):
+        self.app.config["GROUP_COMMIT_ENABLED"] = True
+        self.app.config["GROUP_COMMIT_MAX_DELAY_MS"] = 200
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Test Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        responses = []
+
+        def comment(n):
+            client = self.app.test_client()
+            responses.append(client.post('/comments', json={"content": f"Comment {n}", "post_id": post_id}))
+
+        threads = [threading.Thread(target=comment, args=(n,)) for n in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [201] * 5)
+        ids = {response.json['id'] for response in responses}
+        self.assertEqual(len(ids), 5)
+        self.assertLess(self.app.extensions['group_commit'].batches, 5)
+        with self.app.app_context():
+            self.assertEqual(Comment.query.filter(Comment.id.in_(ids)).count(), 5)
+
+    @patch('auth.decode_token')
+    def test_group_commit_timeout_says_the_write_may_still_apply(self, mock_decode_token):
+        from concurrent.futures import Future
+        self.app.config["GROUP_COMMIT_ENABLED"] = True
+        self.app.config["GROUP_COMMIT_TIMEOUT"] = 0.01
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Test Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.commit()
+            post_id = post.id
+        mock_decode_token.return_value = user_id
+
+        # A writer stuck behind a slow batch
+        writer = MagicMock()
+        writer.submit.return_value = Future()
+        self.app.extensions['group_commit'] = writer
+        response = self.client.post('/comments', json={"content": "Slow", "post_id": post_id})
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('may still be applied', response.json['error'])
+        self.assertIn('Retry-After', response.headers)
+
+    # Live comment stream
+    @patch('auth.decode_token')
+    def test_comment_stream_resumes_and_receives_new_comments(self, mock_decode_token):
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            post = Post(title='Test Post', content='Test Content', user_id=user_id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            first = Comment(content='Before', post_id=post_id, user_id=user_id)
+            db.session.add(first)
+            db.session.flush()
+            first_id = first.id
+            db.session.add(Comment(content='Missed', post_id=post_id, user_id=user_id))
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        response = self.client.get(f'/posts/{post_id}/comments/stream',
+                                   headers={'Last-Event-ID': str(first_id)}, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = iter(response.response)
+        self.assertIn('"content": "Missed"', next(stream).decode())
+
+        self.client.post('/comments', json={"content": "Live", "post_id": post_id})
+        self.assertIn('"content": "Live"', next(stream).decode())
+        response.close()
+
+    @patch('auth.decode_token')
+    def test_comment_stream_delivers_comments_committed_out_of_id_order(self, mock_decode_token):
+        from pubsub import broker
+        from routes import comment_channel
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Test Post', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            db.session.add(Comment(id=10, content='Seen', post_id=post_id, user_id=user.id))
+            db.session.commit()
+            # A writer that took a lower id commits after the client saw id 10
+            db.session.add(Comment(id=5, content='Late', post_id=post_id, user_id=user.id))
+            db.session.commit()
+            mock_decode_token.return_value = user.id
+
+        response = self.client.get(f'/posts/{post_id}/comments/stream',
+                                   headers={'Last-Event-ID': '10'}, buffered=False)
+        stream = iter(response.response)
+        self.assertIn('"content": "Late"', next(stream).decode())
+
+        # Live events are only deduplicated against the backlog
+        broker.publish(comment_channel(post_id), {'id': 20, 'data': {'content': 'Newer'}})
+        broker.publish(comment_channel(post_id), {'id': 5, 'data': {'content': 'Late'}})
+        broker.publish(comment_channel(post_id), {'id': 15, 'data': {'content': 'Older'}})
+        self.assertIn('"content": "Newer"', next(stream).decode())
+        self.assertIn('"content": "Older"', next(stream).decode())
+        response.close()
+
+    def test_pubsub_bridge_is_private_and_resolves_only_comment_channels(self):
+        import os
+        import stat
+        from pubsub import broker
+        from routes import comment_channel, load_comment_event
+        from suggest import TITLES_CHANNEL
+        self.assertEqual(os.path.dirname(broker._socket_dir), self.app.instance_path)
+        self.assertEqual(stat.S_IMODE(os.stat(broker._socket_dir).st_mode), 0o700)
+        self.assertIs(broker._resolver(comment_channel(7)), load_comment_event)
+        self.assertIsNone(broker._resolver(TITLES_CHANNEL))
+
+    @patch('auth.decode_token')
+    def test_comment_stream_releases_unstarted_subscriptions(self, mock_decode_token):
+        from pubsub import broker
+        from routes import comment_channel
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Test Post', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            mock_decode_token.return_value = user.id
+            post_id = post.id
+
+        # Neither a HEAD request nor a streaming /batch sub-request ever starts the generator
+        for _ in range(3):
+            response = self.client.head(f'/posts/{post_id}/comments/stream')
+            self.assertEqual(response.status_code, 200)
+            response.close()  # as the WSGI server does, without iterating the body
+        response = self.client.post('/batch', headers={'Authorization': 'Bearer token'},
+                                    json=[{"path": f"/posts/{post_id}/comments/stream"}])
+        self.assertEqual(response.json[0]['status'], 400)
+        self.assertFalse(broker._subscribers.get(comment_channel(post_id)))
+
+    # OpenAPI spec
+    def test_openapi_spec_is_generated_and_etagged(self):
+        response = self.client.get('/swagger/swagger.json', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+
+        spec = self.app.extensions['openapi']
+        self.assertNotIn('date_posted', spec['components']['schemas']['Post']['properties'])
+        self.assertIn('/posts/{id}/comments', spec['paths'])
+        self.assertEqual(spec['paths']['/posts']['post']['security'], [{'bearerAuth': []}])
+        self.assertNotIn('security', spec['paths']['/posts']['get'])
+
+        response = self.client.get('/swagger/swagger.yaml', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 200)
+        cached = self.client.get('/swagger/swagger.yaml', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(cached.status_code, 304)
+
+    # Rate limiting
+    @patch('auth.decode_token')
+    def test_rate_limit_is_per_user_not_per_ip(self, mock_decode_token):
+        self.app.config["RATE_LIMIT_ROUTES"] = {'update_user': '2 per minute'}
+        with self.app.app_context():
+            first = User(name='First', username='first', email='first@example.com', password='testpass')
+            second = User(name='Second', username='second', email='second@example.com', password='testpass')
+            db.session.add_all([first, second])
+            db.session.flush()
+            first_id, second_id = first.id, second.id
+            db.session.commit()
+
+        mock_decode_token.return_value = first_id
+        statuses = [self.client.put(f'/users/{first_id}', json={"name": "Renamed"}).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+        # Same IP, different user: not throttled
+        mock_decode_token.return_value = second_id
+        response = self.client.put(f'/users/{second_id}', json={"name": "Renamed"})
+        self.assertEqual(response.status_code, 200)
+
+        mock_decode_token.return_value = first_id
+        response = self.client.put(f'/users/{first_id}', json={"name": "Renamed"})
+        self.assertIn('Retry-After', response.headers)
+
+    @patch('auth.decode_token')
+    def test_optional_token_routes_are_limited_per_user(self, mock_decode_token):
+        self.app.config["RATE_LIMIT_ROUTES"] = {'list_posts': '1 per minute'}
+        with self.app.app_context():
+            first = User(name='First', username='first', email='first@example.com', password='testpass')
+            second = User(name='Second', username='second', email='second@example.com', password='testpass')
+            db.session.add_all([first, second])
+            db.session.commit()
+            tokens = {'first-token': first.id, 'second-token': second.id}
+        mock_decode_token.side_effect = tokens.get
+
+        # list_posts needs no token, but one sent still picks the bucket; distinct pages miss the cache
+        get = lambda page, token: self.client.get(f'/posts?page={page}', headers={'Authorization': f'Bearer {token}'})
+        self.assertEqual(get(1, 'first-token').status_code, 200)
+        self.assertEqual(get(2, 'first-token').status_code, 429)
+        self.assertEqual(get(3, 'second-token').status_code, 200)
+        # Anonymous clients behind the same address have their own bucket
+        self.assertEqual(self.client.get('/posts?page=4').status_code, 200)
+
+    def test_cache_warmup_is_not_rate_limited(self):
+        # Warm-up renders have no client address, so they would all share one bucket
+        self.app.config["RATE_LIMIT_ROUTES"] = {'list_posts': '1 per minute'}
+        self.app.config["CACHE_WARMUP_LIST_PAGES"] = 3
+        warm_cache(self.app)
+        with self.app.app_context():
+            for page in (1, 2, 3):
+                self.assertIsNotNone(cache.get(f'view//posts?page={page}#{get_version(POST_LIST_VERSION_KEY)}'))
+
+    # Admission control
+    def test_saturated_class_is_shed_with_503(self):
+        controller = self.app.extensions['admission']
+        writes = controller.limits['write']
+        writes.in_flight = int(writes.limit)
+        try:
+            response = self.client.post('/users', json={"name": "New", "username": "new",
+                                                       "email": "new@example.com", "password": "testpass"})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+            # Reads have their own budget and keep flowing, read-only POSTs included
+            self.assertEqual(self.client.get('/posts').status_code, 200)
+            self.assertEqual(self.client.post('/posts/mget', json={"ids": [1]}).status_code, 200)
+        finally:
+            writes.in_flight = 0
+
+    @patch('auth.decode_token')
+    def test_batch_sub_requests_each_take_one_slot_of_their_class(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+        mock_decode_token.return_value = user_id
+        controller = self.app.extensions['admission']
+        writes = controller.limits['write']
+        writes.in_flight = int(writes.limit)
+        try:
+            with patch.object(controller, 'try_acquire', wraps=controller.try_acquire) as try_acquire:
+                response = self.client.post('/batch', headers={'Authorization': 'Bearer token'}, json=[
+                    {"path": f"/users/{user_id}"},
+                    {"method": "POST", "path": "/posts/mget", "body": {"ids": [1]}},
+                ])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['status'] for result in response.json], [200, 200])
+            self.assertEqual([call.args[0] for call in try_acquire.call_args_list], ['read', 'read'])
+            self.assertEqual(controller.limits['read'].in_flight, 0)
+        finally:
+            writes.in_flight = 0
+
+    def test_cache_hits_skip_a_saturated_read_limit(self):
+        controller = self.app.extensions['admission']
+        reads = controller.limits['read']
+        self.assertEqual(self.client.get('/posts').status_code, 200)
+        reads.in_flight = reads.maximum
+        try:
+            self.assertEqual(self.client.get('/posts').status_code, 200)
+            self.assertEqual(self.client.get('/posts?page=2').status_code, 503)
+            self.assertEqual(reads.in_flight, reads.maximum)
+        finally:
+            reads.in_flight = 0
+
+    def test_connection_waits_back_off_their_route_class(self):
+        from sqlalchemy import create_engine
+        from admission import TimedQueuePool
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+        held = engine.connect()
+        threading.Timer(0.1, held.close).start()
+        with self.app.test_request_context():
+            engine.connect().close()
+            from flask import g
+            pool_wait = g.pool_wait
+        self.assertGreaterEqual(pool_wait, 0.05)
+        engine.dispose()
+
+        controller = self.app.extensions['admission']
+        writes = controller.limits['write']
+        before = writes.limit
+        writes.in_flight += 1
+        controller.release('write', latency=0.01, pool_wait=pool_wait)
+        self.assertLess(writes.limit, before)
+
+    def test_adaptive_limit_backs_off_and_recovers(self):
+        from admission import AdaptiveLimit
+        limit = AdaptiveLimit(initial=10, minimum=2, maximum=20, target_latency=0.1)
+        limit.on_complete(latency=0.5, congested=False, now=1.0)
+        self.assertAlmostEqual(limit.limit, 9.0)
+        # Only one decrease per latency window
+        limit.on_complete(latency=0.5, congested=False, now=1.05)
+        self.assertAlmostEqual(limit.limit, 9.0)
+        limit.on_complete(latency=0.01, congested=False, now=2.0)
+        self.assertAlmostEqual(limit.limit, 9.0 + 1 / 9.0)
+
+    # Trending posts
+    @patch('auth.decode_token')
+    def test_trending_ranks_posts_by_recent_views_and_comments(self, mock_decode_token):
+        counters = self.app.extensions['trending']
+        counters.merge_interval = 3600
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            posts = [Post(title=f'Post {n}', content='Content', user_id=user_id) for n in range(3)]
+            db.session.add_all(posts)
+            db.session.flush()
+            viewed, commented, quiet = (post.id for post in posts)
+            db.session.commit()
+        mock_decode_token.return_value = user_id
+
+        for _ in range(3):
+            self.client.get(f'/posts/{viewed}')
+        self.client.post('/comments', json={"content": "Hot take", "post_id": commented})
+        # Ids that don't exist are not counted
+        self.assertEqual(self.client.get('/posts/987654').status_code, 404)
+        self.assertNotIn(987654, counters._views)
+
+        # The list only changes when a merge runs
+        self.assertEqual(self.client.get('/posts/trending').json, [])
+        with self.app.app_context():
+            counters.merge_now()
+
+        response = self.client.get('/posts/trending?limit=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([post['id'] for post in response.json], [commented, viewed])
+        self.assertEqual(response.json[1]['views'], 3)
+        self.assertEqual(response.json[0]['title'], 'Post 1')
+
+    def test_minute_ring_drops_counts_outside_the_window(self):
+        from trending import MinuteRing
+        ring = MinuteRing(3)
+        ring.add(100)
+        ring.add(101, 2)
+        self.assertEqual(ring.total(102), 3)
+        # Minute 103 reuses minute 100's slot
+        ring.add(103)
+        self.assertEqual(ring.total(103), 3)
+        self.assertEqual(ring.total(105), 1)
+
+    # Comment archival
+    @patch('auth.decode_token')
+    def test_inactive_post_comments_are_archived_and_still_readable(self, mock_decode_token):
+        from archive import archive_inactive_posts
+        from datetime import datetime
+        from models import ArchivedComment
+        old = datetime(2020, 1, 1)
+        user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+        with self.app.app_context():
+            db.session.add(user)
+            db.session.flush()
+            user_id = user.id
+            stale, active = Post(title='Stale', content='Content', user_id=user_id), Post(title='Active', content='Content', user_id=user_id)
+            db.session.add_all([stale, active])
+            db.session.flush()
+            stale_id = stale.id
+            root = Comment(content='Old root', post_id=stale_id, user_id=user_id, date_posted=old)
+            db.session.add(root)
+            db.session.flush()
+            root_id = root.id
+            db.session.add(Comment(content='Old reply', post_id=stale_id, user_id=user_id, parent_id=root_id, date_posted=old))
+            db.session.add(Comment(content='Recent', post_id=active.id, user_id=user_id, date_posted=datetime.now()))
+            db.session.commit()
+
+            self.assertEqual(archive_inactive_posts(), 1)
+            self.assertEqual(Comment.query.filter_by(post_id=stale_id).count(), 0)
+            self.assertEqual(ArchivedComment.query.filter_by(post_id=stale_id).count(), 2)
+            self.assertEqual(Comment.query.count(), 1)
+        mock_decode_token.return_value = user_id
+
+        response = self.client.get(f'/comments/{root_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['content'], 'Old root')
+        response = self.client.get(f'/posts/{stale_id}/comments?tree=1')
+        self.assertEqual(response.json['items'][0]['replies'][0]['content'], 'Old reply')
+
+        # Replying brings the thread back to the hot table
+        response = self.client.post('/comments', json={"content": "Revived", "post_id": stale_id, "parent_id": root_id})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['depth'], 1)
+        with self.app.app_context():
+            self.assertEqual(Comment.query.filter_by(post_id=stale_id).count(), 3)
+            self.assertEqual(ArchivedComment.query.count(), 0)
+            self.assertFalse(db.session.get(Post, stale_id).comments_archived)
+
+    def test_archiving_keeps_comments_without_a_path(self):
+        from archive import archive_post
+        from datetime import datetime
+        from models import ArchivedComment
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Stale', content='Content', user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            comments = [Comment(content=f'Old {i}', post_id=post_id, user_id=user.id, date_posted=datetime(2020, 1, 1))
+                        for i in range(3)]
+            db.session.add_all(comments)
+            db.session.commit()
+            # Written before comments had paths
+            db.session.execute(db.text('UPDATE comments SET path = NULL WHERE id = :id'), {'id': comments[0].id})
+            db.session.commit()
+
+            self.app.config['ARCHIVE_CHUNK_SIZE'] = 2
+            archive_post(post_id)
+            self.assertEqual(Comment.query.filter_by(post_id=post_id).count(), 0)
+            self.assertEqual(ArchivedComment.query.filter_by(post_id=post_id).count(), 3)
+
+    @patch('auth.decode_token')
+    def test_new_comments_are_dated_when_created(self, mock_decode_token):
+        from datetime import datetime
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Post', content='Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            mock_decode_token.return_value = user.id
+            post_id = post.id
+
+        # Archival keys on date_posted, so the default must not be the process start time
+        with patch('models.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2031, 5, 1, 12, 0)
+            comment_id = self.client.post('/comments', json={"content": "Now", "post_id": post_id}).json['id']
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Comment, comment_id).date_posted, datetime(2031, 5, 1, 12, 0))
+
+    # Preloaded workers
+    def test_after_fork_resets_per_process_state(self):
+        from app import after_fork
+        limiter_table = self.app.extensions['rate_limiter']
+        self.app.extensions['group_commit'] = object()
+        _inflight['stale'] = threading.Event()
+        with self.app.app_context():
+            engine = db.engine
+            pool = engine.pool
+
+        after_fork(self.app)
+
+        self.assertIsNot(self.app.extensions['rate_limiter'], limiter_table)
+        self.assertNotIn('group_commit', self.app.extensions)
+        self.assertNotIn('stale', _inflight)
+        self.assertIsNot(engine.pool, pool)
+        # The worker still serves requests on fresh connections
+        self.assertEqual(self.client.get('/posts').status_code, 200)
+
+    # Profiling
+    def test_profile_header_writes_profile_with_sql(self):
+        import tempfile
+        from config import Config
+        with tempfile.TemporaryDirectory() as directory, \
+                patch.object(Config, 'PROFILING_KEY', 'secret'), patch.object(Config, 'PROFILING_DIR', directory):
+            app = create_app()
+            app.config["CACHE_WARMUP_AFTER_WRITE"] = False
+            client = app.test_client()
+
+            # Without the key the header is ignored and the admin endpoint is closed
+            client.get('/posts?page=7', headers={'X-Profile': '1'})
+            self.assertEqual(client.get('/admin/profiles').status_code, 401)
+
+            headers = {'X-Profile': '1', 'X-Profile-Key': 'secret'}
+            self.assertEqual(client.get('/posts?page=8', headers=headers).status_code, 200)
+            response = client.get('/admin/profiles', headers={'X-Profile-Key': 'secret'})
+            self.assertEqual([profile['path'] for profile in response.json], ['/posts?page=8'])
+            self.assertGreater(response.json[0]['sql_statements'], 0)
+
+            profile = client.get(f"/admin/profiles/{response.json[0]['name']}", headers={'X-Profile-Key': 'secret'})
+            self.assertIn('SELECT', profile.json['sql'][0]['statement'])
+            self.assertIn('function calls', profile.json['summary'])
+
+    # Traffic capture and replay
+    def test_captured_traffic_is_sanitized_and_replayed(self):
+        import json
+        import tempfile
+        from werkzeug.serving import make_server
+        from replay import Replayer, TokenTranslator, load_capture
+        from traffic import CaptureMiddleware
+        from utils.utils import encode_token
+        self.app.config['SECRET_KEY'] = 'replay-secret'
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+            token = encode_token(user_id)
+
+        with tempfile.NamedTemporaryFile('w+', suffix='.jsonl') as capture:
+            self.app.wsgi_app = CaptureMiddleware(self.app, capture.name)
+            # Records are written when the server closes the response
+            self.client.post('/posts', json={"title": "Captured", "content": "Body"},
+                             headers={'Authorization': f'Bearer {token}'}).close()
+            self.client.post('/login', json={"username": "testuser", "password": "testpass"}).close()
+            self.client.get('/posts?page=1').close()
+
+            records = load_capture(capture.name)
+            self.assertEqual([record['endpoint'] for record in records], ['create_post', 'login', 'list_posts'])
+            self.assertEqual(records[0]['auth'], f'user:{user_id}')
+            self.assertNotIn(token, json.dumps(records))
+            self.assertEqual(records[1]['body']['json']['password'], 'redacted')
+
+            server = make_server('127.0.0.1', 0, self.app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            try:
+                replayer = Replayer(f'http://127.0.0.1:{server.server_port}', clients=2, speed=0,
+                                    translate=TokenTranslator(self.app.config['SECRET_KEY']))
+                report = replayer.run(records)
+            finally:
+                server.shutdown()
+
+        self.assertEqual(report['requests'], 3)
+        self.assertEqual(report['endpoints']['create_post']['error_rate'], 0)
+        self.assertEqual(report['endpoints']['create_post']['status_mismatches'], 0)
+        self.assertIsNotNone(report['endpoints']['list_posts']['p99_ms'])
+        with self.app.app_context():
+            self.assertEqual(Post.query.filter_by(title='Captured').count(), 2)
+
+    @patch('auth.decode_token')
+    def test_post_comments_are_listed_in_creation_order(self, mock_decode_token):
+        from datetime import datetime
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Test Post', content='Test Content', user_id=user.id)
+            db.session.add(post)
+            db.session.flush()
+            post_id = post.id
+            # As with sharded ids, drawn from different workers' blocks
+            db.session.add(Comment(id=10, content='First', post_id=post_id, user_id=user.id, date_posted=datetime(2024, 1, 1)))
+            db.session.add(Comment(id=5, content='Second', post_id=post_id, user_id=user.id, date_posted=datetime(2024, 1, 2)))
+            db.session.commit()
+            mock_decode_token.return_value = user.id
+
+        response = self.client.get(f'/posts/{post_id}/comments')
+        self.assertEqual([item['content'] for item in response.json['items']], ['First', 'Second'])
+
+    # Sharding
+    def test_posts_and_comments_are_routed_to_shards(self):
+        import json
+        import os
+        import subprocess
+        import sys
+        import tempfile
+        # The session class is chosen at import time, so run a sharded app in its own interpreter
+        script = '''
+import json
+from app import create_app, db
+import sharding
+app = create_app()
+app.config.update(JOBS_WORKER_ENABLED=False, CACHE_WARMUP_AFTER_WRITE=False, SECRET_KEY='shard-secret')
+client = app.test_client()
+tokens = []
+for i in range(2):
+    client.post('/register', json={'name': 'n', 'username': f'user{i}', 'email': f'user{i}@example.com', 'password': 'pw'})
+    tokens.append(client.post('/token', json={'username': f'user{i}', 'password': 'pw'}).json['token'])
+post_ids = [client.post('/posts', json={'title': f'Post {i}', 'content': 'Body'},
+                        headers={'Authorization': f'Bearer {tokens[i % 2]}'}).json['id'] for i in range(4)]
+comment = client.post('/comments', json={'content': 'Hi', 'post_id': post_ids[1]},
+                      headers={'Authorization': f'Bearer {tokens[0]}'}).json
+with app.app_context():
+    shards = {shard_id: db.session.execute(db.text('SELECT id FROM posts ORDER BY id'),
+                                           bind_arguments={'shard_id': shard_id}).scalars().all()
+              for shard_id in sharding.SHARD_IDS}
+print(json.dumps({
+    'post_ids': post_ids, 'comment': comment, 'shards': shards,
+    'post': client.get(f'/posts/{post_ids[1]}').json,
+    'pages': [[post['id'] for post in client.get(f'/posts?per_page=3&page={page}').json] for page in (1, 2)],
+    'search': [post['id'] for post in client.get('/posts?search=Post 2').json],
+}))
+'''
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(os.environ, CACHE_WARMUP_ON_START='false',
+                       SQLALCHEMY_DATABASE_URI=f'sqlite:///{directory}/main.db',
+                       SHARD_DATABASE_URIS=f'sqlite:///{directory}/shard0.db,sqlite:///{directory}/shard1.db')
+            root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            result = subprocess.run([sys.executable, '-c', script], cwd=root, env=env,
+                                    capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        output = json.loads(result.stdout.strip().splitlines()[-1])
+
+        post_ids = output['post_ids']
+        # Each author's posts land on one shard, and the id says which
+        self.assertEqual(output['shards'], {'shard0': sorted(post_ids[1::2]), 'shard1': sorted(post_ids[0::2])})
+        self.assertEqual(output['comment']['id'] % 2, post_ids[1] % 2)
+        self.assertEqual(output['comment']['post']['id'], post_ids[1])
+        self.assertEqual(output['post']['title'], 'Post 1')
+        # Pages are merged across shards in id order
+        self.assertEqual(output['pages'][0] + output['pages'][1], sorted(post_ids))
+        self.assertEqual(output['search'], [post_ids[2]])
+
+    # Compound documents
+    @patch('auth.decode_token')
+    def test_include_side_loads_authors_and_comments_in_batches(self, mock_decode_token):
+        with self.app.app_context():
+            author = User(name='Author', username='author', email='author@example.com', password='testpass')
+            reader = User(name='Reader', username='reader', email='reader@example.com', password='testpass')
+            db.session.add_all([author, reader])
+            db.session.flush()
+            post = Post(title='Post', content='Content', user_id=author.id)
+            db.session.add(post)
+            db.session.flush()
+            db.session.add_all([Comment(content=f'Comment {n}', post_id=post.id, user_id=user.id)
+                                for n, user in enumerate([author, reader, reader])])
+            db.session.commit()
+            post_id, author_id, reader_id = post.id, author.id, reader.id
+
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get(f'/posts/{post_id}?include=author,comments')
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data']['title'], 'Post')
+        included = response.json['included']
+        self.assertEqual([comment['content'] for comment in included['comments']], ['Comment 0', 'Comment 1', 'Comment 2'])
+        # Each author once, and never their email
+        self.assertEqual([user['id'] for user in included['users']], [author_id, reader_id])
+        self.assertNotIn('email', included['users'][0])
+        # One query per relation, not per row
+        self.assertEqual(sum('FROM users' in statement for statement in statements), 1)
+        self.assertEqual(sum('FROM comments' in statement for statement in statements), 1)
+
+        mock_decode_token.return_value = reader_id
+        response = self.client.get(f'/posts/{post_id}/comments?include=author,post')
+        self.assertEqual([user['username'] for user in response.json['included']['users']], ['author', 'reader'])
+        self.assertEqual(response.json['included']['posts'][0]['id'], post_id)
+        self.assertEqual(len(response.json['items']), 3)
+
+    @patch('auth.decode_token')
+    def test_include_rejects_unknown_relations_and_follows_user_updates(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Author', username='author', email='author@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Post', content='Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            post_id, user_id = post.id, user.id
+
+        response = self.client.get(f'/posts/{post_id}?include=comments,secrets')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('include', response.json)
+
+        response = self.client.get('/posts?include=author')
+        self.assertEqual(response.json['included']['users'][0]['name'], 'Author')
+
+        mock_decode_token.return_value = user_id
+        self.client.put(f'/users/{user_id}', json={'name': 'Renamed'})
+        response = self.client.get('/posts?include=author')
+        self.assertEqual(response.json['included']['users'][0]['name'], 'Renamed')
+
+    # Title autocomplete
+    @patch('auth.decode_token')
+    def test_suggest_follows_post_writes_without_queries(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.commit()
+            mock_decode_token.return_value = user.id
+        for title in ('Café culture', 'Caching at scale', 'Why we love caches'):
+            self.client.post('/posts', json={"title": title, "content": "Body"})
+        self.client.get('/posts/suggest?q=x')  # apply the published changes
+
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            response = self.client.get('/posts/suggest?q=CAC')
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        # Whole-title matches come before matches on a later word
+        self.assertEqual([post['title'] for post in response.json], ['Caching at scale', 'Why we love caches'])
+        self.assertEqual(statements, [])
+        self.assertEqual([post['title'] for post in self.client.get('/posts/suggest?q=cafe').json], ['Café culture'])
+
+        post_id = self.client.get('/posts/suggest?q=why').json[0]['id']
+        self.client.put(f'/posts/{post_id}', json={"title": "Cold storage"})
+        self.assertEqual([post['title'] for post in self.client.get('/posts/suggest?q=cac').json], ['Caching at scale'])
+        self.client.delete(f'/posts/{post_id}')
+        self.assertEqual(self.client.get('/posts/suggest?q=cold').json, [])
+
+    def test_suggest_rebuilds_off_the_request_thread(self):
+        index = self.app.extensions['suggest']
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            # Written behind the routes' back, so only a rebuild finds it
+            db.session.add(Post(title='Quiet import', content='Body', user_id=user.id))
+            db.session.commit()
+            engine = db.engine
+
+        threads = []
+        record = lambda *args: threads.append(threading.current_thread().name)
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            index._rebuild_due = 0
+            self.assertEqual(self.client.get('/posts/suggest?q=quiet').status_code, 200)
+            deadline = time.monotonic() + 5
+            while index._rebuilding and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        self.assertEqual(set(threads), {'suggest-rebuild'})
+        self.assertEqual([post['title'] for post in self.client.get('/posts/suggest?q=quiet').json], ['Quiet import'])
+
+        # With the index disabled the route answers with no suggestions
+        del self.app.extensions['suggest']
+        self.assertEqual(self.client.get('/posts/suggest?q=quiet').json, [])
+
+    def test_prefix_index_checks_queries_longer_than_its_keys(self):
+        from suggest import PrefixIndex
+        index = PrefixIndex(max_key_length=8)
+        index.build([(1, 'Performance tuning'), (2, 'Performance testing'), (3, 'On performance')])
+        self.assertEqual([post['id'] for post in index.search('performance tu')], [1])
+        self.assertEqual([post['id'] for post in index.search('perf', limit=2)], [1, 2])
+        index.update(2, None)
+        self.assertEqual([post['id'] for post in index.search('perf')], [1, 3])
+
+    # Change feed
+    @patch('auth.decode_token')
+    def test_change_feed_returns_latest_state_since_a_cursor(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+        mock_decode_token.return_value = user_id
+        cursor = self.client.get('/changes').json['next_since']
+
+        post_id = self.client.post('/posts', json={"title": "Draft", "content": "Body"}).json['id']
+        self.client.put(f'/posts/{post_id}', json={"title": "Final"})
+        comment_id = self.client.post('/comments', json={"content": "First", "post_id": post_id}).json['id']
+        gone_id = self.client.post('/comments', json={"content": "Oops", "post_id": post_id}).json['id']
+        self.client.delete(f'/comments/{gone_id}')
+
+        response = self.client.get(f'/changes?since={cursor}')
+        self.assertEqual(response.status_code, 200)
+        changes = response.json['changes']
+        # One entry per entity, in order of its last change, with current data
+        self.assertEqual([(change['entity'], change['id'], change['op']) for change in changes],
+                         [('post', post_id, 'upsert'), ('comment', comment_id, 'upsert'), ('comment', gone_id, 'delete')])
+        self.assertEqual(changes[0]['data']['title'], 'Final')
+        self.assertIsNone(changes[2]['data'])
+        self.assertFalse(response.json['has_more'])
+
+        # Paging with a small limit walks the same log
+        page = self.client.get(f'/changes?since={cursor}&limit=2').json
+        self.assertTrue(page['has_more'])
+        self.assertEqual(self.client.get(f"/changes?since={response.json['next_since']}").json['changes'], [])
+
+    @patch('auth.decode_token')
+    def test_change_feed_logs_deletes_of_every_reply(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Post', content='Body', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            user_id, post_id = user.id, post.id
+        mock_decode_token.return_value = user_id
+        self.app.config['PURGE_CHUNK_SIZE'] = 2
+
+        root_id = self.client.post('/comments', json={"content": "Root", "post_id": post_id}).json['id']
+        reply_ids = [self.client.post('/comments', json={"content": f"Reply {n}", "post_id": post_id,
+                                                         "parent_id": root_id}).json['id'] for n in range(2)]
+        nested_id = self.client.post('/comments', json={"content": "Nested", "post_id": post_id,
+                                                        "parent_id": reply_ids[0]}).json['id']
+        cursor = self.client.get('/changes').json['next_since']
+
+        self.client.delete(f'/comments/{root_id}')
+        changes = self.client.get(f'/changes?since={cursor}').json['changes']
+        self.assertEqual(sorted((change['id'], change['op']) for change in changes),
+                         [(comment_id, 'delete') for comment_id in sorted([root_id, *reply_ids, nested_id])])
+
+    def test_compaction_keeps_only_the_latest_entry_per_entity(self):
+        from changes import compact_changes
+        from models import Change
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.commit()
+            post = Post(title='Post', content='Body', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            for title in ('Second', 'Third'):
+                post.title = title
+                db.session.commit()
+            self.assertEqual(Change.query.filter_by(entity='post').count(), 3)
+
+            self.assertEqual(compact_changes(), 2)
+            remaining = Change.query.order_by(Change.seq).all()
+            self.assertEqual([(change.entity, change.op) for change in remaining], [('user', 'upsert'), ('post', 'upsert')])
+
+    # Batch requests
+    @patch('auth.decode_token')
+    def test_batch_authenticates_once_and_keeps_request_order(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Post', content='Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            user_id, post_id = user.id, post.id
+        mock_decode_token.return_value = user_id
+
+        response = self.client.post('/batch', headers={'Authorization': 'Bearer token'}, json=[
+            {"path": f"/posts/{post_id}"},
+            {"path": f"/users/{user_id}"},
+            {"path": "/posts/999999"},
+            {"method": "POST", "path": "/comments", "body": {"content": "First", "post_id": post_id}},
+            {"path": f"/posts/{post_id}/comments"},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.json], [200, 200, 404, 201, 200])
+        self.assertEqual(response.json[0]['body']['title'], 'Post')
+        self.assertEqual(response.json[1]['body']['username'], 'testuser')
+        # The read after the write sees it
+        self.assertEqual([comment['content'] for comment in response.json[4]['body']['items']], ['First'])
+        # One token check for the whole batch
+        self.assertEqual(mock_decode_token.call_count, 1)
+
+        # Without a token, protected sub-requests fail on their own
+        mock_decode_token.return_value = None
+        response = self.client.post('/batch', json=[{"path": f"/posts/{post_id}"}, {"path": f"/users/{user_id}"}])
+        self.assertEqual([result['status'] for result in response.json], [200, 401])
+        self.assertEqual(self.client.post('/batch', json=[{"method": "POST", "path": "/batch"}]).status_code, 400)
+        self.assertEqual(self.client.post('/batch', json=[{"path": "posts"}]).status_code, 400)
+
+    @patch('auth.decode_token')
+    def test_batch_applies_each_routes_rate_limit(self, mock_decode_token):
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            post = Post(title='Post', content='Content', user_id=user.id)
+            db.session.add(post)
+            db.session.commit()
+            user_id, post_id = user.id, post.id
+        mock_decode_token.return_value = user_id
+
+        # POST /comments allows 10 per minute
+        response = self.client.post('/batch', headers={'Authorization': 'Bearer token'}, json=[
+            {"method": "POST", "path": "/comments", "body": {"content": f"Comment {n}", "post_id": post_id}}
+            for n in range(12)
+        ])
+        self.assertEqual([result['status'] for result in response.json], [201] * 10 + [429] * 2)
+        self.assertIn('Retry-After', response.json[-1]['headers'])
+
+    # Post snapshot
+    @patch('auth.decode_token')
+    def test_snapshot_serves_anonymous_reads_until_posts_change(self, mock_decode_token):
+        import tempfile
+        from snapshot import SnapshotReader, build_snapshot
+        with self.app.app_context():
+            user = User(name='Test User', username='testuser', email='test@example.com', password='testpass')
+            db.session.add(user)
+            db.session.flush()
+            db.session.add_all([Post(title=f'Post {n}', content=f'Content {n}', user_id=user.id) for n in range(3)])
+            db.session.commit()
+            user_id = user.id
+            post_id = Post.query.order_by(Post.id).first().id
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config.update(SNAPSHOT_PATH=f'{directory}/posts.snapshot', SNAPSHOT_BUILD_INTERVAL=0)
+            with self.app.app_context():
+                self.assertEqual(build_snapshot(self.app.config['SNAPSHOT_PATH'], chunk_size=2), 3)
+            reader = self.app.extensions['snapshot'] = SnapshotReader(self.app)
+
+            statements = []
+            with self.app.app_context():
+                engine = db.engine
+            record = lambda conn, cursor, statement, *args: statements.append(statement)
+            event.listen(engine, 'before_cursor_execute', record)
+            try:
+                from_snapshot = [self.client.get(path).data for path in
+                                 (f'/posts/{post_id}', '/posts', '/posts?page=2&per_page=2', '/posts?page=9')]
+            finally:
+                event.remove(engine, 'before_cursor_execute', record)
+            # (view counting may still merge its counters)
+            self.assertEqual([statement for statement in statements if 'posts' in statement], [])
+
+            # Byte for byte what the database path returns
+            del self.app.extensions['snapshot']
+            cache.clear()
+            from_database = [self.client.get(path).data for path in
+                             (f'/posts/{post_id}', '/posts', '/posts?page=2&per_page=2', '/posts?page=9')]
+            self.assertEqual(from_snapshot, from_database)
+            self.app.extensions['snapshot'] = reader
+
+            # A changed post and the list pages come from the database until the next snapshot
+            mock_decode_token.return_value = user_id
+            self.client.put(f'/posts/{post_id}', json={"title": "Renamed"})
+            self.assertEqual(self.client.get(f'/posts/{post_id}').json['title'], 'Renamed')
+            self.assertEqual(self.client.get('/posts').json[0]['title'], 'Renamed')
+            with self.app.app_context():
+                build_snapshot(self.app.config['SNAPSHOT_PATH'])
+            reader._checked_at = 0
+            self.assertIsNotNone(reader.post(post_id))
+            self.assertIn(b'Renamed', reader.post(post_id))
+
+            # Past the freshness bound nothing is served from it
+            reader.max_age = -1
+            self.assertIsNone(reader.post(post_id))
+            self.assertIsNone(reader.page(1, 10))
@@ -0,0 +1,42 @@
+from models import Comment
+
+
+def fetch_page(query, page, per_page):
+    """
+    Fetch one page of ``query`` plus one extra row to tell whether more follow.
+    """
+    rows = query.limit(per_page + 1).offset((page - 1) * per_page).all()
+    return rows[:per_page], len(rows) > per_page
+
+
+def subtree_query(root, max_depth):
+    """
+    Query a comment and its replies down to ``max_depth`` levels below it,
+    in depth-first order, as one range scan over the path index.
+    """
+    model = type(root)  # Comment or ArchivedComment
+    low, high = Comment.subtree_bounds(root.path)
+    return model.query.filter(
+        model.post_id == root.post_id,
+        model.path >= low,
+        model.path < high,
+        model.depth <= root.depth + max_depth
+    ).order_by(model.path)
+
+
+def build_tree(comments, serialized):
+    """
+    Nest serialized comments under their parents in a single pass.
+
+    ``comments`` must be in path order so every parent comes before its
+    replies. Comments whose parent is not in the list (it is on an earlier
+    page or above the requested root) are returned at the top level.
+    """
+    nodes = {}
+    roots = []
+    for comment, node in zip(comments, serialized):
+        node['replies'] = []
+        nodes[comment.id] = node
+        parent = nodes.get(comment.parent_id)
+        (parent['replies'] if parent is not None else roots).append(node)
+    return roots
@@ -0,0 +1,140 @@
+import base64
+import hashlib
+import io
+import json
+import threading
+import time
+
+import jwt
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+
+
+# Request headers worth replaying; everything else (cookies, proxies'
+# forwarding headers, the token itself) stays out of the capture
+REPLAYED_HEADERS = ('Content-Type', 'Accept', 'Accept-Encoding', 'If-None-Match')
+
+# JSON body fields replaced before the body is written
+REDACTED_FIELDS = {'password', 'token', 'secret'}
+
+
+def _redact(value):
+    """
+    Replace secrets in a JSON body, and emails with a stable fake address
+    so that uniqueness constraints still hold on replay.
+    """
+    if isinstance(value, list):
+        return [_redact(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    redacted = {}
+    for key, item in value.items():
+        if key in REDACTED_FIELDS:
+            redacted[key] = 'redacted'
+        elif key == 'email' and isinstance(item, str):
+            redacted[key] = f'{hashlib.sha256(item.encode()).hexdigest()[:12]}@example.invalid'
+        else:
+            redacted[key] = _redact(item)
+    return redacted
+
+
+def _replayed_headers(environ):
+    headers = {}
+    for name in REPLAYED_HEADERS:
+        key = 'CONTENT_TYPE' if name == 'Content-Type' else 'HTTP_' + name.upper().replace('-', '_')
+        if environ.get(key):
+            headers[name] = environ[key]
+    return headers
+
+
+class CaptureMiddleware:
+    """
+    WSGI middleware that appends every request to a JSONL capture file.
+
+    Each line holds the request line, replayable headers, a sanitized body,
+    the identity behind the bearer token (``user:<id>``, never the token),
+    the response status and the time the app took. Streaming responses
+    (server-sent events) are not captured.
+    """
+
+    def __init__(self, app, path, max_body=64 * 1024):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.path = path
+        self.max_body = max_body
+        self.started = time.monotonic()
+        self._file = open(path, 'a', buffering=1)
+        self._lock = threading.Lock()
+
+    def _identity(self, environ):
+        authorization = environ.get('HTTP_AUTHORIZATION', '')
+        if not authorization.startswith('Bearer '):
+            return None
+        try:
+            payload = jwt.decode(authorization[7:], self.app.config['SECRET_KEY'], algorithms=['HS256'])
+        except jwt.InvalidTokenError:
+            return 'invalid'
+        return f"user:{payload['sub']}"
+
+    def _endpoint(self, environ):
+        try:
+            endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    def _read_body(self, environ):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if not length:
+            return None, False
+        raw = environ['wsgi.input'].read(length)
+        # The app still gets the whole body
+        environ['wsgi.input'] = io.BytesIO(raw)
+        if length > self.max_body:
+            return None, True
+        try:
+            return {'json': _redact(json.loads(raw))}, False
+        except ValueError:
+            return {'base64': base64.b64encode(raw).decode('ascii')}, False
+
+    def __call__(self, environ, start_response):
+        body, truncated = self._read_body(environ)
+        record = {
+            'offset': time.monotonic() - self.started,
+            'method': environ['REQUEST_METHOD'],
+            'path': environ.get('PATH_INFO', '/'),
+            'query': environ.get('QUERY_STRING', ''),
+            'endpoint': self._endpoint(environ),
+            'headers': _replayed_headers(environ),
+            'auth': self._identity(environ),
+            'body': body,
+            'truncated': truncated,
+        }
+        started = time.perf_counter()
+        streaming = False
+
+        def capture_start_response(status, headers, exc_info=None):
+            nonlocal streaming
+            record['status'] = int(status.split(' ', 1)[0])
+            streaming = any(name.lower() == 'content-type' and value.startswith('text/event-stream')
+                            for name, value in headers)
+            return start_response(status, headers, exc_info)
+
+        def write_record():
+            if streaming:
+                return
+            record['duration_ms'] = (time.perf_counter() - started) * 1000
+            line = json.dumps(record, separators=(',', ':'))
+            with self._lock:
+                self._file.write(line + '\n')
+
+        return ClosingIterator(self.wsgi_app(environ, capture_start_response), write_record)
+
+
+def init_app(app):
+    """
+    Record traffic to ``TRAFFIC_CAPTURE_FILE`` when it is set (see replay.py).
+    """
+    path = app.config.get('TRAFFIC_CAPTURE_FILE')
+    if path:
+        app.wsgi_app = CaptureMiddleware(app, path, app.config.get('TRAFFIC_CAPTURE_MAX_BODY', 64 * 1024))
@@ -0,0 +1,194 @@
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import current_app, make_response, request
+from sqlalchemy import delete, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from extensions import db
+from models import TrendingSnapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+class MinuteRing:
+    """
+    Counts per minute for the last ``size`` minutes in a fixed ring buffer.
+    """
+
+    __slots__ = ('counts', 'minutes')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.minutes = [-1] * size
+
+    def add(self, minute, n=1):
+        i = minute % len(self.counts)
+        if self.minutes[i] != minute:
+            self.minutes[i] = minute
+            self.counts[i] = 0
+        self.counts[i] += n
+
+    def total(self, minute):
+        oldest = minute - len(self.counts)
+        return sum(count for count, m in zip(self.counts, self.minutes) if m > oldest)
+
+
+class TrendingCounters:
+    """
+    Sliding-window view and comment counters per post.
+
+    Recording only touches this process's ring buffers. Every
+    ``TRENDING_MERGE_INTERVAL`` seconds a background thread publishes the
+    process's window totals to the trending_snapshots table, sums every
+    live worker's totals and keeps the top K in memory, so reading the
+    trending list is O(K) and no request waits on the merge.
+    """
+
+    def __init__(self, config):
+        self.window = config.get('TRENDING_WINDOW_MINUTES', 60)
+        self.merge_interval = config.get('TRENDING_MERGE_INTERVAL', 10)
+        self.comment_weight = config.get('TRENDING_COMMENT_WEIGHT', 5)
+        self.top_k = config.get('TRENDING_TOP_K', 50)
+        self._views = {}
+        self._comments = {}
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        # A new worker has nothing of its own to publish until an interval has passed
+        self._last_merge = time.monotonic()
+        self._top = []
+
+    def _record(self, rings, post_id):
+        minute = int(time.time() // 60)
+        with self._lock:
+            ring = rings.get(post_id)
+            if ring is None:
+                ring = rings[post_id] = MinuteRing(self.window)
+            ring.add(minute)
+        self.maybe_merge()
+
+    def record_view(self, post_id):
+        self._record(self._views, post_id)
+
+    def record_comment(self, post_id):
+        self._record(self._comments, post_id)
+
+    def top(self, limit):
+        self.maybe_merge()
+        return self._top[:limit]
+
+    def maybe_merge(self):
+        """
+        Start a merge on a background thread once per merge interval; the
+        request goes on with the current list.
+        """
+        if time.monotonic() - self._last_merge < self.merge_interval:
+            return
+        # Only one merge per process at a time; the lock is released by the merge thread
+        if not self._merge_lock.acquire(blocking=False):
+            return
+        self._last_merge = time.monotonic()
+        app = current_app._get_current_object()
+        threading.Thread(target=self._run_merge, args=(app,), name='trending-merge', daemon=True).start()
+
+    def _run_merge(self, app):
+        try:
+            with app.app_context():
+                self.merge()
+        except SQLAlchemyError as e:
+            logger.warning("Could not merge trending counters: %s", e)
+        finally:
+            self._merge_lock.release()
+
+    def merge_now(self):
+        """
+        Merge on the calling thread, after any merge already running.
+        """
+        with self._merge_lock:
+            self._last_merge = time.monotonic()
+            self.merge()
+
+    def _window_totals(self):
+        minute = int(time.time() // 60)
+        totals = {}
+        with self._lock:
+            for name, rings in (('views', self._views), ('comments', self._comments)):
+                for post_id, ring in list(rings.items()):
+                    count = ring.total(minute)
+                    if count:
+                        totals.setdefault(post_id, {'views': 0, 'comments': 0})[name] = count
+                    else:
+                        # Nothing left in the window: forget the post
+                        del rings[post_id]
+        return totals
+
+    def merge(self):
+        """
+        Publish this worker's window totals and rebuild the merged top K.
+        """
+        # Read on every merge so a forked worker publishes under its own pid
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        # A private session, so a merge never commits a request's own changes
+        with Session(db.engine) as session:
+            session.execute(delete(TrendingSnapshot).where(TrendingSnapshot.worker == worker))
+            session.add_all(
+                TrendingSnapshot(worker=worker, post_id=post_id, updated_at=now, **counts)
+                for post_id, counts in self._window_totals().items()
+            )
+            # Workers that stopped publishing are dropped from the merge
+            stale = now - timedelta(seconds=3 * self.merge_interval)
+            session.execute(delete(TrendingSnapshot).where(TrendingSnapshot.updated_at < stale))
+            session.commit()
+
+            rows = session.execute(
+                select(TrendingSnapshot.post_id,
+                       func.sum(TrendingSnapshot.views),
+                       func.sum(TrendingSnapshot.comments))
+                .group_by(TrendingSnapshot.post_id)
+            ).all()
+        scored = ((views + self.comment_weight * comments, post_id, views, comments) for post_id, views, comments in rows)
+        self._top = [
+            {'post_id': post_id, 'score': score, 'views': views, 'comments': comments}
+            for score, post_id, views, comments in heapq.nlargest(self.top_k, scored)
+        ]
+
+
+def init_app(app):
+    if app.config.get('TRENDING_ENABLED', True):
+        app.extensions['trending'] = TrendingCounters(app.config)
+
+
+def record_comment(post_id):
+    counters = current_app.extensions.get('trending')
+    if counters is not None:
+        counters.record_comment(post_id)
+
+
+def trending_posts(limit):
+    counters = current_app.extensions.get('trending')
+    return counters.top(limit) if counters is not None else []
+
+
+def count_view(f):
+    """
+    Count a view of the post in the trending window, cache hits included.
+    Only successful responses count, so ids that 404 never get a ring.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        response = make_response(f(*args, **kwargs))
+        counters = current_app.extensions.get('trending')
+        if counters is not None and response.status_code == 200 and not request.environ.get('blog.warmup'):
+            counters.record_view(kwargs['id'])
+        return response
+    return decorated_function
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.exceptions import NotFound
+
+from caching import apply_invalidations, hot_post_ids, seed_post_hits, shared_cache
+from jobs import enqueue, job_handler
+from pubsub import broker
+
+
+logger = logging.getLogger(__name__)
+
+# Published after a worker re-warmed its process-local cache, so the others do too
+WARMUP_CHANNEL = 'cache:warmup'
+
+
+def _hot_set_path(app):
+    return app.config.get('CACHE_HOT_SET_FILE') or os.path.join(app.instance_path, 'hot_posts.json')
+
+
+def _load_hot_set(app):
+    """
+    Seed the access counters from the hot set saved by a previous process.
+    """
+    try:
+        with open(_hot_set_path(app)) as f:
+            seed_post_hits({int(post_id): hits for post_id, hits in json.load(f).items()})
+    except (OSError, ValueError):
+        pass
+
+
+def _save_hot_set(app, post_ids):
+    path = _hot_set_path(app)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Store ranks rather than raw counts so a restart keeps the order
+        # without letting old traffic outweigh new traffic forever.
+        with open(path, 'w') as f:
+            json.dump({str(post_id): len(post_ids) - rank for rank, post_id in enumerate(post_ids)}, f)
+    except OSError as e:
+        logger.warning("Could not save hot post set: %s", e)
+
+
+def warm_cache(app):
+    """
+    Precompute the first list_posts pages and the most requested posts.
+
+    Views are dispatched inside a synthetic request, so the entries land
+    under exactly the keys real requests use.
+    """
+    pages = app.config.get('CACHE_WARMUP_LIST_PAGES', 5)
+    hot_posts = hot_post_ids(app.config.get('CACHE_WARMUP_HOT_POSTS', 20))
+
+    paths = ['/posts'] + [f'/posts?page={page}' for page in range(1, pages + 1)]
+    paths += [f'/posts/{post_id}' for post_id in hot_posts]
+
+    for path in paths:
+        with app.test_request_context(path, environ_base={'blog.warmup': True}):
+            try:
+                app.dispatch_request()
+            except SQLAlchemyError as e:
+                logger.warning("Cache warm-up stopped at %s: %s", path, e)
+                return
+            except NotFound:
+                # A hot post may have been deleted since it was counted
+                continue
+
+    _save_hot_set(app, hot_posts)
+
+
+def warm_cache_on_start(app):
+    """
+    Warm the cache before the worker takes traffic.
+    """
+    if not app.config.get('CACHE_WARMUP_ON_START', True):
+        return
+    _load_hot_set(app)
+    warm_cache(app)
+
+
+def schedule_warmup(app):
+    """
+    Queue a background re-warm after a write invalidated the cache.
+
+    Call it before the write commits: the job is only queued if the commit
+    succeeds, and all warm-ups queued meanwhile run as one batch.
+    """
+    if app.config.get('CACHE_WARMUP_AFTER_WRITE', True):
+        enqueue('warm_cache')
+
+
+@job_handler('warm_cache')
+def _run_warmup(payloads):
+    app = current_app._get_current_object()
+    warm_cache(app)
+    if not shared_cache():
+        broker.publish(WARMUP_CHANNEL, {'pid': os.getpid()})
+
+
+class Rewarmer:
+    """
+    Re-warms this worker's process-local cache on a background thread
+    whenever another worker ran a warm-up job.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.subscription = broker.subscribe(WARMUP_CHANNEL)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='cache-rewarm', daemon=True)
+                self._thread.start()
+
+    def run(self):
+        while True:
+            events = self.subscription.wait(None)
+            lagged, self.subscription.lagged = self.subscription.lagged, False
+            if not lagged and all(event['pid'] == os.getpid() for event in events):
+                continue
+            try:
+                # Warm from the invalidated state, not the entries the writes replaced
+                with self.app.app_context():
+                    apply_invalidations(self.app.extensions['cache_invalidations'])
+                warm_cache(self.app)
+            except Exception:
+                logger.exception("Cache re-warm failed")
+
+
+def init_app(app):
+    """
+    With a process-local ``CACHE_TYPE``, re-warm each worker's cache when
+    another worker re-warmed its own. The thread starts with the worker's
+    first request, so a preloaded master never runs it.
+    """
+    if 'cache_invalidations' not in app.extensions:
+        return
+    rewarmer = app.extensions['cache_rewarm'] = Rewarmer(app)
+
+    @app.before_request
+    def start_rewarmer():
+        if rewarmer._thread is None or not rewarmer._thread.is_alive():
+            rewarmer.start()